@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# codec benchmark: encodes and decodes synthetic payloads of several sizes
+# with each available codec, reporting the encoded size and the encode and
+# decode time per payload as JSON, against plain JSON as the baseline
+#
+#   python bench/codec.py --sizes 1024,65536 --runs 200
+#   python bench/codec.py --codecs msgpack,msgpack+zstd --output codec.json
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
+sys.path[:0] = [ROOT_PATH, LAYER_DIR]
+
+from bench import percentile  # noqa: E402
+from sedo_common import codec  # noqa: E402
+
+SIZES = [256, 4096, 65536, 262144]
+
+
+def get_payload(size, seed=0):
+    # a list of records, as an execution input or output typically is, of
+    # about size bytes as JSON
+    rnd = random.Random(seed)
+    records = []
+    while len(json.dumps(records)) < size:
+        records.append({
+            'id': '%08x' % rnd.getrandbits(32),
+            'name': rnd.choice(['alpha', 'bravo', 'charlie', 'delta']),
+            'amount': round(rnd.random() * 1000, 2),
+            'count': rnd.randint(0, 100000),
+            'active': rnd.random() > 0.5,
+            'tags': rnd.sample(['a', 'b', 'c', 'd', 'e', 'f'], 2)
+        })
+    return records
+
+
+def is_available(name):
+    try:
+        codec.encode({}, name, min_bytes=0)
+    except ImportError:
+        return False
+    return True
+
+
+def measure(payload, name, runs):
+    # (size, encode times, decode times) in bytes and microseconds
+    if name == 'none':
+        (encode, decode) = (json.dumps, json.loads)
+    else:
+        def encode(x):
+            return codec.encode(x, name, min_bytes=0)
+        decode = codec.decode
+    (encoded, encode_us, decode_us) = (None, [], [])
+    for i in range(runs):
+        t = time.perf_counter()
+        encoded = encode(payload)
+        encode_us.append((time.perf_counter() - t) * 1000000)
+        t = time.perf_counter()
+        decoded = decode(encoded)
+        decode_us.append((time.perf_counter() - t) * 1000000)
+    if decoded != payload:
+        raise Exception('%s does not round trip' % name)
+    return len(encoded), encode_us, decode_us
+
+
+def run(sizes=None, codecs=None, runs=100):
+    codecs = ['none'] + [
+        c for c in (codecs or list(codec.CODECS)) if is_available(c)
+    ]
+    results = {'params': {'runs': runs}, 'sizes': []}
+    for size in sizes or SIZES:
+        payload = get_payload(size)
+        json_bytes = len(json.dumps(payload))
+        result = {'size': json_bytes, 'codecs': {}}
+        for name in codecs:
+            (encoded_bytes, encode_us, decode_us) = measure(
+                payload, name, runs
+            )
+            result['codecs'][name] = {
+                'bytes': encoded_bytes,
+                'ratio': round(encoded_bytes / json_bytes, 3),
+                'encode_us': {
+                    'p50': round(percentile(encode_us, 50), 1),
+                    'p95': round(percentile(encode_us, 95), 1)
+                },
+                'decode_us': {
+                    'p50': round(percentile(decode_us, 50), 1),
+                    'p95': round(percentile(decode_us, 95), 1)
+                }
+            }
+        results['sizes'].append(result)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument('--sizes', help='comma separated JSON payload sizes')
+    ap.add_argument('--codecs', help='comma separated codecs, default all')
+    ap.add_argument('--runs', type=int, default=100)
+    ap.add_argument('--output', help='write JSON results to file')
+    args = ap.parse_args()
+    results = run(
+        [int(x) for x in args.sizes.split(',')] if args.sizes else None,
+        args.codecs.split(',') if args.codecs else None,
+        args.runs
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
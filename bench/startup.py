@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# cold start benchmark: imports each handler's index module in a fresh
+# interpreter and times the import and the first and second invocations,
+# with AWS mocked by moto
+#
+#   python bench/startup.py --runs 5 --output startup.json
+#   python bench/startup.py --budget-ms processor:import=600
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
+sys.path.insert(0, ROOT_PATH)
+
+from bench import percentile  # noqa: E402
+
+HANDLERS = {
+    'processor': 'sedo_execution-processor',
+    'api': 'sedo_api'
+}
+METRICS = ['import', 'first', 'second']
+
+# run in the child interpreter, timings are printed as JSON on the last line
+CHILD = '''
+import json, os, sys, time
+sys.path[:0] = [%(func_dir)r, %(layer_dir)r, %(root_path)r]
+os.chdir(%(func_dir)r)
+os.environ.setdefault('AWS_REGION', 'us-east-1')
+t0 = time.perf_counter()
+import index
+t1 = time.perf_counter()
+from moto import mock_dynamodb2, mock_sqs
+mocks = [mock_dynamodb2(), mock_sqs()]
+for m in mocks:
+    m.start()
+from bench.startup import get_invocation
+from tests import helpers as h
+h.create_infra()
+invoke = get_invocation(%(name)r, index)
+t2 = time.perf_counter()
+invoke()
+t3 = time.perf_counter()
+invoke()
+t4 = time.perf_counter()
+for m in mocks:
+    m.stop()
+print(json.dumps({
+    'import': (t1 - t0) * 1000,
+    'first': (t3 - t2) * 1000,
+    'second': (t4 - t3) * 1000
+}))
+'''
+
+
+def get_invocation(name, index):
+    # returns a callable making one representative request for the handler
+    from tests import helpers as h
+    if name == 'api':
+        return lambda: h.invoke(
+            index.handler, 'GET', '/sedo/tenants/123/definitions'
+        )
+    from processor import get_definition_hash
+    from processor import now_dt
+    from processor import timestamp
+    from sedo_common import codec
+    definition = h.load_file(
+        os.path.join(ROOT_PATH, 'example-definition.yaml')
+    )
+    definition['tenantId'] = '123'
+    # the definition version, executions and their first events are seeded
+    # as the API writes them, an execution for each invocation so the
+    # second is not dropped as a duplicate of the first
+    version = get_definition_hash(definition)
+    dynamodb = h.get_session().resource('dynamodb')
+    dynamodb.Table('sedo_definition_version').put_item(Item={
+        'tenantId': '123',
+        'id': version,
+        'definitionId': definition['id'],
+        'definition': codec.encode(definition)
+    })
+    input = {'foo': 'bar'}
+    now = timestamp(now_dt())
+    events = []
+    for i in range(2):
+        id = '123:%s:bench-%s' % (definition['id'], i)
+        dynamodb.Table('sedo_execution').put_item(Item={
+            'tenantId': '123',
+            'id': id,
+            'state': 'ExecutionSubmitted',
+            'input': codec.encode(input),
+            'definitionId': definition['id'],
+            'definitionHash': version,
+            'revision': 0,
+            'activeState': 'ExecutionSubmitted',
+            'createdAt': now,
+            'updatedAt': now
+        })
+        events.append({
+            'Records': [{
+                'messageId': 'bench-%s' % i,
+                'body': codec.encode_body({
+                    'tenantId': '123',
+                    'id': id,
+                    'state': 'ExecutionSubmitted',
+                    'input': input,
+                    'definitionHash': version,
+                    'revision': 0
+                }),
+                'attributes': {'ApproximateReceiveCount': '1'}
+            }]
+        })
+    events = iter(events)
+    return lambda: index.handler(next(events), None)
+
+
+def measure(name):
+    code = CHILD % {
+        'name': name,
+        'func_dir': os.path.join(ROOT_PATH, 'functions', HANDLERS[name]),
+        'layer_dir': LAYER_DIR,
+        'root_path': ROOT_PATH
+    }
+    out = subprocess.run(
+        [sys.executable, '-c', code],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def run(names=None, runs=5):
+    results = {}
+    for name in names or list(HANDLERS.keys()):
+        samples = [measure(name) for _ in range(runs)]
+        results[name] = {
+            metric: {
+                'p50': round(percentile([x[metric] for x in samples], 50), 2),
+                'max': round(max([x[metric] for x in samples]), 2)
+            } for metric in METRICS
+        }
+    return results
+
+
+def parse_budgets(budgets):
+    # handler:metric=ms
+    parsed = {}
+    for budget in budgets or []:
+        key, ms = budget.split('=')
+        name, metric = key.split(':')
+        if name not in HANDLERS or metric not in METRICS:
+            raise Exception('invalid budget %s' % budget)
+        parsed[(name, metric)] = float(ms)
+    return parsed
+
+
+def check_budgets(results, budgets):
+    # p50 over budget, as a list of messages
+    return [
+        '%s %s p50 %sms over budget %sms' % (
+            name, metric, results[name][metric]['p50'], ms
+        )
+        for (name, metric), ms in sorted(budgets.items())
+        if name in results and results[name][metric]['p50'] > ms
+    ]
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='cold start benchmark')
+    ap.add_argument('--handler', action='append', choices=HANDLERS.keys())
+    ap.add_argument('--runs', type=int, default=5)
+    ap.add_argument('--output', help='write JSON results to file')
+    ap.add_argument(
+        '--budget-ms', action='append',
+        help='fail if p50 exceeds budget, e.g. processor:import=600'
+    )
+    args = ap.parse_args()
+    budgets = parse_budgets(args.budget_ms)
+    results = run(args.handler, args.runs)
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    errors = check_budgets(results, budgets)
+    for error in errors:
+        print(error, file=sys.stderr)
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# throughput benchmark: submits synthetic executions of a generated
+# definition and drives them through sqs_handler against a local backend,
+# reporting transitions per second, latency percentiles and backend calls
+# per execution as JSON
+#
+#   python bench/throughput.py --executions 5000 --steps 10 --wait-ratio 0.2
+#   python bench/throughput.py --backend sqlite --output results.json
+#   python bench/throughput.py --baseline results.json --max-regression 0.2
+import argparse
+from collections import Counter
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FUNC_DIR = os.path.join(ROOT_PATH, 'functions', 'sedo_execution-processor')
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
+sys.path[:0] = [ROOT_PATH, FUNC_DIR, LAYER_DIR]
+
+from bench import percentile  # noqa: E402
+import processor  # noqa: E402
+from sedo_common import backends  # noqa: E402
+from sedo_common import claimcheck  # noqa: E402
+from sedo_common import codec  # noqa: E402
+from sedo_common import scheduling  # noqa: E402
+
+TENANT_ID = 'bench'
+QUEUE_NAME = scheduling.get_queue_name(TENANT_ID)
+
+
+class Recorder(object):
+    # counts calls to the methods of a backend, calling hooks[name] with
+    # the arguments of each successful call
+
+    def __init__(self, target, hooks=None):
+        self.target = target
+        self.hooks = hooks or {}
+        self.calls = Counter()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        method = getattr(self.target, name)
+        hook = self.hooks.get(name)
+
+        def call(*args, **kwargs):
+            with self.lock:
+                self.calls[name] += 1
+            r = method(*args, **kwargs)
+            if hook is not None:
+                hook(*args, **kwargs)
+            return r
+        return call
+
+
+def get_step_id(i):
+    # step ids are lower case letters
+    letters = ''
+    while True:
+        letters = chr(ord('a') + i % 26) + letters
+        i = i // 26 - 1
+        if i < 0:
+            return 'step-%s' % letters
+
+
+def get_definition(steps, wait_ratio=0.0, wait_seconds=1):
+    # wait steps are spread evenly through the echo steps
+    definition = {
+        'id': 'bench-%s-%s' % (steps, int(wait_ratio * 100)),
+        'tenantId': TENANT_ID,
+        'inputSchema': {'type': 'object'},
+        'steps': []
+    }
+    for i in range(steps):
+        step = {'id': get_step_id(i)}
+        if int((i + 1) * wait_ratio) > int(i * wait_ratio):
+            step.update({'type': 'wait', 'seconds': wait_seconds})
+        else:
+            step.update({'type': 'echo', 'message': 'bench'})
+        if i == steps - 1:
+            step['end'] = True
+        else:
+            step['next'] = get_step_id(i + 1)
+        definition['steps'].append(step)
+    return definition
+
+
+def submit(store, queue, definition, executions, input_size=0):
+    # writes the definition version, executions and their first events as
+    # the API does, returning the submit time of each execution
+    version = processor.get_definition_hash(definition)
+    store.put_item('sedo_definition_version', {
+        'tenantId': TENANT_ID,
+        'id': version,
+        'definitionId': definition['id'],
+        'definition': codec.encode(definition)
+    })
+    now = processor.timestamp(processor.now_dt())
+    input = claimcheck.offload({'data': 'x' * input_size}, TENANT_ID)
+    submitted = {}
+    for i in range(0, executions, 500):
+        items = []
+        entries = []
+        for j in range(i, min(i + 500, executions)):
+            id = '%s:%s:%08d' % (TENANT_ID, definition['id'], j)
+            items.append({
+                'tenantId': TENANT_ID,
+                'id': id,
+                'state': 'ExecutionSubmitted',
+                'input': codec.encode(input),
+                'definitionId': definition['id'],
+                'definitionHash': version,
+                'revision': 0,
+                'activeState': 'ExecutionSubmitted',
+                'createdAt': now,
+                'updatedAt': now
+            })
+            entries.append({'Id': str(j), 'MessageBody': codec.encode_body({
+                'tenantId': TENANT_ID,
+                'id': id,
+                'state': 'ExecutionSubmitted',
+                'input': input,
+                'definitionHash': version,
+                'revision': 0
+            })})
+        store.batch_write('sedo_execution', items)
+        t = time.time()
+        queue.send_message_batch(QUEUE_NAME, entries)
+        submitted.update({item['id']: t for item in items})
+    return submitted
+
+
+def drive(queue, executions, done, received, batch_size=10, timeout=600):
+    # receives batches and hands them to sqs_handler, as the SQS event
+    # source mapping does, until every execution has finished
+    deadline = time.time() + timeout
+    while len(done) < executions and time.time() < deadline:
+        records = queue.receive_messages(QUEUE_NAME, batch_size)
+        if len(records) == 0:
+            time.sleep(0.01)
+            continue
+        now = time.time()
+        for record in records:
+            received[codec.decode_body(record['body'])['id']] = now
+        r = processor.sqs_handler({'Records': records}, None)
+        failed = [x['itemIdentifier'] for x in r['batchItemFailures']]
+        queue.delete_messages(QUEUE_NAME, [
+            record for record in records if record['messageId'] not in failed
+        ])
+
+
+def get_latency(seconds):
+    ms = [x * 1000 for x in seconds]
+    if len(ms) == 0:
+        return None
+    return {
+        'p50': round(percentile(ms, 50), 3),
+        'p95': round(percentile(ms, 95), 3),
+        'p99': round(percentile(ms, 99), 3),
+        'max': round(max(ms), 3)
+    }
+
+
+def create_backend(name, sqlite_path=None):
+    if name == 'sqlite':
+        from sedo_common.backends.sqlite import FileBlobStore
+        from sedo_common.backends.sqlite import SqliteQueue
+        from sedo_common.backends.sqlite import SqliteStore
+        if sqlite_path is None:
+            sqlite_path = os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+        return (
+            SqliteStore(sqlite_path),
+            SqliteQueue(sqlite_path),
+            FileBlobStore(sqlite_path + '-blobs')
+        )
+    return tuple([
+        backends.create(kind, name) for kind in ['store', 'queue', 'blobs']
+    ])
+
+
+def run(executions=1000, steps=5, wait_ratio=0.0, wait_seconds=1,
+        input_size=0, backend='memory', batch_size=10, concurrency=1,
+        sqlite_path=None, timeout=600):
+    (store, queue, blobs) = create_backend(backend, sqlite_path)
+    # execution IDs are reused by every run, on a new backend
+    processor.DEDUPE_CACHE.clear()
+    definition = get_definition(steps, wait_ratio, wait_seconds)
+    backends.set_backend(store, queue, blobs)
+    submitted = submit(store, queue, definition, executions, input_size)
+
+    # transition latency is from the event being received by sqs_handler
+    # to the execution being written, so excludes queue delays and waits
+    (received, done, latencies) = ({}, {}, [])
+    transitions = Counter()
+
+    def on_update(table, key, values, remove=None, condition=None, **kwargs):
+        if table != 'sedo_execution' or 'state' not in values:
+            return
+        now = time.time()
+        latencies.append(now - received[key['id']])
+        if values['state'] in processor.TERMINAL_STATES:
+            done[key['id']] = now
+
+    _transition = processor.transition
+
+    def transition(*args, **kwargs):
+        transitions['count'] += 1
+        return _transition(*args, **kwargs)
+
+    recorders = {
+        'store': Recorder(store, {'update_item': on_update}),
+        'queue': Recorder(queue)
+    }
+    backends.set_backend(recorders['store'], recorders['queue'], blobs)
+    processor.transition = transition
+    start = time.time()
+    try:
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                threads = [threading.Thread(
+                    target=drive,
+                    args=(
+                        queue, executions, done, received, batch_size, timeout
+                    )
+                ) for _ in range(concurrency)]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+    finally:
+        processor.transition = _transition
+        backends.reset()
+    duration = time.time() - start
+
+    calls = {}
+    for kind, recorder in recorders.items():
+        for name, count in sorted(recorder.calls.items()):
+            calls['%s.%s' % (kind, name)] = round(count / executions, 3)
+    calls['total'] = round(sum(calls.values()), 3)
+    return {
+        'params': {
+            'executions': executions,
+            'steps': steps,
+            'wait_ratio': wait_ratio,
+            'wait_seconds': wait_seconds,
+            'input_size': input_size,
+            'backend': backend,
+            'batch_size': batch_size,
+            'concurrency': concurrency
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform()
+        },
+        'completed': len(done),
+        'duration_s': round(duration, 3),
+        'transitions': transitions['count'],
+        'transitions_per_second': round(transitions['count'] / duration, 1),
+        'executions_per_second': round(len(done) / duration, 1),
+        'latency_ms': {
+            'execution': get_latency([
+                done[id] - submitted[id] for id in done
+            ]),
+            'transition': get_latency(latencies)
+        },
+        'calls_per_execution': calls
+    }
+
+
+def compare(results, baseline, max_regression=0.2):
+    # regressions beyond max_regression against a baseline run, as a list
+    # of messages
+    errors = []
+    checks = [
+        ('transitions_per_second', lambda r: r['transitions_per_second'], -1),
+        ('transition p95', lambda r: r['latency_ms']['transition']['p95'], 1),
+        ('execution p95', lambda r: r['latency_ms']['execution']['p95'], 1),
+        ('calls per execution', lambda r: r['calls_per_execution']['total'], 1)
+    ]
+    for (name, get, sign) in checks:
+        (value, base) = (get(results), get(baseline))
+        if base and sign * (value - base) / base > max_regression:
+            errors.append('%s regressed from %s to %s' % (name, base, value))
+    return errors
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description='throughput benchmark')
+    ap.add_argument('--executions', type=int, default=1000)
+    ap.add_argument('--steps', type=int, default=5)
+    ap.add_argument('--wait-ratio', type=float, default=0.0,
+                    help='fraction of steps that are wait steps')
+    ap.add_argument('--wait-seconds', type=int, default=1)
+    ap.add_argument('--input-size', type=int, default=0,
+                    help='execution input size in bytes')
+    ap.add_argument('--backend', choices=['memory', 'sqlite'],
+                    default='memory')
+    ap.add_argument('--sqlite-path')
+    ap.add_argument('--batch-size', type=int, default=10)
+    ap.add_argument('--concurrency', type=int, default=1,
+                    help='concurrent sqs_handler invocations')
+    ap.add_argument('--timeout', type=int, default=600)
+    ap.add_argument('--output', help='write JSON results to file')
+    ap.add_argument('--baseline', help='JSON results to compare against')
+    ap.add_argument('--max-regression', type=float, default=0.2)
+    args = ap.parse_args()
+    results = run(
+        args.executions, args.steps, args.wait_ratio, args.wait_seconds,
+        args.input_size, args.backend, args.batch_size, args.concurrency,
+        args.sqlite_path, args.timeout
+    )
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    errors = []
+    if results['completed'] < args.executions:
+        errors.append('%s of %s executions completed' % (
+            results['completed'], args.executions
+        ))
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            errors.extend(compare(results, json.load(f), args.max_regression))
+    for error in errors:
+        print(error, file=sys.stderr)
+    sys.exit(1 if errors else 0)
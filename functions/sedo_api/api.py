@@ -12,27 +12,73 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import base64
+from boto3.dynamodb.conditions import Attr
 from boto3.dynamodb.conditions import Key
 from boto3.dynamodb.types import Decimal
-from boto3.session import Session
+from collections import OrderedDict
+import copy
 from datetime import datetime
+from flask import has_request_context
+from flask import request
+from flask import Response
+import hashlib
 import json
-from jsonschema import validate
 import os
+from sedo_common.backends import ConditionFailed
+from sedo_common import claimcheck
+from sedo_common import codec
+from sedo_common.backends import get_queue
+from sedo_common.backends import get_store
+from sedo_common.definitions import compile_definition
+from sedo_common.definitions import InvalidDefinition
+from sedo_common import scheduling
+from sedo_common.validation import validate
+import threading
+import time
 import traceback
 from uuid import uuid4
 
-
-def get_session():
-    return Session(region_name=os.environ.get('AWS_REGION', 'us-east-1'))
-
-
-def get_table(name):
-    return get_session().resource('dynamodb').Table(name)
-
-
-def get_client(name):
-    return get_session().client(name)
+# list endpoints return a page of items, with the next page cursor header
+DEFAULT_LIMIT = 100
+CURSOR_HEADER = 'X-Next-Cursor'
+# ndjson exports are buffered into a single Lambda response, of at most 6MB,
+# so they end after SEDO_NDJSON_LIMIT items, or the page going over
+# SEDO_NDJSON_MAX_BYTES, with the cursor of the rest
+NDJSON_LIMIT = int(os.environ.get('SEDO_NDJSON_LIMIT', 1000))
+NDJSON_MAX_BYTES = int(
+    os.environ.get('SEDO_NDJSON_MAX_BYTES', 4 * 1024 * 1024)
+)
+
+# execution states that are kept in the sparse active-index
+ACTIVE_STATES = [
+    'ExecutionSubmitted',
+    'ExecutionStarted',
+    'StepStarted',
+    'StepFailed',
+    'StepSucceeded'
+]
+
+# definitions read by this container, kept for SEDO_DEFINITION_CACHE_TTL
+# seconds and dropped when written through it. other containers serve a
+# replaced definition until their copy expires
+DEFINITION_CACHE_TTL = int(os.environ.get('SEDO_DEFINITION_CACHE_TTL', 30))
+DEFINITION_CACHE_SIZE = int(os.environ.get('SEDO_DEFINITION_CACHE_SIZE', 256))
+DEFINITION_CACHE = OrderedDict()
+DEFINITION_CACHE_LOCK = threading.Lock()
+
+# waiting for an execution polls its state alone, backing off from the
+# minimum to the maximum interval, until it is terminal or the timeout
+TERMINAL_STATES = ['ExecutionSucceeded', 'ExecutionFailed']
+WAIT_TIMEOUT = 20
+WAIT_MIN_INTERVAL = float(os.environ.get('SEDO_WAIT_MIN_INTERVAL', 0.1))
+WAIT_MAX_INTERVAL = float(os.environ.get('SEDO_WAIT_MAX_INTERVAL', 2))
+
+# attributes projected into the execution indexes
+EXECUTION_INDEX_ATTRIBUTES = [
+    'tenantId', 'id', 'state', 'step', 'definitionId', 'createdAt',
+    'updatedAt', 'activeState'
+]
 
 
 def problem(title, detail=None, status=400, type=None):
@@ -82,56 +128,198 @@ def json_serial(obj):
     raise TypeError('type not serializable')
 
 
-def query(entity, tenantId, id=None, attributes=None):
-    table = get_table(entity)
+def get_definition_hash(definition):
+    definition = {k: v for k, v in definition.items() if k != 'version'}
+    return hashlib.sha256(json.dumps(
+        definition, sort_keys=True, separators=(',', ':'), default=json_serial
+    ).encode('utf-8')).hexdigest()
+
+
+def write_definition_version(definition):
+    # versions are immutable and addressed by content hash, so an existing
+    # version never needs to be overwritten
+    version = get_definition_hash(definition)
+    try:
+        get_store().put_item(
+            'sedo_definition_version',
+            {
+                'tenantId': definition['tenantId'],
+                'id': version,
+                'definitionId': definition['id'],
+                'definition': codec.encode({
+                    k: v for k, v in definition.items() if k != 'version'
+                })
+            },
+            condition=Attr('id').not_exists()
+        )
+    except ConditionFailed:
+        pass
+    return version
+
+
+def get_cached_definition(tenantId, id, now=None):
+    if now is None:
+        now = time.time()
+    key = (tenantId, id)
+    with DEFINITION_CACHE_LOCK:
+        entry = DEFINITION_CACHE.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del DEFINITION_CACHE[key]
+            return None
+        DEFINITION_CACHE.move_to_end(key)
+        return copy.deepcopy(entry[1])
+
+
+def cache_definition(definition, now=None):
+    if DEFINITION_CACHE_TTL <= 0:
+        return
+    if now is None:
+        now = time.time()
+    key = (definition['tenantId'], definition['id'])
+    with DEFINITION_CACHE_LOCK:
+        DEFINITION_CACHE[key] = (
+            now + DEFINITION_CACHE_TTL, copy.deepcopy(definition)
+        )
+        DEFINITION_CACHE.move_to_end(key)
+        while len(DEFINITION_CACHE) > DEFINITION_CACHE_SIZE:
+            DEFINITION_CACHE.popitem(last=False)
+
+
+def invalidate_definition(tenantId, id):
+    with DEFINITION_CACHE_LOCK:
+        DEFINITION_CACHE.pop((tenantId, id), None)
+
+
+def get_etag(body):
+    # strong ETag of a JSON body
+    return '"%s"' % hashlib.sha256(json.dumps(
+        body, sort_keys=True, separators=(',', ':'), default=json_serial
+    ).encode('utf-8')).hexdigest()
+
+
+def is_not_modified(etag):
+    # whether the request's If-None-Match header matches the ETag
+    if not has_request_context():
+        return False
+    header = request.headers.get('If-None-Match')
+    if header is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/%s' % etag in tags
 
-    def _item(item):
-        return json.loads(json.dumps(item, default=json_serial))
 
+def not_modified(etag):
+    return Response(status=304, headers={'ETag': etag})
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(
+        json.dumps(key, default=json_serial).encode('utf-8')
+    ).decode('utf-8')
+
+
+def decode_cursor(cursor, tenantId, hash_key='tenantId'):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+    except Exception:
+        key = None
+    if not isinstance(key, dict) or key.get(hash_key) != tenantId:
+        raise ValueError('invalid cursor')
+    return key
+
+
+def to_item(item):
+    # attributes stored with the codec are returned as JSON
+    return json.loads(
+        json.dumps(codec.decode_fields(item), default=json_serial)
+    )
+
+
+def get_query_kwargs(tenantId, attributes=None, index=None,
+                     key_condition=None, filter_expression=None,
+                     hash_key='tenantId'):
+    kwargs = {
+        'key_condition': Key(hash_key).eq(tenantId),
+        'index': index,
+        'filter': filter_expression,
+        'attributes': attributes
+    }
+    if key_condition is not None:
+        kwargs['key_condition'] &= key_condition
+    return kwargs
+
+
+def export(entity, kwargs, limit):
+    # returns up to limit items as newline delimited JSON, read a page at a
+    # time, and the key to start the rest from or None
+    store = get_store()
+    lines = []
+    size = 0
+    while True:
+        kwargs['limit'] = min(limit - len(lines), DEFAULT_LIMIT)
+        (items, start_key) = store.query(entity, **kwargs)
+        for item in items:
+            lines.append(json.dumps(to_item(item)) + '\n')
+            size += len(lines[-1])
+        if start_key is None or len(lines) >= limit or (
+            size >= NDJSON_MAX_BYTES
+        ):
+            return ''.join(lines), start_key
+        kwargs['start_key'] = start_key
+
+
+def query(entity, tenantId, id=None, attributes=None, limit=None,
+          cursor=None, format=None, index=None, key_condition=None,
+          filter_expression=None, hash_key='tenantId'):
     # get by ID
     if tenantId is not None and id is not None:
-        response = {}
         try:
-            response = get_table(entity).get_item(Key=get_key(tenantId, id))
+            item = get_store().get_item(entity, get_key(tenantId, id))
         except Exception as e:
             return log_exception('unable to get %s' % entity, e)
-        if 'Item' not in response:
+        if item is None:
             return problem(
                 '%s not found' % entity.replace('sedo_', ''), status=404
             )
-        return _item(response['Item']), 200
+        return to_item(item), 200
 
-    kwargs = {
-        'KeyConditionExpression': Key('tenantId').eq(tenantId)
-    }
+    kwargs = get_query_kwargs(
+        tenantId, attributes, index, key_condition, filter_expression,
+        hash_key
+    )
+    if cursor is not None:
+        try:
+            kwargs['start_key'] = decode_cursor(cursor, tenantId, hash_key)
+        except ValueError as e:
+            return problem(str(e))
 
-    if isinstance(attributes, list):
-        kwargs.update({
-            'ProjectionExpression': ', '.join([
-                '#%s' % a for a in attributes
-            ]),
-            'ExpressionAttributeNames': {},
-            'Select': 'SPECIFIC_ATTRIBUTES'
-        })
-    for a in attributes:
-        kwargs['ExpressionAttributeNames']['#%s' % a] = a
-
-    response = []
-    last_key = None
+    if format == 'ndjson':
+        headers = {}
+        try:
+            (body, start_key) = export(
+                entity, kwargs, NDJSON_LIMIT if limit is None else limit
+            )
+        except Exception as e:
+            return log_exception('unable to query %s' % (entity), e)
+        if start_key is not None:
+            headers[CURSOR_HEADER] = encode_cursor(start_key)
+        return Response(
+            body, mimetype='application/x-ndjson', headers=headers
+        )
+
+    # a single page, with the cursor of the next page if there is one
+    kwargs['limit'] = DEFAULT_LIMIT if limit is None else limit
+    headers = {}
     try:
-        while True:
-            if last_key is not None:
-                kwargs['ExclusiveStartKey'] = last_key
-            r = table.query(**kwargs)
-            for item in r['Items']:
-                response.append(_item(item))
-            if 'LastEvaluatedKey' in r:
-                last_key = r['LastEvaluatedKey']
-            else:
-                break
+        (items, start_key) = get_store().query(entity, **kwargs)
     except Exception as e:
         return log_exception('unable to query %s' % (entity), e)
-    return response, 200
+    response = [to_item(item) for item in items]
+    if start_key is not None:
+        headers[CURSOR_HEADER] = encode_cursor(start_key)
+    return response, 200, headers
 
 
 def write(entity, vals, return_vals=None):
@@ -144,9 +332,8 @@ def write(entity, vals, return_vals=None):
     vals.pop(hk_attr, None)
     vals.pop('id', None)
     try:
-        table = get_table(entity)
         vals.update(key)
-        table.put_item(Item=vals)
+        get_store().put_item(entity, vals)
         if isinstance(return_vals, list):
             vals = {k: vals[k] for k in return_vals}
         return vals, 201
@@ -159,7 +346,7 @@ def delete(entity, vals):
     (hk, rk) = (vals.get(hk_attr), vals.get('id'))
     key = get_key(hk, rk)
     try:
-        get_table(entity).delete_item(Key=key)
+        get_store().delete_item(entity, key)
     except Exception as e:
         return log_exception('unable to delete %s' % entity, e)
     return {
@@ -167,84 +354,371 @@ def delete(entity, vals):
     }, 204
 
 
-def get_definitions(tenantId):
+def get_definitions(tenantId, limit=None, cursor=None, fields=None,
+                    format=None):
     print('get_definitions(%s)' % tenantId)
-    return query('sedo_definition', tenantId, attributes=['tenantId', 'id'])
+    return query(
+        'sedo_definition',
+        tenantId,
+        attributes=fields or ['tenantId', 'id'],
+        limit=limit,
+        cursor=cursor,
+        format=format
+    )
 
 
 def create_definition(tenantId, createDefinitionRequest):
     print('create_definition(%s)' % tenantId)
+    # the step graph is checked now rather than when it is first executed
+    try:
+        compile_definition(createDefinitionRequest)
+    except InvalidDefinition as e:
+        return problem('invalid definition', detail=str(e))
     createDefinitionRequest['tenantId'] = tenantId
+    try:
+        createDefinitionRequest['version'] = write_definition_version(
+            createDefinitionRequest
+        )
+    except Exception as e:
+        return log_exception('unable to create definition version', e)
+    invalidate_definition(tenantId, createDefinitionRequest.get('id'))
     return write(
         'sedo_definition',
         createDefinitionRequest,
-        return_vals=['tenantId', 'id']
+        return_vals=['tenantId', 'id', 'version']
     )
 
 
+def read_definition(tenantId, id):
+    definition = get_cached_definition(tenantId, id)
+    if definition is not None:
+        return definition, 200
+    definition, code = query('sedo_definition', tenantId, id)
+    if code == 200:
+        cache_definition(definition)
+    return definition, code
+
+
 def get_definition(tenantId, id):
     print('get_definition(%s, %s)' % (tenantId, id))
-    return query('sedo_definition', tenantId, id)
+    definition, code = read_definition(tenantId, id)
+    if code != 200:
+        return definition, code
+    etag = get_etag(definition)
+    if is_not_modified(etag):
+        return not_modified(etag)
+    return definition, 200, {'ETag': etag}
 
 
-def execute_definition(tenantId, id, createExecutionRequest):
-    print('execute_definition(%s, %s)' % (tenantId, id))
-    # get definition ID
-    definition, code = get_definition(tenantId, id)
+def get_versioned_definition(tenantId, id):
+    definition, code = read_definition(tenantId, id)
     if code != 200:
         return (definition, code)
+
+    # definitions created before versioning get their version now
+    if definition.get('version') is None:
+        try:
+            definition['version'] = write_definition_version(definition)
+        except Exception as e:
+            return log_exception('unable to create definition version', e)
+        cache_definition(definition)
+    return definition, 200
+
+
+def validate_input(definition, input):
+    validate(
+        input,
+        definition['inputSchema'],
+        '%s:inputSchema' % definition['version']
+    )
+
+
+def new_execution(tenantId, definition, input, now):
+    # a large input is stored once and referenced by the execution and its
+    # events
+    input = claimcheck.offload(input, tenantId)
     response = {
         'tenantId': tenantId,
         'id': '%s:%s:%s' % (
             tenantId,
-            id,
-            str(uuid4()).split('-')[0]
+            definition['id'],
+            str(uuid4())
         ),
         'state': 'ExecutionSubmitted'
     }
+
+    # execution references rather than copies the definition
+    execution_data = {
+        'input': codec.encode(input),
+        'definitionId': definition['id'],
+        'definitionHash': definition['version'],
+        'revision': 0,
+        'activeState': response['state'],
+        'createdAt': now,
+        'updatedAt': now
+    }
+    execution_data.update(response)
+
+    # event carries enough state for the processor to skip reading the
+    # execution
     event = {
-        'input': createExecutionRequest['input']
+        'input': input,
+        'definitionHash': definition['version'],
+        'revision': 0
     }
     event.update(response)
+    return response, event, execution_data
+
+
+def create_execution(execution_data):
+    # an existing execution is never overwritten
+    get_store().put_item(
+        'sedo_execution', execution_data, condition=Attr('id').not_exists()
+    )
+
+
+def get_create_problem(e):
+    if isinstance(e, ConditionFailed):
+        return problem('execution already exists', status=409)
+    return log_exception('unable to create execution', e)
+
+
+def remove_executions(tenantId, ids):
+    # best effort, the executions are reported as failed either way
+    if len(ids) == 0:
+        return
+    try:
+        get_store().batch_delete(
+            'sedo_execution', [get_key(tenantId, id) for id in ids]
+        )
+    except Exception as e:
+        log_exception('unable to remove executions', e)
+
+
+def execute_definition(tenantId, id, createExecutionRequest):
+    print('execute_definition(%s, %s)' % (tenantId, id))
+    # get definition ID
+    definition, code = get_versioned_definition(tenantId, id)
+    if code != 200:
+        return (definition, code)
 
     # validate input
     try:
-        validate(event['input'], definition['inputSchema'])
+        validate_input(definition, createExecutionRequest['input'])
     except Exception as e:
         return problem(
             'input does not pass inputSchema validation', detail=str(e)
         )
 
     # write to table
-    execution_data = event.copy()
-    execution_data.update({'definition': definition})
-    r, code = write('sedo_execution', execution_data)
-    if code != 201:
-        return r, code
-
-    # dispatch event to queue
-    client = get_client('sqs')
-    queue_url = client.get_queue_url(
-        QueueName='sedo_execution-processor-queue'
-    )['QueueUrl']
-    kwargs = {
-        'QueueUrl': queue_url,
-        'MessageBody': json.dumps(event)
-    }
-    client.send_message(**kwargs)
+    (response, event, execution_data) = new_execution(
+        tenantId,
+        definition,
+        createExecutionRequest['input'],
+        datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    )
+    try:
+        create_execution(execution_data)
+    except Exception as e:
+        return get_create_problem(e)
+
+    # dispatch event to queue, an execution that can't be dispatched is
+    # removed rather than left to never run
+    try:
+        get_queue().send_message(
+            scheduling.get_queue_name(tenantId),
+            {'MessageBody': codec.encode_body(event)}
+        )
+    except Exception as e:
+        remove_executions(tenantId, [response['id']])
+        return log_exception('unable to dispatch execution', e)
 
     return response, 201
 
 
-def get_executions(tenantId):
+def execute_definition_batch(tenantId, id, createExecutionBatchRequest):
+    print('execute_definition_batch(%s, %s)' % (tenantId, id))
+    # the definition is read and its inputSchema compiled once for every
+    # input, each input gets its own result
+    definition, code = get_versioned_definition(tenantId, id)
+    if code != 200:
+        return (definition, code)
+
+    now = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+    results = []
+    executions = []
+    for i, input in enumerate(createExecutionBatchRequest['inputs']):
+        try:
+            validate_input(definition, input)
+        except Exception as e:
+            results.append(problem(
+                'input does not pass inputSchema validation', detail=str(e)
+            )[0])
+            continue
+        (response, event, execution_data) = new_execution(
+            tenantId, definition, input, now
+        )
+        results.append(response)
+        executions.append((i, event, execution_data))
+
+    # write to table in batches, executions still unprocessed after
+    # retrying are reported as failed. a write that fails part way may have
+    # written any of them, so they are removed
+    try:
+        unprocessed = get_store().batch_write(
+            'sedo_execution', [e[2] for e in executions]
+        )
+    except Exception as e:
+        log_exception('unable to create executions', e)
+        unprocessed = [e[2] for e in executions]
+        remove_executions(tenantId, [item['id'] for item in unprocessed])
+    unprocessed = set([item['id'] for item in unprocessed])
+    entries = []
+    for (i, event, execution_data) in executions:
+        if execution_data['id'] in unprocessed:
+            results[i] = problem(
+                'unable to create execution',
+                detail={'id': execution_data['id']},
+                status=500
+            )[0]
+        else:
+            entries.append(
+                {'Id': str(i), 'MessageBody': codec.encode_body(event)}
+            )
+
+    # dispatch events to queue, executions whose events can't be sent are
+    # removed rather than left to never run
+    try:
+        failed = get_queue().send_message_batch(
+            scheduling.get_queue_name(tenantId), entries
+        )
+    except Exception as e:
+        log_exception('unable to dispatch executions', e)
+        failed = entries
+    for entry in failed:
+        i = int(entry['Id'])
+        results[i] = problem(
+            'unable to dispatch execution',
+            detail={'id': results[i]['id']},
+            status=500
+        )[0]
+    remove_executions(tenantId, [
+        results[int(entry['Id'])]['detail']['id'] for entry in failed
+    ])
+
+    return {
+        'results': results
+    }, 200
+
+
+def get_executions(tenantId, limit=None, cursor=None, fields=None,
+                   format=None, state=None, definitionId=None, since=None):
     print('get_executions(%s)' % (tenantId))
+    # the first filter with an index is used as its key condition, any
+    # others are applied as filter expressions. sub-executions, which have
+    # a parent, are not listed
+    (index, key_condition, filters) = (None, None, [
+        Attr('parent').not_exists()
+    ])
+    if state == 'active' or state in ACTIVE_STATES:
+        index = 'active-index'
+        if state != 'active':
+            key_condition = Key('activeState').eq(state)
+    elif state is not None:
+        filters.append(Attr('state').eq(state))
+    for (attribute, value, _index, condition) in [
+        ('definitionId', definitionId, 'definition-index', 'eq'),
+        ('updatedAt', since, 'updated-index', 'gte')
+    ]:
+        if value is None:
+            continue
+        if index is None:
+            index = _index
+            key_condition = getattr(Key(attribute), condition)(value)
+        else:
+            filters.append(getattr(Attr(attribute), condition)(value))
+    filter_expression = None
+    for f in filters:
+        filter_expression = f if filter_expression is None else (
+            filter_expression & f
+        )
+
+    attributes = fields or ['tenantId', 'id', 'state', 'step']
+    if index is not None and not set(attributes).issubset(
+        EXECUTION_INDEX_ATTRIBUTES
+    ):
+        return problem(
+            'fields not available when filtering',
+            detail='fields must be in %s' % ', '.join(
+                EXECUTION_INDEX_ATTRIBUTES
+            )
+        )
     return query(
         'sedo_execution',
         tenantId,
-        attributes=['tenantId', 'id', 'state', 'step']
+        attributes=attributes,
+        limit=limit,
+        cursor=cursor,
+        format=format,
+        index=index,
+        key_condition=key_condition,
+        filter_expression=filter_expression
     )
 
 
-def get_execution(tenantId, id):
+def wait_for_execution(tenantId, id, timeout):
+    # returns once the execution is terminal, missing or the timeout is up
+    deadline = time.time() + timeout
+    interval = WAIT_MIN_INTERVAL
+    while True:
+        item = get_store().get_item(
+            'sedo_execution', get_key(tenantId, id), attributes=['state']
+        )
+        if item is None or item.get('state') in TERMINAL_STATES:
+            return
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, WAIT_MAX_INTERVAL)
+
+
+def get_execution(tenantId, id, waitFor=None, timeout=None):
     print('get_execution(%s, %s)' % (tenantId, id))
-    return query('sedo_execution', tenantId, id)
+    if waitFor == 'terminal':
+        try:
+            wait_for_execution(
+                tenantId, id, WAIT_TIMEOUT if timeout is None else timeout
+            )
+        except Exception as e:
+            return log_exception('unable to wait for execution', e)
+    execution, code = query('sedo_execution', tenantId, id)
+    if code != 200:
+        return execution, code
+    # references to large payloads carry their hash, so the ETag is of the
+    # execution before they are loaded
+    etag = get_etag(execution)
+    if is_not_modified(etag):
+        return not_modified(etag)
+    try:
+        for field in ['input', 'output']:
+            if field in execution:
+                execution[field] = claimcheck.load(execution[field])
+    except Exception as e:
+        return log_exception('unable to load execution payload', e)
+    return execution, 200, {'ETag': etag}
+
+
+def get_execution_history(tenantId, id, limit=None, cursor=None,
+                          format=None):
+    print('get_execution_history(%s, %s)' % (tenantId, id))
+    # history is keyed by execution, in sequence order
+    return query(
+        'sedo_execution_history',
+        id,
+        limit=limit,
+        cursor=cursor,
+        format=format,
+        filter_expression=Attr('tenantId').eq(tenantId),
+        hash_key='executionId'
+    )
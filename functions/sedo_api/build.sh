@@ -1,2 +1,3 @@
 #!/bin/bash
-pip install -r requirements.txt -t .
\ No newline at end of file
+pip install -r requirements.txt -t .
+python build_spec.py
\ No newline at end of file
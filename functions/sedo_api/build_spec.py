@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# converts api.yaml into api.json, which index.py loads at cold start as
+# json.loads is much cheaper than yaml.safe_load on the full spec
+import json
+import os
+import sys
+import yaml
+
+DIR = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(DIR, 'api.yaml')
+TARGET = os.path.join(DIR, 'api.json')
+
+
+def load_spec(path=SOURCE):
+    with open(path, 'r') as f:
+        return yaml.safe_load(f)
+
+
+def build_spec(source=SOURCE, target=TARGET):
+    with open(target, 'w') as f:
+        json.dump(load_spec(source), f, indent=1, sort_keys=True)
+        f.write('\n')
+    return target
+
+
+if __name__ == "__main__":
+    print('wrote %s' % build_spec(*sys.argv[1:3]))
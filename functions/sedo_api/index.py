@@ -16,19 +16,37 @@ import awsgi
 import connexion
 from flask_cors import CORS
 import json
+import os
 from traceback import print_exc
 
+SPEC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'api.json')
+
+
+def create_app(spec=SPEC):
+    # the prebuilt JSON spec (see build_spec.py) avoids parsing YAML
+    with open(spec, 'r') as f:
+        api = json.load(f)
+    app = connexion.FlaskApp(__name__, options={'swagger_ui': False})
+    app.add_api(api)
+    CORS(app.app, expose_headers=['X-Next-Cursor', 'ETag'])
+    return app
+
+
+# build the app during the init phase, which is not billed against the
+# first request; if that fails the handler retries and reports the error
 global APP
-APP = None
+try:
+    APP = create_app()
+except Exception:
+    print_exc()
+    APP = None
 
 
 def handler(event, context):
     global APP
     try:
         if APP is None:
-            APP = connexion.FlaskApp(__name__, options={'swagger_ui': False})
-            APP.add_api('api.yaml')
-            CORS(APP.app)
+            APP = create_app()
         return awsgi.response(APP, event, context)
     except Exception as e:
         print_exc()
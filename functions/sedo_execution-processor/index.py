@@ -14,15 +14,19 @@
 #
 import argparse
 import json
-import yaml
 
 from processor import sqs_handler
+from processor import timer_handler
 
 
 def handler(event, context):
     return sqs_handler(event, context)
 
 
+def tick_handler(event, context):
+    return timer_handler(event, context)
+
+
 if __name__ == "__main__":
     ap = argparse.ArgumentParser(
         description='Serveless Event Driven Orchestrator'
@@ -37,6 +41,7 @@ if __name__ == "__main__":
     ap.add_argument('--step', help='current step')
     ap.add_argument('--wait', help='wait timestamp')
     args = ap.parse_args()
+    import yaml
     event = {
         'state': args.state,
         'definition': yaml.safe_load(open(args.definition, 'r').read())
@@ -48,6 +53,7 @@ if __name__ == "__main__":
 
     response = handler({
         'Records': [{
+            'messageId': 'local',
             'body': json.dumps(event)
         }]
     }, None)
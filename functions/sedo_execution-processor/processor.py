@@ -13,55 +13,206 @@
 # limitations under the License.
 #
 from boto3.dynamodb.types import Decimal
-from boto3.session import Session
+from boto3.dynamodb.conditions import Attr
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
-import dateutil
+from datetime import timezone
+import hashlib
 import json
-from jsonschema import validate
 import os
+from sedo_common.backends import ConditionFailed
+from sedo_common import claimcheck
+from sedo_common import codec
+from sedo_common.batch import message_chunks
+from sedo_common.backends import get_queue
+from sedo_common.backends import get_store
+from sedo_common.definitions import compile_definition
+from sedo_common.definitions import InvalidDefinition
+from sedo_common import scheduling
+from sedo_common import telemetry
+from sedo_common.telemetry import get_metrics
+from sedo_common.validation import get_schema_hash
+from sedo_common.validation import validate
+import threading
+from timers import fire_timers
+from timers import schedule_timer
+import time
 import traceback
-import yaml
-
-
-EVENT_SCHEMA = yaml.safe_load('''
-type: object
-properties:
-  tenantId:
-    type: string
-    pattern: '^[a-z0-9-]+$'
-  id:
-    type: string
-    pattern: '^[a-z0-9:-]+$'
-  state:
-    type: string
-    enum:
-      - ExecutionSubmitted
-      - ExecutionStarted
-      - StepStarted
-      - StepFailed
-      - StepSucceeded
-      - ExecutionSucceeded
-      - ExecutionFailed
-  input:
-    type: object
-  step:
-    type: string
-    pattern: '^[a-z-]+$'
-  wait_timestamp:
-    type: string
-  stash:
-    type: object
-required:
-  - tenantId
-  - id
-  - state
-additionalProperties: false
-''')
+
+
+# precomputed rather than parsed from YAML at import, to keep cold starts
+# short
+EVENT_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'tenantId': {
+            'type': 'string',
+            'pattern': '^[a-z0-9-]+$'
+        },
+        'id': {
+            'type': 'string',
+            'pattern': '^[a-z0-9:-]+$'
+        },
+        'state': {
+            'type': 'string',
+            'enum': [
+                'ExecutionSubmitted',
+                'ExecutionStarted',
+                'StepStarted',
+                'StepFailed',
+                'StepSucceeded',
+                'ExecutionSucceeded',
+                'ExecutionFailed'
+            ]
+        },
+        'input': {
+            'type': 'object'
+        },
+        'step': {
+            'type': 'string',
+            'pattern': '^[a-z-]+$'
+        },
+        'wait_timestamp': {
+            'type': 'string'
+        },
+        'stash': {
+            'type': 'object'
+        },
+        'revision': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'seq': {
+            'type': 'integer',
+            'minimum': 0
+        },
+        'definitionHash': {
+            'type': 'string'
+        },
+        'branch': {
+            'type': 'string'
+        },
+        'parent': {
+            'type': 'object',
+            'properties': {
+                'id': {
+                    'type': 'string'
+                },
+                'revision': {
+                    'type': 'integer'
+                },
+                'seq': {
+                    'type': 'integer'
+                },
+                'count': {
+                    'type': 'integer'
+                },
+                'items': {
+                    'type': 'integer'
+                }
+            },
+            'required': ['id', 'revision', 'seq', 'count']
+        },
+        'joined': {
+            'type': 'boolean'
+        },
+        'items': {
+            'type': 'integer',
+            'minimum': 0
+        }
+    },
+    'required': [
+        'tenantId',
+        'id',
+        'state'
+    ],
+    'additionalProperties': False
+}
+
+EVENT_SCHEMA_HASH = get_schema_hash(EVENT_SCHEMA)
+
+# events are dispatched to the queue shard of their tenant
+QUEUE_NAME = scheduling.QUEUE_NAME
+
+# events dispatched by the processor are marked with this message attribute
+# and, when enabled, are not validated again. only the sedo lambdas are
+# allowed to send to the queue
+SOURCE_ATTRIBUTE = 'sedoSource'
+REPLAY_ATTRIBUTE = 'sedoReplay'
+TRUST_INTERNAL_EVENTS = os.environ.get(
+    'SEDO_TRUST_INTERNAL_EVENTS', 'false'
+).lower() == 'true'
+
+# waits longer than the maximum SQS delay are scheduled as timers
+MAX_DELAY_SECONDS = 900
+
+# event fields offloaded to the blob store when too large
+CLAIM_CHECK_FIELDS = ['input', 'stash']
+# execution attributes stored with the codec, when SEDO_CODEC is set
+CODEC_FIELDS = ['input', 'output', 'definition']
+
+TERMINAL_STATES = ['ExecutionSucceeded', 'ExecutionFailed']
+
+EXECUTION_ATTRIBUTES = [
+    'tenantId', 'id', 'state', 'step', 'input', 'output', 'definitionId',
+    'definitionHash', 'revision', 'seq', 'branch', 'parent'
+]
+
+# returned by a transition that waits for sub-executions, which dispatch
+# the event that moves the execution on
+SUSPENDED = object()
+
+# map steps run their steps over chunks of items, a chunk per sub-execution
+MAP_CHUNK_SIZE = int(os.environ.get('SEDO_MAP_CHUNK_SIZE', 100))
+MAP_MAX_CONCURRENCY = int(os.environ.get('SEDO_MAP_MAX_CONCURRENCY', 10))
+# the inputs of sub-executions started as others finish are offloaded
+# concurrently when the step starts, by a pool of their own as the worker
+# pool may be busy processing the step
+OFFLOAD_WORKERS = int(os.environ.get('SEDO_OFFLOAD_WORKERS', 32))
+OFFLOAD_POOL = None
+OFFLOAD_POOL_LOCK = threading.Lock()
+
+# every transition is recorded in the history table, keyed by execution ID
+# and sequence number, rather than appended to the execution item
+HISTORY_TABLE = 'sedo_execution_history'
+HISTORY_ENABLED = os.environ.get('SEDO_HISTORY', 'true').lower() == 'true'
+
+# compiled definitions keyed by definition version (content hash), kept
+# across invocations of a warm container. versions are immutable so cached
+# definitions never need invalidating
+DEFINITION_CACHE_SIZE = int(os.environ.get('SEDO_DEFINITION_CACHE_SIZE', 128))
+DEFINITION_CACHE = OrderedDict()
+DEFINITION_CACHE_LOCK = threading.Lock()
+
+# events already processed in this container, by execution and revision,
+# so duplicate deliveries are dropped before the execution is read. the
+# conditional write still drops duplicates processed elsewhere
+DEDUPE_TTL = int(os.environ.get('SEDO_DEDUPE_TTL', 300))
+DEDUPE_CACHE_SIZE = int(os.environ.get('SEDO_DEDUPE_CACHE_SIZE', 10000))
+DEDUPE_CACHE = OrderedDict()
+DEDUPE_CACHE_LOCK = threading.Lock()
+
+# executions within a batch are processed concurrently, records of the
+# same execution are processed in order
+MAX_WORKERS = int(os.environ.get('SEDO_MAX_WORKERS', 4))
+# the pool, and the thread local AWS resources of its threads, are kept
+# across invocations of a warm container
+POOL = None
+POOL_LOCK = threading.Lock()
+
+
+class StaleEvent(Exception):
+    pass
+
+
+class InvalidInput(Exception):
+    pass
 
 
 def add_utc_tz(x):
-    return x.replace(tzinfo=dateutil.tz.gettz("UTC"))
+    return x.replace(tzinfo=timezone.utc)
 
 
 def now_dt():
@@ -72,16 +223,11 @@ def timestamp(dt):
     return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
 
 
-def get_session():
-    return Session(region_name=os.environ.get('AWS_REGION', 'us-east-1'))
-
-
-def get_table(name):
-    return get_session().resource('dynamodb').Table(name)
-
-
-def get_client(name):
-    return get_session().client(name)
+def parse_timestamp(x):
+    dt = datetime.fromisoformat(x.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        return add_utc_tz(dt)
+    return dt
 
 
 def get_key(tenantId, id):
@@ -104,84 +250,418 @@ def json_serial(obj):
     raise TypeError('type not serializable')
 
 
-def get_exception_object(e):
-    return {
-        'exception': str(e),
-        'stackTrace': traceback.format_tb(e.__traceback__)
-    }
-
-
 def log_exception(title, e):
-    exception_object = get_exception_object(e)
-    print('EXCEPTION: %s: %s' % (title, exception_object))
+    telemetry.error(
+        title, exception=telemetry.describe(e),
+        stackTrace=traceback.format_tb(e.__traceback__)
+    )
     raise Exception(e)
 
 
-def get_execution(tenant_id, id):
-    r = get_table('sedo_execution').get_item(Key=get_key(tenant_id, id))
-    if 'Item' not in r:
+def get_definition_hash(definition):
+    return hashlib.sha256(json.dumps(
+        definition, sort_keys=True, separators=(',', ':'), default=json_serial
+    ).encode('utf-8')).hexdigest()
+
+
+def get_branch_definition(definition, branch=None):
+    if branch is None:
+        return definition
+    # chunk indexes of map steps are keyed as *
+    (key, parts) = (None, branch.split('/'))
+    for i in range(0, len(parts) - 1, 2):
+        prefix = '' if key is None else key + '/'
+        key = prefix + '/'.join(parts[i:i + 2])
+        if key not in definition['branches']:
+            key = prefix + parts[i] + '/*'
+    if key not in definition['branches']:
+        raise Exception('branch %s not found' % branch)
+    return definition['branches'][key]
+
+
+def get_items(event, sd):
+    # the items of a map step, from its itemsPath in the input
+    items = claimcheck.load(event.get('input', {}))
+    for k in sd['itemsPath'].split('.'):
+        items = items.get(k) if isinstance(items, dict) else None
+    if not isinstance(items, list):
+        raise InvalidInput('step %s itemsPath %s is not an array' % (
+            sd['id'], sd['itemsPath']
+        ))
+    return items
+
+
+def get_child_inputs(event, sd):
+    # the inputs of the sub-executions of a parallel step, or of a map step
+    # whose items are split into chunks once when it starts
+    if sd['type'] != 'map':
+        return [event.get('input', {})] * len(sd['branches'])
+    items = get_items(event, sd)
+    size = sd.get('chunkSize', MAP_CHUNK_SIZE)
+    return [{'items': items[i:i + size]} for i in range(0, len(items), size)]
+
+
+def get_max_concurrency(sd, count):
+    if sd['type'] == 'map':
+        return sd.get('maxConcurrency', MAP_MAX_CONCURRENCY)
+    return sd.get('maxConcurrency', count)
+
+
+def get_compiled_definition(definition, definition_hash=None):
+    if definition_hash is None:
+        if definition is None:
+            return None
+        definition_hash = get_definition_hash(definition)
+    with DEFINITION_CACHE_LOCK:
+        compiled = DEFINITION_CACHE.get(definition_hash)
+        if compiled is not None:
+            DEFINITION_CACHE.move_to_end(definition_hash)
+            return compiled
+    if definition is None:
+        return None
+    compiled = compile_definition(definition)
+    compiled['hash'] = definition_hash
+    with DEFINITION_CACHE_LOCK:
+        DEFINITION_CACHE[definition_hash] = compiled
+        while len(DEFINITION_CACHE) > DEFINITION_CACHE_SIZE:
+            DEFINITION_CACHE.popitem(last=False)
+    return compiled
+
+
+def get_item(table_name, tenant_id, id, attributes=None):
+    with get_metrics().time('ReadTime', 'StoreCalls'):
+        return get_store().get_item(
+            table_name, get_key(tenant_id, id), attributes
+        )
+
+
+def get_execution(tenant_id, id, attributes=None):
+    execution = get_item('sedo_execution', tenant_id, id, attributes)
+    if execution is None:
         raise Exception('execution not found')
-    return json.loads(json.dumps(r['Item'], default=json_serial))
+    return codec.decode_fields(execution, CODEC_FIELDS)
+
+
+def get_definition_version(tenant_id, version):
+    item = get_item('sedo_definition_version', tenant_id, version)
+    if item is None:
+        return None
+    return codec.decode(item['definition'])
 
 
-def update_execution(execution, vals):
+def get_execution_definition(execution):
+    # the definition version is only read and parsed on a cache miss
+    version = execution.get('definitionHash')
+    definition = get_compiled_definition(execution.get('definition'), version)
+    if definition is None and version is not None:
+        definition = get_compiled_definition(
+            get_definition_version(execution['tenantId'], version), version
+        )
+    if definition is None:
+        # executions created before definition versions embed the definition
+        r = get_execution(
+            execution['tenantId'], execution['id'], attributes=['definition']
+        )
+        definition = get_compiled_definition(
+            r.get('definition'), execution.get('definitionHash')
+        )
+        # later transitions of the same event find it in the cache
+        if definition is not None:
+            execution['definitionHash'] = definition['hash']
+    if definition is None:
+        raise Exception('execution definition not found')
+    return definition
+
+
+def update_execution(execution, vals, revision=None, remove=None):
+    # when revision is given the update only succeeds if the execution
+    # exists and is still at that revision, and the revision is incremented
     title = 'unable to update execution'
-    key = get_key(execution['tenantId'], execution['id'])
+    condition = None
+    if revision is not None:
+        vals = dict(vals, revision=revision + 1)
+        condition = Attr('revision').eq(revision)
+        if revision == 0:
+            condition |= Attr('revision').not_exists()
+        condition = Attr('id').exists() & condition
+    vals = {k: None if v == '' else v for k, v in vals.items()}
     try:
-        table = get_table('sedo_execution')
-        kwargs = {
-            'Key': key,
-            'ReturnValues': 'ALL_NEW'
-        }
-        exp = []
-        _vals = {}
-        aliases = {}
-        for k, v in vals.items():
-            if isinstance(v, str) and v == '':
-                v = None
-            aliases['#%s' % k] = k
-            if isinstance(v, list):
-                exp.append('#%s = list_append(#%s, :%s)' % (k, k, k))
-                _vals[':%s' % k] = v
-            else:
-                exp.append('#%s = :%s' % (k, k))
-                _vals[':%s' % k] = v
-        if len(_vals):
-            kwargs['ExpressionAttributeValues'] = _vals
-            kwargs['UpdateExpression'] = 'SET %s' % ', '.join(exp)
-        if len(aliases):
-            kwargs['ExpressionAttributeNames'] = aliases
-            table.update_item(**kwargs)
+        with get_metrics().time('WriteTime', 'StoreCalls'):
+            get_store().update_item(
+                'sedo_execution',
+                get_key(execution['tenantId'], execution['id']),
+                vals,
+                remove=remove,
+                condition=condition
+            )
+    except ConditionFailed:
+        # an execution removed, or never written, is not created by the
+        # update
+        if get_item(
+            'sedo_execution', execution['tenantId'], execution['id'], ['id']
+        ) is None:
+            raise Exception('execution not found')
+        raise StaleEvent('execution %s is not at revision %s' % (
+            execution['id'], revision
+        ))
     except Exception as e:
         log_exception(title, e)
 
 
-def dispatch_event(event, wait_seconds=None):
-    print('dispatch_event() %s, wait_seconds=%s' % (event, wait_seconds))
-    client = get_session().client('sqs')
-    queue_url = client.get_queue_url(
-        QueueName='sedo_execution-processor-queue'
-    )['QueueUrl']
-    kwargs = {
-        'QueueUrl': queue_url,
-        'MessageBody': json.dumps(event)
+def get_history_item(event):
+    item = {
+        'executionId': event['id'],
+        'seq': event['seq'],
+        'tenantId': event['tenantId'],
+        'state': event['state'],
+        'revision': event['revision'] + 1,
+        'createdAt': timestamp(now_dt())
+    }
+    if 'step' in event:
+        item['step'] = event['step']
+    return item
+
+
+def write_history(items):
+    # returns the items that could not be written
+    if len(items) == 0:
+        return []
+    with get_metrics().time('HistoryTime', 'StoreCalls'):
+        unprocessed = get_store().batch_write(HISTORY_TABLE, items)
+    get_metrics().add('HistoryItems', len(items) - len(unprocessed))
+    return unprocessed
+
+
+def get_offload_pool():
+    global OFFLOAD_POOL
+    with OFFLOAD_POOL_LOCK:
+        if OFFLOAD_POOL is None:
+            OFFLOAD_POOL = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS)
+        return OFFLOAD_POOL
+
+
+def offload_inputs(inputs, tenant_id):
+    # references to each of inputs, put in the blob store concurrently
+    metrics = get_metrics()
+    with metrics.time('OffloadTime'):
+        refs = list(get_offload_pool().map(
+            lambda input: claimcheck.offload(input, tenant_id, threshold=0),
+            inputs
+        ))
+    metrics.add('OffloadedInputs', len(refs))
+    return refs
+
+
+def get_branch_event(event, definition_hash, sd, index, input):
+    # the first event of a sub-execution running a branch or chunk of the
+    # step sd, whose ID is derived from its parent so it is only ever
+    # created once
+    branch = '%s/%s' % (sd['id'], index)
+    if 'branch' in event:
+        branch = '%s/%s' % (event['branch'], branch)
+    return {
+        'tenantId': event['tenantId'],
+        'id': '%s:%s:%s' % (event['id'], sd['id'], index),
+        'state': 'ExecutionSubmitted',
+        'input': input,
+        'definitionHash': definition_hash,
+        'branch': branch,
+        'revision': 0,
+        'seq': 0
+    }
+
+
+def start_execution(event, outbox=None):
+    # writes a sub-execution and dispatches its first event. one that
+    # already exists is dispatched again, its dispatch may have failed, and
+    # the duplicate is dropped as stale
+    now = timestamp(now_dt())
+    event['input'] = claimcheck.offload(event['input'], event['tenantId'])
+    item = {
+        k: event[k] for k in [
+            'tenantId', 'id', 'state', 'definitionHash', 'branch', 'parent',
+            'revision', 'seq'
+        ]
+    }
+    item.update({
+        'input': codec.encode(event['input']),
+        'createdAt': now,
+        'updatedAt': now
+    })
+    try:
+        with get_metrics().time('WriteTime', 'StoreCalls'):
+            get_store().put_item(
+                'sedo_execution', item, condition=Attr('id').not_exists()
+            )
+        get_metrics().add('SubExecutions', 1)
+    except ConditionFailed:
+        pass
+    dispatch_event(event, outbox=outbox)
+
+
+def join_parent(event, execution, outbox=None):
+    # counts a finished sub-execution on its parent with an atomic add to a
+    # set, conditional on the parent still waiting at the revision that
+    # started it. a branch starts the branch maxConcurrency after it, and
+    # the branch that completes the set dispatches the event moving the
+    # parent on. redeliveries add nothing and their duplicate events are
+    # dropped as stale
+    parent = event['parent']
+    (branch, step, index) = ([None] + event['branch'].rsplit('/', 2))[-3:]
+    (index, count) = (int(index), parent['count'])
+    sd = get_branch_definition(
+        get_execution_definition(execution), branch
+    )['steps'][step]
+    try:
+        with get_metrics().time('WriteTime', 'StoreCalls'):
+            joined = get_store().update_item(
+                'sedo_execution',
+                get_key(event['tenantId'], parent['id']),
+                {},
+                add={'joined': set([index])},
+                condition=Attr('revision').eq(parent['revision'])
+            )['joined']
+    except ConditionFailed:
+        telemetry.info('parent has moved on', parentId=parent['id'])
+        return
+    get_metrics().add('Joins', 1)
+
+    # the inputs of the sub-executions started as others finish were
+    # offloaded when the step started, so only the next one is loaded
+    max_concurrency = get_max_concurrency(sd, count)
+    if index + max_concurrency < count:
+        r = get_execution(
+            event['tenantId'], parent['id'],
+            attributes=['branch', 'childInputs']
+        )
+        r.update({'tenantId': event['tenantId'], 'id': parent['id']})
+        input = claimcheck.load(claimcheck.load(r['childInputs'])[index])
+        start_execution(dict(get_branch_event(
+            r, execution['definitionHash'], sd, index + max_concurrency,
+            input
+        ), parent=parent), outbox)
+    if len(joined) == count:
+        joined_event = {
+            'tenantId': event['tenantId'],
+            'id': parent['id'],
+            'state': 'StepStarted',
+            'step': step,
+            'revision': parent['revision'],
+            'seq': parent['seq'],
+            'joined': True
+        }
+        if 'items' in parent:
+            joined_event['items'] = int(parent['items'])
+        dispatch_event(joined_event, outbox=outbox)
+
+
+def get_message(event, wait_seconds=None):
+    # returns the queue message for an event, or None when the wait is too
+    # long for a message delay and a timer is scheduled instead
+    body = json.dumps(event)
+    # large payloads travel as claim checks, loaded by the steps using them
+    if len(body) > claimcheck.THRESHOLD:
+        claimcheck.offload_fields(
+            event, CLAIM_CHECK_FIELDS, event['tenantId']
+        )
+        body = json.dumps(event)
+    body = codec.encode_body(event, body)
+    message = {
+        'MessageBody': body,
+        'MessageAttributes': {
+            SOURCE_ATTRIBUTE: {
+                'DataType': 'String',
+                'StringValue': 'processor'
+            }
+        }
     }
     if wait_seconds is not None:
-        if wait_seconds < 0:
-            wait_seconds = 0
-        elif wait_seconds > 300:
-            wait_seconds = 300
-        kwargs['DelaySeconds'] = wait_seconds
-    client.send_message(**kwargs)
+        if wait_seconds > MAX_DELAY_SECONDS:
+            schedule_timer(event, time.time() + wait_seconds)
+            return None
+        message['DelaySeconds'] = max(int(wait_seconds), 0)
+    return message
 
 
-def process_event(event):
-    validate(event, EVENT_SCHEMA)
-    wait_seconds = None
-    print('process_event(): %s' % event)
+def dispatch_event(event, wait_seconds=None, outbox=None):
+    # (queue name, message) pairs are appended to outbox when given, to be
+    # sent in batches by flush_events, otherwise they are sent straight away
+    metrics = get_metrics()
+    with metrics.time('DispatchTime'):
+        telemetry.debug(
+            'dispatching event', state=event.get('state'),
+            step=event.get('step'),
+            waitSeconds=wait_seconds, event=telemetry.payload(event)
+        )
+        message = get_message(event, wait_seconds)
+        if message is None:
+            return
+        metrics.add('DispatchBytes', len(message['MessageBody']), 'Bytes')
+        queue_name = scheduling.get_queue_name(event.get('tenantId'))
+        if outbox is not None:
+            outbox.append((queue_name, message))
+        else:
+            metrics.add('QueueCalls', 1)
+            get_queue().send_message(queue_name, message)
 
-    # get execution to check its valid/exists
-    execution = get_execution(event['tenantId'], event['id'])
+
+def flush_events(outbox):
+    # returns the indexes of outbox messages that could not be sent
+    if len(outbox) == 0:
+        return []
+    queues = OrderedDict()
+    for i, (queue_name, message) in enumerate(outbox):
+        queues.setdefault(queue_name, []).append(dict(message, Id=str(i)))
+    metrics = get_metrics()
+    failed = []
+    with metrics.time('FlushTime'):
+        for queue_name, entries in queues.items():
+            # a queue that cannot be sent to fails only its own messages
+            try:
+                failed.extend(
+                    get_queue().send_message_batch(queue_name, entries)
+                )
+            except Exception:
+                failed.extend(entries)
+            metrics.add('QueueCalls', len(list(message_chunks(entries))))
+    metrics.add('Messages', len(outbox))
+    metrics.add('DispatchFailures', len(failed))
+    for message in failed:
+        telemetry.error(
+            'unable to dispatch event',
+            event=telemetry.payload(message['MessageBody'])
+        )
+    return [int(message['Id']) for message in failed]
+
+
+def dispatch_events(events):
+    # dispatches (event, wait_seconds) pairs in batches, returning the
+    # indexes of the events that could not be sent
+    outbox = []
+    indexes = []
+    for i, (event, wait_seconds) in enumerate(events):
+        dispatch_event(event, wait_seconds, outbox)
+        indexes.extend([i] * (len(outbox) - len(indexes)))
+    return [indexes[i] for i in flush_events(outbox)]
+
+
+def get_chain_budget(context):
+    # steps are chained in-process until a wait, a terminal state or the
+    # budget is used up, keeping a reserve of the remaining lambda time
+    max_steps = int(os.environ.get('SEDO_MAX_CHAIN_STEPS', 25))
+    deadline = None
+    if hasattr(context, 'get_remaining_time_in_millis'):
+        reserve_ms = int(os.environ.get('SEDO_CHAIN_RESERVE_MS', 5000))
+        deadline = time.time() + (
+            context.get_remaining_time_in_millis() - reserve_ms
+        ) / 1000.0
+    return max_steps, deadline
+
+
+def transition(event, execution, execution_update, children=None):
+    # the first events of sub-executions to start once the transition is
+    # written are appended to children
+    wait_seconds = None
     output = None
 
     if event['state'] == 'ExecutionSubmitted':
@@ -191,24 +671,21 @@ def process_event(event):
         'ExecutionStarted', 'StepStarted', 'StepSucceeded'
     ]:
         event['state'] = 'StepStarted'
-        if execution['state'] != event['state']:
-            update_execution(execution, {'state': event['state']})
 
         # get first step if not defined otherwise current step
-        current_step = event.get('step')
-        sd = None
-        for _sd in execution['definition']['steps']:
-            sd = _sd
-            if current_step is None:
-                current_step = _sd['id']
-                break
-            elif current_step == _sd['id']:
-                break
+        definition = get_branch_definition(
+            get_execution_definition(execution), execution.get('branch')
+        )
+        current_step = event.get('step', definition['first'])
+        sd = definition['steps'].get(current_step)
+        if sd is None:
+            raise Exception('step %s not found' % current_step)
+        event['step'] = current_step
 
         # echo step
         if sd['type'] == 'echo':
-            print('STEP %s ECHO: %s' % (
-                current_step, sd.get('message', 'some message'))
+            telemetry.info(
+                sd.get('message', 'some message'), step=current_step
             )
             event['state'] = 'StepSucceeded'
 
@@ -223,18 +700,57 @@ def process_event(event):
                 )
             else:
                 # remaining wait seconds
-                wait_dt = add_utc_tz(
-                    dateutil.parser.parse(event['wait_timestamp'])
-                )
+                wait_dt = parse_timestamp(event['wait_timestamp'])
                 wait_seconds = int((wait_dt - now_dt()).total_seconds())
             if wait_seconds <= 0:
                 wait_seconds = None
                 event.pop('wait_timestamp', None)
                 event['state'] = 'StepSucceeded'
             if 'wait_timestamp' in event:
-                print('STEP %s WAIT: %s seconds until %s' % (
-                    current_step, wait_seconds, event['wait_timestamp']
-                ))
+                telemetry.debug(
+                    'waiting', step=current_step, waitSeconds=wait_seconds,
+                    until=event['wait_timestamp']
+                )
+
+        # parallel step, each branch runs as a sub-execution, and map step,
+        # each chunk of items runs as a sub-execution, at most
+        # maxConcurrency at a time
+        elif sd['type'] in ['parallel', 'map']:
+            if event.pop('joined', False):
+                event['state'] = 'StepSucceeded'
+                # chunk results are kept by their sub-executions, the join
+                # carries the count of items
+                if sd['type'] == 'map':
+                    count = event.pop('items', None)
+                    if count is None:
+                        count = len(get_items(event, sd))
+                    size = sd.get('chunkSize', MAP_CHUNK_SIZE)
+                    output = {'count': count, 'chunks': -(-count // size)}
+            else:
+                inputs = get_child_inputs(event, sd)
+                count = len(inputs)
+                parent = {'count': count}
+                if sd['type'] == 'map':
+                    parent['items'] = sum(len(i['items']) for i in inputs)
+                if count == 0:
+                    event['state'] = 'StepSucceeded'
+                    output = {'count': 0, 'chunks': 0}
+                else:
+                    wait_seconds = SUSPENDED
+                    max_concurrency = get_max_concurrency(sd, count)
+                    for i in range(min(max_concurrency, count)):
+                        children.append(dict(get_branch_event(
+                            event, execution['definitionHash'], sd, i,
+                            inputs[i]
+                        ), parent=dict(parent)))
+                    # the inputs of the rest are offloaded once, so each
+                    # join loads only the input of the one it starts
+                    if max_concurrency < count:
+                        execution_update['childInputs'] = claimcheck.offload(
+                            offload_inputs(
+                                inputs[max_concurrency:], event['tenantId']
+                            ), event['tenantId']
+                        )
 
         if event['state'] == 'StepSucceeded':
             if sd.get('end') is True:
@@ -242,29 +758,451 @@ def process_event(event):
             elif 'next' in sd:
                 event['step'] = sd['next']
 
-    execution_update = {'state': event['state']}
+    execution_update['state'] = event['state']
     if 'step' in event:
         execution_update['step'] = event['step']
     if output is not None:
+        output = claimcheck.offload(output, event['tenantId'])
         event['input'] = output
-        execution_update['output'] = output
-    update_execution(execution, execution_update)
+        execution_update['output'] = codec.encode(output)
+    return wait_seconds
+
+
+def fail_execution(event, execution_update, title, metric, e):
+    telemetry.error(title, exception=telemetry.describe(e))
+    get_metrics().add(metric, 1)
+    event['state'] = 'ExecutionFailed'
+    execution_update['state'] = event['state']
+    execution_update['error'] = '%s: %s' % (title, e)
+    return None
+
+
+def is_trusted(record):
+    attribute = record.get('messageAttributes', {}).get(SOURCE_ATTRIBUTE)
+    return TRUST_INTERNAL_EVENTS and attribute is not None and (
+        attribute.get('stringValue') == 'processor'
+    )
+
+
+def is_replay(record):
+    # redelivered records, and records deferred after a redelivery, replay
+    # the dispatch of events already written
+    receive_count = int(record.get('attributes', {}).get(
+        'ApproximateReceiveCount', 1
+    ))
+    return receive_count > 1 or (
+        REPLAY_ATTRIBUTE in record.get('messageAttributes', {})
+    )
+
+
+def get_message_id(record):
+    # records deferred after a redelivery carry the ID of the message
+    attribute = record.get('messageAttributes', {}).get(REPLAY_ATTRIBUTE)
+    if attribute is not None:
+        return attribute['stringValue']
+    return record.get('messageId')
+
+
+def is_writer(execution, revision, message_id=None):
+    # whether the execution is at revision, written by the message when
+    # known, so a duplicate of a redelivered message does not replay
+    r = get_execution(
+        execution['tenantId'], execution['id'],
+        attributes=['revision', 'messageId']
+    )
+    if int(r.get('revision', 0)) != revision:
+        return False
+    return None in [message_id, r.get('messageId')] or (
+        r['messageId'] == message_id
+    )
+
+
+def get_dedupe_key(event):
+    return (event['tenantId'], event['id'], int(event['revision']))
+
+
+def is_duplicate(event, now=None):
+    if DEDUPE_TTL <= 0 or 'revision' not in event:
+        return False
+    if now is None:
+        now = time.time()
+    key = get_dedupe_key(event)
+    with DEDUPE_CACHE_LOCK:
+        expires = DEDUPE_CACHE.get(key)
+        if expires is None:
+            return False
+        if expires <= now:
+            del DEDUPE_CACHE[key]
+            return False
+        return True
+
+
+def set_processed(event, now=None):
+    # records that the event's transitions from its revision were written
+    if DEDUPE_TTL <= 0:
+        return
+    if now is None:
+        now = time.time()
+    key = get_dedupe_key(event)
+    with DEDUPE_CACHE_LOCK:
+        DEDUPE_CACHE[key] = now + DEDUPE_TTL
+        DEDUPE_CACHE.move_to_end(key)
+        while len(DEDUPE_CACHE) > DEDUPE_CACHE_SIZE:
+            DEDUPE_CACHE.popitem(last=False)
+
+
+def process_event(event, context=None, max_steps=None, trusted=False,
+                  outbox=None, replay=False, history=None, message_id=None):
+    # history items are appended to history when given, to be written in
+    # batches by the caller, otherwise they are written before returning.
+    # message_id is written with the transitions, identifying the message a
+    # redelivery may replay
+    metrics = get_metrics()
+    if not trusted:
+        with metrics.time('ValidateTime'):
+            validate(event, EVENT_SCHEMA, EVENT_SCHEMA_HASH)
+    if not replay and is_duplicate(event):
+        metrics.add('Duplicates', 1)
+        raise StaleEvent('execution %s revision %s already processed' % (
+            event['id'], event['revision']
+        ))
+    telemetry.debug(
+        'processing event', state=event['state'], step=event.get('step'),
+        event=telemetry.payload(event)
+    )
+
+    # events dispatched by the processor carry enough state to skip reading
+    # the execution, the conditional write still checks it is valid/current
+    if 'revision' in event and 'definitionHash' in event:
+        execution = {
+            'tenantId': event['tenantId'],
+            'id': event['id'],
+            'definitionHash': event['definitionHash']
+        }
+        if 'branch' in event:
+            execution['branch'] = event['branch']
+    else:
+        execution = get_execution(
+            event['tenantId'], event['id'], attributes=EXECUTION_ATTRIBUTES
+        )
+        # the sequence number is only known with the revision it is of
+        if 'revision' not in event:
+            event['revision'] = int(execution.get('revision', 0))
+            event['seq'] = int(execution.get('seq', 0))
+        elif not replay and (
+            int(execution.get('revision', 0)) != event['revision']
+        ):
+            # dropped before its transitions are run again
+            raise StaleEvent('execution %s is not at revision %s' % (
+                event['id'], event['revision']
+            ))
+        if 'definitionHash' in execution:
+            event['definitionHash'] = execution['definitionHash']
+        for k in ['input', 'branch', 'parent']:
+            if k in execution:
+                event.setdefault(k, execution[k])
+    event.setdefault('seq', 0)
+    (state, step) = (event['state'], event.get('step'))
+    joined = event.get('joined', False)
+
+    (_max_steps, deadline) = get_chain_budget(context)
+    if max_steps is None:
+        max_steps = _max_steps
+    steps = 0
+    execution_update = {}
+    (items, children) = ([], [])
+    while True:
+        _state = (event['state'], event.get('step'))
+        try:
+            with metrics.time('TransitionTime'):
+                wait_seconds = transition(
+                    event, execution, execution_update, children
+                )
+        except InvalidDefinition as e:
+            # redelivering the event can't fix the definition
+            wait_seconds = fail_execution(
+                event, execution_update, 'invalid definition',
+                'InvalidDefinitions', e
+            )
+        except InvalidInput as e:
+            # nor can it fix the input
+            wait_seconds = fail_execution(
+                event, execution_update, 'invalid input', 'InvalidInputs', e
+            )
+        steps += 1
+        if (event['state'], event.get('step')) != _state:
+            event['seq'] += 1
+            items.append(get_history_item(event))
+        if event['state'] in TERMINAL_STATES or wait_seconds is not None:
+            break
+        if steps >= max_steps:
+            break
+        if deadline is not None and time.time() >= deadline:
+            break
+
+    # a wait re-poll that changed nothing is not written
+    if (event['state'], event.get('step')) != (state, step):
+        # activeState is only set while the execution is running, keeping
+        # the active executions index sparse. sub-executions never set it,
+        # they are listed by their parent rather than as executions
+        execution_update['updatedAt'] = timestamp(now_dt())
+        execution_update['seq'] = event['seq']
+        if message_id is not None:
+            execution_update['messageId'] = message_id
+        remove = []
+        if event['state'] in TERMINAL_STATES:
+            remove.append('activeState')
+        elif 'parent' not in event:
+            execution_update['activeState'] = event['state']
+        # the count of finished sub-executions starts again
+        if len(children):
+            remove.append('joined')
+        # as are the inputs of those still to start once they are joined
+        if joined and 'childInputs' not in execution_update:
+            remove.append('childInputs')
+        try:
+            update_execution(
+                execution, execution_update, event['revision'],
+                remove=remove or None
+            )
+        except StaleEvent:
+            # a redelivered event whose transition was written but whose
+            # dispatch failed is replayed without writing
+            if not replay or not is_writer(
+                execution, event['revision'] + 1, message_id
+            ):
+                raise
+            telemetry.info('replaying dispatch')
+            metrics.add('Replays', 1)
+        set_processed(event)
+        event['revision'] += 1
+        # only written once the transitions are, a replay writes the same
+        # items again
+        if HISTORY_ENABLED:
+            if history is None:
+                if len(write_history(items)):
+                    raise Exception('unable to write history')
+            else:
+                history.extend(items)
+    metrics.add('Transitions', steps)
+    metrics.properties.update({
+        'state': event['state'],
+        'step': event.get('step'),
+        'revision': event['revision']
+    })
 
-    if event['state'] not in ['ExecutionSucceeded', 'ExecutionFailed']:
-        dispatch_event(event, wait_seconds=wait_seconds)
+    # sub-executions are started, or joined, once the transitions are
+    # written, a replay starts or joins them again
+    for child in children:
+        child['parent'].update({
+            'id': event['id'],
+            'revision': event['revision'],
+            'seq': event['seq']
+        })
+        start_execution(child, outbox)
+    if event['state'] in TERMINAL_STATES and 'parent' in event:
+        join_parent(event, execution, outbox)
+
+    if event['state'] not in TERMINAL_STATES and wait_seconds is not SUSPENDED:
+        dispatch_event(event, wait_seconds=wait_seconds, outbox=outbox)
     return event
 
 
+def get_queue_lag(record):
+    # milliseconds since the message was sent, including any delay
+    sent = record.get('attributes', {}).get('SentTimestamp')
+    if sent is None:
+        return None
+    return max(0, time.time() * 1000 - int(sent))
+
+
+def process_record(record, event, context=None, outbox=None, history=None):
+    # processes a record, collecting the metrics of its transitions
+    with telemetry.record(
+        messageId=record.get('messageId'),
+        tenantId=(event or {}).get('tenantId'),
+        executionId=(event or {}).get('id')
+    ) as metrics:
+        with metrics.time('ProcessTime'):
+            lag = get_queue_lag(record)
+            if lag is not None:
+                metrics.add('QueueLag', lag, 'Milliseconds')
+            metrics.add('PayloadBytes', len(record.get('body') or ''), 'Bytes')
+            try:
+                if event is None:
+                    raise Exception('invalid message body')
+                process_event(
+                    event,
+                    context,
+                    trusted=is_trusted(record),
+                    outbox=outbox,
+                    replay=is_replay(record),
+                    history=history,
+                    message_id=get_message_id(record)
+                )
+            except StaleEvent as e:
+                # another event has already moved the execution on
+                metrics.add('StaleEvents', 1)
+                telemetry.info('dropping stale event', reason=str(e))
+            except Exception as e:
+                metrics.add('Errors', 1)
+                telemetry.error(
+                    'exception processing event',
+                    exception=telemetry.describe(e),
+                    event=telemetry.payload(record.get('body'))
+                )
+                raise
+
+
+def process_records(records, context=None):
+    # returns message IDs of the failed record and every record after it,
+    # so later events of the same execution are redelivered in order, the
+    # outbox of (message ID, message) to dispatch and the history of
+    # (message ID, item) to write
+    (outbox, history) = ([], [])
+    for i, (record, event) in enumerate(records):
+        (messages, items) = ([], [])
+        try:
+            process_record(record, event, context, messages, items)
+        except Exception:
+            return [r['messageId'] for r, _ in records[i:]], outbox, history
+        outbox.extend([(record['messageId'], m) for m in messages])
+        history.extend([(record['messageId'], item) for item in items])
+    return [], outbox, history
+
+
+def flush_history(history):
+    # returns message IDs of the records whose history was not written
+    try:
+        unprocessed = write_history([item for (_, item) in history])
+    except Exception as e:
+        telemetry.error(
+            'unable to write history', exception=telemetry.describe(e)
+        )
+        return list(set([id for (id, _) in history]))
+    unprocessed = set([
+        (item['executionId'], int(item['seq'])) for item in unprocessed
+    ])
+    get_metrics().add('HistoryFailures', len(unprocessed))
+    return list(set([
+        id for (id, item) in history
+        if (item['executionId'], item['seq']) in unprocessed
+    ]))
+
+
+def get_deferred_message(record, event, delay):
+    # the record sent again to its tenant's queue, delayed until the tenant
+    # has quota
+    attributes = {
+        k: {'DataType': v['dataType'], 'StringValue': v['stringValue']}
+        for k, v in record.get('messageAttributes', {}).items()
+    }
+    if is_replay(record):
+        attributes[REPLAY_ATTRIBUTE] = {
+            'DataType': 'String',
+            'StringValue': get_message_id(record)
+        }
+    message = {
+        'MessageBody': record['body'],
+        'DelaySeconds': min(delay, MAX_DELAY_SECONDS)
+    }
+    if len(attributes):
+        message['MessageAttributes'] = attributes
+    return scheduling.get_queue_name(event['tenantId']), message
+
+
+def schedule(groups, now=None):
+    # admits the records of each tenant up to its quota, returning the
+    # admitted groups and the outbox of (message ID, message) deferring the
+    # rest. the records of an execution after a deferred one are deferred
+    # with it, keeping them in order
+    counts = OrderedDict()
+    for key, records in groups.items():
+        if isinstance(key, tuple):
+            counts[key[0]] = counts.get(key[0], 0) + len(records)
+    quotas = {
+        tenant_id: list(scheduling.admit(tenant_id, count, now))
+        for tenant_id, count in counts.items()
+    }
+    (admitted, deferred) = (OrderedDict(), [])
+    for key, records in groups.items():
+        if not isinstance(key, tuple):
+            admitted[key] = records
+            continue
+        quota = quotas[key[0]]
+        if quota[0] > 0:
+            admitted[key] = records[:quota[0]]
+        deferred.extend([
+            (record['messageId'], get_deferred_message(
+                record, event, quota[1]
+            )) for (record, event) in records[quota[0]:]
+        ])
+        quota[0] = max(quota[0] - len(records), 0)
+    return admitted, deferred
+
+
+def get_pool():
+    global POOL
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        return POOL
+
+
 def sqs_handler(event, context):
-    records = event['Records']
-    responses = []
-    for record in records:
-        msg = None
-        event = json.loads(record['body'])
+    # group records by execution
+    groups = OrderedDict()
+    for record in event['Records']:
         try:
-            msg = process_event(event)
-        except Exception as e:
-            msg = 'exception processing event %s: %s' % (event, e)
-        print(msg)
-        responses.append(msg)
-    return responses
+            _event = codec.decode_body(record['body'])
+            key = (_event['tenantId'], _event['id'])
+        except Exception:
+            _event = None
+            key = record['messageId']
+        groups.setdefault(key, []).append((record, _event))
+
+    # records of tenants over their quota are sent again, delayed
+    with telemetry.record():
+        (groups, deferred) = schedule(groups)
+
+    results = []
+    if len(groups) == 1 or MAX_WORKERS <= 1:
+        for records in groups.values():
+            results.append(process_records(records, context))
+    else:
+        results = list(get_pool().map(
+            lambda records: process_records(records, context),
+            groups.values()
+        ))
+
+    # history is written and dispatched events are sent in batches, records
+    # whose history could not be written or events could not be sent are
+    # redelivered and replay them
+    (failures, outbox, history) = ([], deferred, [])
+    for (_failures, _outbox, _history) in results:
+        failures.extend(_failures)
+        outbox.extend(_outbox)
+        history.extend(_history)
+    with telemetry.record() as metrics:
+        metrics.add('Records', len(event['Records']))
+        for id in flush_history(history):
+            if id not in failures:
+                failures.append(id)
+        outbox = [(id, m) for (id, m) in outbox if id not in failures]
+        for i in flush_events([m for (_, m) in outbox]):
+            if outbox[i][0] not in failures:
+                failures.append(outbox[i][0])
+        metrics.add('Failures', len(failures))
+    return {
+        'batchItemFailures': [{'itemIdentifier': id} for id in failures]
+    }
+
+
+def timer_handler(event, context):
+    with telemetry.record() as metrics:
+        fired = fire_timers(dispatch_events)
+        metrics.add('TimersFired', fired)
+    telemetry.info('fired timers', fired=fired)
+    return {
+        'fired': fired
+    }
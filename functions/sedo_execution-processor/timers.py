@@ -0,0 +1,93 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from boto3.dynamodb.conditions import Key
+import json
+import os
+from sedo_common.backends import get_store
+from sedo_common import telemetry
+from sedo_common.telemetry import get_metrics
+import time
+
+# timers are stored in a table partitioned by the minute they are due, so
+# each tick only reads the buckets that have become due since the last one
+TIMER_TABLE = 'sedo_timer'
+BUCKET_FORMAT = '%Y-%m-%dT%H:%M'
+CURSOR_KEY = {'bucket': 'cursor', 'id': 'cursor'}
+LOOKBACK_MINUTES = int(os.environ.get('SEDO_TIMER_LOOKBACK_MINUTES', 15))
+MAX_BUCKETS = int(os.environ.get('SEDO_TIMER_MAX_BUCKETS', 60))
+
+
+def get_bucket(seconds):
+    return time.strftime(BUCKET_FORMAT, time.gmtime(seconds))
+
+
+def get_timer_id(event):
+    return '%s/%s/%s' % (event['tenantId'], event['id'], event.get('step'))
+
+
+def schedule_timer(event, due):
+    telemetry.debug('scheduling timer', timer=get_timer_id(event), due=due)
+    with get_metrics().time('TimerTime', 'StoreCalls'):
+        get_store().put_item(TIMER_TABLE, {
+            'bucket': get_bucket(due),
+            'id': get_timer_id(event),
+            'due': int(due),
+            'event': json.dumps(event)
+        })
+
+
+def fire_timers(dispatch, now=None):
+    # dispatches events of timers due up to the end of the current minute,
+    # those due later in the minute are dispatched with a delay. dispatch
+    # takes a list of (event, wait_seconds) and returns the indexes of
+    # those not sent, whose timers are kept for the next tick
+    if now is None:
+        now = time.time()
+    now = int(now)
+    store = get_store()
+    current = now - now % 60
+    cursor = store.get_item(TIMER_TABLE, CURSOR_KEY)
+    if cursor is not None:
+        minute = int(cursor['due'])
+    else:
+        minute = current - LOOKBACK_MINUTES * 60
+    end = min(current, minute + (MAX_BUCKETS - 1) * 60)
+
+    fired = 0
+    while minute <= end:
+        bucket = get_bucket(minute)
+        start_key = None
+        while True:
+            (items, start_key) = store.query(
+                TIMER_TABLE, Key('bucket').eq(bucket), start_key=start_key
+            )
+            failed = dispatch([
+                (json.loads(item['event']), max(0, int(item['due']) - now))
+                for item in items
+            ])
+            keys = [
+                {'bucket': bucket, 'id': item['id']}
+                for i, item in enumerate(items) if i not in failed
+            ]
+            store.batch_delete(TIMER_TABLE, keys)
+            fired += len(keys)
+            # the cursor is not moved on, so failed timers fire next tick
+            if len(failed):
+                raise Exception('unable to dispatch %s timers' % len(failed))
+            if start_key is None:
+                break
+        minute += 60
+
+    store.put_item(TIMER_TABLE, dict(CURSOR_KEY, due=minute))
+    return fired
@@ -0,0 +1,105 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from boto3.session import Session
+from botocore.config import Config
+import os
+import threading
+
+# sessions, clients, resources and queue URLs are created once per
+# container and reused by every invocation so HTTP connections are kept
+# alive between events. clients are thread safe and shared, resources are
+# not so are kept per thread.
+LOCK = threading.Lock()
+POOL = {
+    'session': None,
+    'clients': {},
+    'queue_urls': {},
+    'generation': 0
+}
+LOCAL = threading.local()
+
+
+def get_region():
+    return os.environ.get('AWS_REGION', 'us-east-1')
+
+
+def get_config():
+    return Config(
+        max_pool_connections=int(
+            os.environ.get('SEDO_MAX_POOL_CONNECTIONS', 25)
+        ),
+        retries={'mode': 'standard'}
+    )
+
+
+def get_session():
+    if POOL['session'] is None:
+        with LOCK:
+            if POOL['session'] is None:
+                POOL['session'] = Session(region_name=get_region())
+    return POOL['session']
+
+
+def get_client(name):
+    client = POOL['clients'].get(name)
+    if client is None:
+        session = get_session()
+        with LOCK:
+            client = POOL['clients'].get(name)
+            if client is None:
+                client = session.client(name, config=get_config())
+                POOL['clients'][name] = client
+    return client
+
+
+def get_local():
+    if getattr(LOCAL, 'generation', None) != POOL['generation']:
+        LOCAL.generation = POOL['generation']
+        LOCAL.resources = {}
+        LOCAL.tables = {}
+    return LOCAL
+
+
+def get_resource(name):
+    local = get_local()
+    if name not in local.resources:
+        session = get_session()
+        with LOCK:
+            local.resources[name] = session.resource(
+                name, config=get_config()
+            )
+    return local.resources[name]
+
+
+def get_table(name):
+    local = get_local()
+    if name not in local.tables:
+        local.tables[name] = get_resource('dynamodb').Table(name)
+    return local.tables[name]
+
+
+def get_queue_url(name):
+    queue_url = POOL['queue_urls'].get(name)
+    if queue_url is None:
+        queue_url = get_client('sqs').get_queue_url(QueueName=name)['QueueUrl']
+        POOL['queue_urls'][name] = queue_url
+    return queue_url
+
+
+def reset():
+    with LOCK:
+        POOL['session'] = None
+        POOL['clients'].clear()
+        POOL['queue_urls'].clear()
+        POOL['generation'] += 1
@@ -0,0 +1,97 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# storage and queue backends. the execution processor and API read and
+# write items through a Store, send events through a Queue and keep large
+# payloads in a BlobStore, selected by SEDO_BACKEND, so the same logic runs
+# against DynamoDB, SQS and S3 (aws), in process (memory) or on local files
+# (sqlite)
+import importlib
+import os
+from sedo_common.backends.base import ConditionFailed  # noqa: F401
+import threading
+
+BACKENDS = {
+    'aws': {
+        'module': 'sedo_common.backends.aws',
+        'store': 'DynamoDBStore',
+        'queue': 'SQSQueue',
+        'blobs': 'S3BlobStore'
+    },
+    'memory': {
+        'module': 'sedo_common.backends.memory',
+        'store': 'MemoryStore',
+        'queue': 'MemoryQueue',
+        'blobs': 'MemoryBlobStore'
+    },
+    'sqlite': {
+        'module': 'sedo_common.backends.sqlite',
+        'store': 'SqliteStore',
+        'queue': 'SqliteQueue',
+        'blobs': 'FileBlobStore'
+    }
+}
+
+LOCK = threading.Lock()
+INSTANCES = {
+    'store': None,
+    'queue': None,
+    'blobs': None
+}
+
+
+def get_backend_name():
+    return os.environ.get('SEDO_BACKEND', 'aws')
+
+
+def create(kind, name=None):
+    if name is None:
+        name = get_backend_name()
+    if name not in BACKENDS:
+        raise Exception('unknown backend %s' % name)
+    backend = BACKENDS[name]
+    return getattr(importlib.import_module(backend['module']), backend[kind])()
+
+
+def get_instance(kind):
+    instance = INSTANCES[kind]
+    if instance is None:
+        with LOCK:
+            instance = INSTANCES[kind]
+            if instance is None:
+                instance = INSTANCES[kind] = create(kind)
+    return instance
+
+
+def get_store():
+    return get_instance('store')
+
+
+def get_queue():
+    return get_instance('queue')
+
+
+def get_blobs():
+    return get_instance('blobs')
+
+
+def set_backend(store=None, queue=None, blobs=None):
+    # installs backend instances, eg for tests and local benchmarks
+    with LOCK:
+        INSTANCES['store'] = store
+        INSTANCES['queue'] = queue
+        INSTANCES['blobs'] = blobs
+
+
+def reset():
+    set_backend()
@@ -0,0 +1,211 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from botocore.exceptions import ClientError
+from sedo_common.aws import get_client
+from sedo_common.aws import get_queue_url
+from sedo_common.aws import get_table
+from sedo_common.backends.base import BlobStore
+from sedo_common.backends.base import ConditionFailed
+from sedo_common.backends.base import Queue
+from sedo_common.backends.base import Store
+from sedo_common.backends.base import to_native
+from sedo_common.batch import batch_write
+from sedo_common.batch import chunks
+from sedo_common.batch import MESSAGE_BATCH_SIZE
+from sedo_common.batch import send_message_batch
+import os
+
+BLOB_BUCKET = os.environ.get('SEDO_BLOB_BUCKET', 'sedo-blobs')
+
+
+def get_projection(attributes):
+    if not isinstance(attributes, list):
+        return {}
+    return {
+        'ProjectionExpression': ', '.join(['#%s' % a for a in attributes]),
+        'ExpressionAttributeNames': {'#%s' % a: a for a in attributes}
+    }
+
+
+def is_condition_failure(e):
+    return e.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class DynamoDBStore(Store):
+
+    def get_item(self, table, key, attributes=None):
+        r = get_table(table).get_item(Key=key, **get_projection(attributes))
+        if 'Item' not in r:
+            return None
+        return to_native(r['Item'])
+
+    def put_item(self, table, item, condition=None):
+        kwargs = {'Item': item}
+        if condition is not None:
+            kwargs['ConditionExpression'] = condition
+        try:
+            get_table(table).put_item(**kwargs)
+        except ClientError as e:
+            if is_condition_failure(e):
+                raise ConditionFailed(str(e))
+            raise
+
+    def update_item(self, table, key, values, remove=None, condition=None,
+                    add=None):
+        kwargs = {
+            'Key': key
+        }
+        if condition is not None:
+            kwargs['ConditionExpression'] = condition
+        aliases = {}
+        clauses = []
+        if len(values):
+            aliases.update({'#%s' % k: k for k in values})
+            kwargs['ExpressionAttributeValues'] = {
+                ':%s' % k: v for k, v in values.items()
+            }
+            clauses.append('SET %s' % ', '.join([
+                '#%s = :%s' % (k, k) for k in values
+            ]))
+        if isinstance(remove, list) and len(remove):
+            aliases.update({'#%s' % k: k for k in remove})
+            clauses.append('REMOVE %s' % ', '.join([
+                '#%s' % k for k in remove
+            ]))
+        if add:
+            aliases.update({'#%s' % k: k for k in add})
+            kwargs.setdefault('ExpressionAttributeValues', {}).update({
+                ':add_%s' % k: v for k, v in add.items()
+            })
+            clauses.append('ADD %s' % ', '.join([
+                '#%s :add_%s' % (k, k) for k in add
+            ]))
+            kwargs['ReturnValues'] = 'UPDATED_NEW'
+        if len(clauses) == 0:
+            return {}
+        kwargs['UpdateExpression'] = ' '.join(clauses)
+        kwargs['ExpressionAttributeNames'] = aliases
+        try:
+            r = get_table(table).update_item(**kwargs)
+        except ClientError as e:
+            if is_condition_failure(e):
+                raise ConditionFailed(str(e))
+            raise
+        attributes = r.get('Attributes', {})
+        return to_native({
+            k: attributes[k] for k in add or {} if k in attributes
+        })
+
+    def delete_item(self, table, key):
+        get_table(table).delete_item(Key=key)
+
+    def batch_write(self, table, items):
+        return batch_write(table, items)
+
+    def batch_delete(self, table, keys):
+        with get_table(table).batch_writer() as batch:
+            for key in keys:
+                batch.delete_item(Key=key)
+
+    def query(self, table, key_condition, index=None, filter=None,
+              attributes=None, limit=None, start_key=None):
+        kwargs = {
+            'KeyConditionExpression': key_condition
+        }
+        if index is not None:
+            kwargs['IndexName'] = index
+        if filter is not None:
+            kwargs['FilterExpression'] = filter
+        if isinstance(attributes, list):
+            kwargs.update(get_projection(attributes))
+            kwargs['Select'] = 'SPECIFIC_ATTRIBUTES'
+        if limit is not None:
+            kwargs['Limit'] = limit
+        if start_key is not None:
+            kwargs['ExclusiveStartKey'] = start_key
+        r = get_table(table).query(**kwargs)
+        last_key = r.get('LastEvaluatedKey')
+        return (
+            [to_native(item) for item in r['Items']],
+            None if last_key is None else to_native(last_key)
+        )
+
+
+class S3BlobStore(BlobStore):
+
+    def __init__(self, bucket=None):
+        self.bucket = bucket or BLOB_BUCKET
+
+    def put(self, key, data):
+        get_client('s3').put_object(Bucket=self.bucket, Key=key, Body=data)
+
+    def get(self, key):
+        try:
+            r = get_client('s3').get_object(Bucket=self.bucket, Key=key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                raise KeyError(key)
+            raise
+        return r['Body'].read()
+
+
+class SQSQueue(Queue):
+
+    def send_message(self, queue, message):
+        return get_client('sqs').send_message(
+            QueueUrl=get_queue_url(queue), **message
+        )['MessageId']
+
+    def send_message_batch(self, queue, entries):
+        return send_message_batch(queue, entries)
+
+    def receive_messages(self, queue, max_messages=10):
+        r = get_client('sqs').receive_message(
+            QueueUrl=get_queue_url(queue),
+            MaxNumberOfMessages=min(max_messages, MESSAGE_BATCH_SIZE),
+            AttributeNames=['All'],
+            MessageAttributeNames=['All']
+        )
+        return [{
+            'messageId': m['MessageId'],
+            'receiptHandle': m['ReceiptHandle'],
+            'body': m['Body'],
+            'attributes': m.get('Attributes', {}),
+            'messageAttributes': {
+                k: {'stringValue': v['StringValue'], 'dataType': v['DataType']}
+                for k, v in m.get('MessageAttributes', {}).items()
+            },
+            'eventSource': 'aws:sqs'
+        } for m in r.get('Messages', [])]
+
+    def delete_messages(self, queue, records):
+        for chunk in chunks(records, MESSAGE_BATCH_SIZE):
+            get_client('sqs').delete_message_batch(
+                QueueUrl=get_queue_url(queue),
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': r['receiptHandle']}
+                    for i, r in enumerate(chunk)
+                ]
+            )
+
+    def get_size(self, queue):
+        attributes = get_client('sqs').get_queue_attributes(
+            QueueUrl=get_queue_url(queue),
+            AttributeNames=[
+                'ApproximateNumberOfMessages',
+                'ApproximateNumberOfMessagesNotVisible',
+                'ApproximateNumberOfMessagesDelayed'
+            ]
+        )['Attributes']
+        return sum([int(v) for v in attributes.values()])
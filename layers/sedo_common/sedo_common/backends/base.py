@@ -0,0 +1,338 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from contextlib import contextmanager
+from boto3.dynamodb.types import Binary
+from decimal import Decimal
+import threading
+
+# key schemas of the tables and their indexes, used by the backends that
+# emulate DynamoDB. index keys are listed before the table keys they are
+# ordered by
+TABLES = {
+    'sedo_definition': {
+        'keys': ['tenantId', 'id']
+    },
+    'sedo_definition_version': {
+        'keys': ['tenantId', 'id']
+    },
+    'sedo_execution': {
+        'keys': ['tenantId', 'id'],
+        'indexes': {
+            'active-index': ['tenantId', 'activeState'],
+            'definition-index': ['tenantId', 'definitionId'],
+            'updated-index': ['tenantId', 'updatedAt']
+        }
+    },
+    'sedo_execution_history': {
+        'keys': ['executionId', 'seq']
+    },
+    'sedo_tenant_usage': {
+        'keys': ['tenantId', 'window']
+    },
+    'sedo_timer': {
+        'keys': ['bucket', 'id']
+    }
+}
+
+MISSING = object()
+
+
+class ConditionFailed(Exception):
+    pass
+
+
+def to_native(obj):
+    # DynamoDB numbers, sets and binaries as JSON types and bytes
+    if isinstance(obj, dict):
+        return {k: to_native(v) for k, v in obj.items()}
+    if isinstance(obj, set):
+        return sorted([to_native(v) for v in obj])
+    if isinstance(obj, (list, tuple)):
+        return [to_native(v) for v in obj]
+    if isinstance(obj, Decimal):
+        return int(obj) if obj % 1 == 0 else float(obj)
+    if isinstance(obj, Binary):
+        return obj.value
+    return obj
+
+
+def copy_item(item):
+    # to_native returns new containers, values left are immutable
+    return to_native(item)
+
+
+def project(item, attributes=None):
+    if not isinstance(attributes, list):
+        return item
+    return {k: item[k] for k in attributes if k in item}
+
+
+def evaluate(condition, item):
+    # evaluates a boto3 Key or Attr condition against an item
+    exp = condition.get_expression()
+    (op, values) = (exp['operator'], exp['values'])
+    if op == 'AND':
+        return all([evaluate(c, item) for c in values])
+    if op == 'OR':
+        return any([evaluate(c, item) for c in values])
+    if op == 'NOT':
+        return not evaluate(values[0], item)
+    value = item.get(values[0].name, MISSING)
+    if op == 'attribute_exists':
+        return value is not MISSING
+    if op == 'attribute_not_exists':
+        return value is MISSING
+    if value is MISSING:
+        return False
+    try:
+        if op == '=':
+            return value == values[1]
+        if op == '<>':
+            return value != values[1]
+        if op == '<':
+            return value < values[1]
+        if op == '<=':
+            return value <= values[1]
+        if op == '>':
+            return value > values[1]
+        if op == '>=':
+            return value >= values[1]
+        if op == 'BETWEEN':
+            return values[1] <= value <= values[2]
+        if op == 'IN':
+            return value in values[1]
+        if op == 'begins_with':
+            return value.startswith(values[1])
+        if op == 'contains':
+            return values[1] in value
+    except (AttributeError, TypeError):
+        return False
+    raise Exception('unsupported condition %s' % op)
+
+
+def get_key_value(condition, name):
+    # the value a key condition requires name to equal, if any
+    exp = condition.get_expression()
+    if exp['operator'] == 'AND':
+        for c in exp['values']:
+            value = get_key_value(c, name)
+            if value is not None:
+                return value
+    elif exp['operator'] == '=' and exp['values'][0].name == name:
+        return exp['values'][1]
+    return None
+
+
+class Store(object):
+    # reads and writes items of the tables in TABLES. items are JSON types,
+    # keys are dicts of the table key attributes and conditions are boto3
+    # Key/Attr conditions. a failed condition raises ConditionFailed
+
+    def get_item(self, table, key, attributes=None):
+        raise NotImplementedError()
+
+    def put_item(self, table, item, condition=None):
+        raise NotImplementedError()
+
+    def update_item(self, table, key, values, remove=None, condition=None,
+                    add=None):
+        # add atomically adds numbers, or set elements given as sets, and
+        # returns the updated values of the added attributes
+        raise NotImplementedError()
+
+    def delete_item(self, table, key):
+        raise NotImplementedError()
+
+    def batch_write(self, table, items):
+        # returns the items that could not be written
+        raise NotImplementedError()
+
+    def batch_delete(self, table, keys):
+        raise NotImplementedError()
+
+    def query(self, table, key_condition, index=None, filter=None,
+              attributes=None, limit=None, start_key=None):
+        # returns a page of items and the key to start the next page from,
+        # None on the last page. like DynamoDB, limit applies before filter
+        raise NotImplementedError()
+
+
+class Queue(object):
+    # sends and receives messages. messages and entries are SQS
+    # SendMessage/SendMessageBatch arguments, received messages are SQS
+    # Lambda event records
+
+    def send_message(self, queue, message):
+        raise NotImplementedError()
+
+    def send_message_batch(self, queue, entries):
+        # returns the entries that could not be sent
+        raise NotImplementedError()
+
+    def receive_messages(self, queue, max_messages=10):
+        raise NotImplementedError()
+
+    def delete_messages(self, queue, records):
+        raise NotImplementedError()
+
+    def get_size(self, queue):
+        # messages not yet deleted, including delayed and in flight
+        raise NotImplementedError()
+
+
+class BlobStore(object):
+    # immutable payloads as bytes, by key
+
+    def put(self, key, data):
+        raise NotImplementedError()
+
+    def get(self, key):
+        # raises KeyError when there is no such blob
+        raise NotImplementedError()
+
+
+class EmulatedStore(Store):
+    # DynamoDB semantics over primitives keyed by (hash, range) tuples
+
+    def __init__(self):
+        self.lock = threading.RLock()
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            yield
+
+    def _get(self, table, key):
+        raise NotImplementedError()
+
+    def _put(self, table, key, item):
+        raise NotImplementedError()
+
+    def _delete(self, table, key):
+        raise NotImplementedError()
+
+    def _partition(self, table, hash_value=None):
+        # items with the hash key value, or all items when None
+        raise NotImplementedError()
+
+    def get_key(self, table, item):
+        return tuple([item[k] for k in TABLES[table]['keys']])
+
+    def check(self, table, key, condition):
+        if condition is None:
+            return
+        if not evaluate(condition, self._get(table, key) or {}):
+            raise ConditionFailed('conditional request failed')
+
+    def get_item(self, table, key, attributes=None):
+        item = self._get(table, self.get_key(table, key))
+        if item is None:
+            return None
+        return project(item, attributes)
+
+    def put_item(self, table, item, condition=None):
+        key = self.get_key(table, item)
+        with self.transaction():
+            self.check(table, key, condition)
+            self._put(table, key, copy_item(item))
+
+    def update_item(self, table, key, values, remove=None, condition=None,
+                    add=None):
+        _key = self.get_key(table, key)
+        with self.transaction():
+            self.check(table, _key, condition)
+            item = self._get(table, _key) or dict(key)
+            item.update(copy_item(values))
+            for k in remove or []:
+                item.pop(k, None)
+            # sets are kept as sorted lists, as they are read back
+            for (k, v) in (add or {}).items():
+                if isinstance(v, set):
+                    item[k] = sorted(set(item.get(k, [])) | v)
+                else:
+                    item[k] = item.get(k, 0) + v
+            self._put(table, _key, item)
+        return {k: copy_item(item[k]) for k in add or {}}
+
+    def delete_item(self, table, key):
+        with self.transaction():
+            self._delete(table, self.get_key(table, key))
+
+    def batch_write(self, table, items):
+        with self.transaction():
+            for item in items:
+                self._put(table, self.get_key(table, item), copy_item(item))
+        return []
+
+    def batch_delete(self, table, keys):
+        with self.transaction():
+            for key in keys:
+                self._delete(table, self.get_key(table, key))
+
+    def query(self, table, key_condition, index=None, filter=None,
+              attributes=None, limit=None, start_key=None):
+        schema = TABLES[table]
+        keys = schema['keys'] if index is None else schema['indexes'][index]
+        order = keys + [k for k in schema['keys'] if k not in keys]
+        hash_value = None
+        if keys[0] == schema['keys'][0]:
+            hash_value = get_key_value(key_condition, keys[0])
+        # indexes are sparse, items without the index keys are left out
+        items = sorted([
+            item for item in self._partition(table, hash_value)
+            if all([k in item for k in keys])
+            and evaluate(key_condition, item)
+        ], key=lambda item: tuple([item[k] for k in order]))
+        if start_key is not None:
+            start = tuple([start_key[k] for k in order])
+            items = [
+                item for item in items
+                if tuple([item[k] for k in order]) > start
+            ]
+        last_key = None
+        if limit is not None and len(items) > limit:
+            items = items[:limit]
+            last_key = {k: items[-1][k] for k in order}
+        return [
+            copy_item(project(item, attributes)) for item in items
+            if filter is None or evaluate(filter, item)
+        ], last_key
+
+
+class EmulatedQueue(Queue):
+
+    def send_message_batch(self, queue, entries):
+        for entry in entries:
+            self.send_message(queue, {
+                k: v for k, v in entry.items() if k != 'Id'
+            })
+        return []
+
+
+def get_record(id, body, attributes, receive_count, sent):
+    # a received message as an SQS Lambda event record
+    return {
+        'messageId': id,
+        'receiptHandle': id,
+        'body': body,
+        'attributes': {
+            'ApproximateReceiveCount': str(receive_count),
+            'SentTimestamp': str(int(sent * 1000))
+        },
+        'messageAttributes': {
+            k: {'stringValue': v['StringValue'], 'dataType': v['DataType']}
+            for k, v in (attributes or {}).items()
+        },
+        'eventSource': 'aws:sqs'
+    }
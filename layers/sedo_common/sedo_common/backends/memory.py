@@ -0,0 +1,137 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import heapq
+import itertools
+import os
+from sedo_common.backends.base import BlobStore
+from sedo_common.backends.base import copy_item
+from sedo_common.backends.base import EmulatedQueue
+from sedo_common.backends.base import EmulatedStore
+from sedo_common.backends.base import get_record
+import threading
+import time
+from uuid import uuid4
+
+VISIBILITY_TIMEOUT = int(os.environ.get('SEDO_VISIBILITY_TIMEOUT', 180))
+
+
+class MemoryStore(EmulatedStore):
+    # tables held as {table: {hash: {range: item}}}
+
+    def __init__(self):
+        super(MemoryStore, self).__init__()
+        self.tables = {}
+
+    def _get(self, table, key):
+        item = self.tables.get(table, {}).get(key[0], {}).get(key[1:])
+        return None if item is None else copy_item(item)
+
+    def _put(self, table, key, item):
+        self.tables.setdefault(table, {}).setdefault(key[0], {})[
+            key[1:]
+        ] = item
+
+    def _delete(self, table, key):
+        self.tables.get(table, {}).get(key[0], {}).pop(key[1:], None)
+
+    def _partition(self, table, hash_value=None):
+        with self.lock:
+            partitions = self.tables.get(table, {})
+            if hash_value is not None:
+                return list(partitions.get(hash_value, {}).values())
+            return [
+                item for partition in partitions.values()
+                for item in partition.values()
+            ]
+
+
+class MemoryBlobStore(BlobStore):
+
+    def __init__(self):
+        self.blobs = {}
+
+    def put(self, key, data):
+        self.blobs[key] = bytes(data)
+
+    def get(self, key):
+        return self.blobs[key]
+
+
+class MemoryQueue(EmulatedQueue):
+    # messages become visible again after the visibility timeout unless
+    # deleted, as with SQS
+
+    def __init__(self, visibility_timeout=None):
+        self.lock = threading.Lock()
+        self.visibility_timeout = VISIBILITY_TIMEOUT if (
+            visibility_timeout is None
+        ) else visibility_timeout
+        self.queues = {}
+        self.sequence = itertools.count()
+
+    def get_queue(self, queue):
+        if queue not in self.queues:
+            self.queues[queue] = {'heap': [], 'messages': {}}
+        return self.queues[queue]
+
+    def send_message(self, queue, message):
+        now = time.time()
+        id = str(uuid4())
+        visible_at = now + message.get('DelaySeconds', 0)
+        with self.lock:
+            q = self.get_queue(queue)
+            q['messages'][id] = {
+                'body': message['MessageBody'],
+                'attributes': message.get('MessageAttributes'),
+                'sent': now,
+                'visible_at': visible_at,
+                'receive_count': 0
+            }
+            heapq.heappush(q['heap'], (visible_at, next(self.sequence), id))
+        return id
+
+    def receive_messages(self, queue, max_messages=10):
+        now = time.time()
+        records = []
+        received = []
+        with self.lock:
+            q = self.get_queue(queue)
+            while len(records) < max_messages and len(q['heap']) and (
+                q['heap'][0][0] <= now
+            ):
+                (visible_at, _, id) = heapq.heappop(q['heap'])
+                m = q['messages'].get(id)
+                # deleted, or an entry left over from an earlier receive
+                if m is None or m['visible_at'] != visible_at:
+                    continue
+                m['receive_count'] += 1
+                m['visible_at'] = now + self.visibility_timeout
+                received.append((m['visible_at'], next(self.sequence), id))
+                records.append(get_record(
+                    id, m['body'], m['attributes'], m['receive_count'],
+                    m['sent']
+                ))
+            for entry in received:
+                heapq.heappush(q['heap'], entry)
+        return records
+
+    def delete_messages(self, queue, records):
+        with self.lock:
+            q = self.get_queue(queue)
+            for record in records:
+                q['messages'].pop(record['receiptHandle'], None)
+
+    def get_size(self, queue):
+        with self.lock:
+            return len(self.get_queue(queue)['messages'])
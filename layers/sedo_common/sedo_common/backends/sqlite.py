@@ -0,0 +1,245 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+import base64
+from contextlib import contextmanager
+import json
+import os
+from sedo_common.backends.base import BlobStore
+from sedo_common.backends.base import EmulatedQueue
+from sedo_common.backends.base import EmulatedStore
+from sedo_common.backends.base import get_record
+from sedo_common.backends.memory import VISIBILITY_TIMEOUT
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+# store and queue share a database file, which persists between local runs,
+# blobs are files in a directory
+PATH = os.environ.get('SEDO_SQLITE_PATH', 'sedo.sqlite')
+BLOB_DIR = os.environ.get('SEDO_BLOB_DIR', 'sedo-blobs')
+
+# binary attributes, such as encoded payloads, in JSON item bodies
+BINARY = '$b64'
+
+
+def encode_binary(obj):
+    if isinstance(obj, bytes):
+        return {BINARY: base64.b64encode(obj).decode('ascii')}
+    raise TypeError('%s is not JSON serializable' % type(obj).__name__)
+
+
+def decode_binary(obj):
+    if len(obj) == 1 and BINARY in obj:
+        return base64.b64decode(obj[BINARY])
+    return obj
+
+
+def dump_item(item):
+    return json.dumps(item, default=encode_binary)
+
+
+def load_item(body):
+    return json.loads(body, object_hook=decode_binary)
+
+
+STORE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS item (
+    tbl TEXT NOT NULL,
+    hk TEXT NOT NULL,
+    rk TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (tbl, hk, rk)
+)
+'''
+
+QUEUE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS message (
+    id TEXT PRIMARY KEY,
+    queue TEXT NOT NULL,
+    body TEXT NOT NULL,
+    attributes TEXT,
+    sent REAL NOT NULL,
+    visible_at REAL NOT NULL,
+    receive_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS message_visible ON message (queue, visible_at);
+'''
+
+
+def connect(path, schema):
+    # one connection per store or queue, shared by threads under a lock
+    connection = sqlite3.connect(
+        path or PATH, timeout=30, isolation_level=None,
+        check_same_thread=False
+    )
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    connection.executescript(schema)
+    return connection
+
+
+class SqliteStore(EmulatedStore):
+
+    def __init__(self, path=None):
+        super(SqliteStore, self).__init__()
+        self.connection = connect(path, STORE_SCHEMA)
+        self.depth = 0
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.depth += 1
+            if self.depth == 1:
+                self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield
+            except Exception:
+                if self.depth == 1:
+                    self.connection.execute('ROLLBACK')
+                raise
+            else:
+                if self.depth == 1:
+                    self.connection.execute('COMMIT')
+            finally:
+                self.depth -= 1
+
+    def _get(self, table, key):
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT body FROM item WHERE tbl = ? AND hk = ? AND rk = ?',
+                (table, str(key[0]), json.dumps(key[1:]))
+            ).fetchone()
+        return None if row is None else load_item(row[0])
+
+    def _put(self, table, key, item):
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO item (tbl, hk, rk, body) '
+                'VALUES (?, ?, ?, ?)',
+                (table, str(key[0]), json.dumps(key[1:]), dump_item(item))
+            )
+
+    def _delete(self, table, key):
+        with self.lock:
+            self.connection.execute(
+                'DELETE FROM item WHERE tbl = ? AND hk = ? AND rk = ?',
+                (table, str(key[0]), json.dumps(key[1:]))
+            )
+
+    def _partition(self, table, hash_value=None):
+        with self.lock:
+            if hash_value is not None:
+                rows = self.connection.execute(
+                    'SELECT body FROM item WHERE tbl = ? AND hk = ?',
+                    (table, str(hash_value))
+                ).fetchall()
+            else:
+                rows = self.connection.execute(
+                    'SELECT body FROM item WHERE tbl = ?', (table,)
+                ).fetchall()
+        return [load_item(row[0]) for row in rows]
+
+
+class FileBlobStore(BlobStore):
+
+    def __init__(self, path=None):
+        self.path = path or BLOB_DIR
+
+    def get_path(self, key):
+        path = os.path.normpath(os.path.join(self.path, key))
+        if not path.startswith(os.path.normpath(self.path) + os.sep):
+            raise Exception('invalid blob key %s' % key)
+        return path
+
+    def put(self, key, data):
+        # written to a temporary file and renamed, so readers never see a
+        # partial blob
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = '%s.%s.tmp' % (path, uuid4())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    def get(self, key):
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(key)
+
+
+class SqliteQueue(EmulatedQueue):
+
+    def __init__(self, path=None, visibility_timeout=None):
+        self.lock = threading.Lock()
+        self.connection = connect(path, QUEUE_SCHEMA)
+        self.visibility_timeout = VISIBILITY_TIMEOUT if (
+            visibility_timeout is None
+        ) else visibility_timeout
+
+    def send_message(self, queue, message):
+        now = time.time()
+        id = str(uuid4())
+        attributes = message.get('MessageAttributes')
+        with self.lock:
+            self.connection.execute(
+                'INSERT INTO message (id, queue, body, attributes, sent, '
+                'visible_at, receive_count) VALUES (?, ?, ?, ?, ?, ?, 0)',
+                (
+                    id, queue, message['MessageBody'],
+                    None if attributes is None else json.dumps(attributes),
+                    now, now + message.get('DelaySeconds', 0)
+                )
+            )
+        return id
+
+    def receive_messages(self, queue, max_messages=10):
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self.connection.execute(
+                    'SELECT id, body, attributes, receive_count, sent '
+                    'FROM message WHERE queue = ? AND visible_at <= ? '
+                    'ORDER BY visible_at LIMIT ?',
+                    (queue, now, max_messages)
+                ).fetchall()
+                self.connection.executemany(
+                    'UPDATE message SET visible_at = ?, '
+                    'receive_count = receive_count + 1 WHERE id = ?',
+                    [(now + self.visibility_timeout, r[0]) for r in rows]
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+        return [get_record(
+            id, body, None if attributes is None else json.loads(attributes),
+            receive_count + 1, sent
+        ) for (id, body, attributes, receive_count, sent) in rows]
+
+    def delete_messages(self, queue, records):
+        with self.lock:
+            self.connection.executemany(
+                'DELETE FROM message WHERE id = ?',
+                [(record['receiptHandle'],) for record in records]
+            )
+
+    def get_size(self, queue):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT COUNT(*) FROM message WHERE queue = ?', (queue,)
+            ).fetchone()[0]
@@ -0,0 +1,117 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from sedo_common.aws import get_client
+from sedo_common.aws import get_queue_url
+from sedo_common.aws import get_resource
+import os
+import time
+
+# BatchWriteItem takes up to 25 items, SendMessageBatch up to 10 messages
+# of up to 256KB in total
+WRITE_BATCH_SIZE = 25
+MESSAGE_BATCH_SIZE = 10
+MESSAGE_BATCH_BYTES = 256 * 1024
+MAX_ATTEMPTS = int(os.environ.get('SEDO_BATCH_MAX_ATTEMPTS', 5))
+
+
+def backoff(attempt):
+    time.sleep(min(0.05 * (2 ** attempt), 1))
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_message_size(entry):
+    # the body and attribute names, types and values count towards the limit
+    size = len(entry['MessageBody'].encode('utf-8'))
+    for name, value in entry.get('MessageAttributes', {}).items():
+        size += len(name.encode('utf-8'))
+        size += len(value.get('DataType', '').encode('utf-8'))
+        size += len(value.get('StringValue', '').encode('utf-8'))
+        size += len(value.get('BinaryValue', b''))
+    return size
+
+
+def message_chunks(entries):
+    # chunks entries by count and by total size, an entry over the size
+    # limit on its own is sent alone and fails as a sender fault
+    chunk = []
+    chunk_size = 0
+    for entry in entries:
+        size = get_message_size(entry)
+        if len(chunk) == MESSAGE_BATCH_SIZE or (
+            len(chunk) > 0 and chunk_size + size > MESSAGE_BATCH_BYTES
+        ):
+            yield chunk
+            chunk = []
+            chunk_size = 0
+        chunk.append(entry)
+        chunk_size += size
+    if len(chunk) > 0:
+        yield chunk
+
+
+def batch_write(table_name, items, max_attempts=None):
+    # returns the items still unprocessed after retrying
+    if max_attempts is None:
+        max_attempts = MAX_ATTEMPTS
+    dynamodb = get_resource('dynamodb')
+    unprocessed = []
+    for chunk in chunks(items, WRITE_BATCH_SIZE):
+        requests = [{'PutRequest': {'Item': item}} for item in chunk]
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                backoff(attempt)
+            r = dynamodb.batch_write_item(RequestItems={table_name: requests})
+            requests = r.get('UnprocessedItems', {}).get(table_name, [])
+            if len(requests) == 0:
+                break
+        unprocessed.extend([r['PutRequest']['Item'] for r in requests])
+    return unprocessed
+
+
+def send_message_batch(queue_name, entries, max_attempts=None):
+    # entries are SendMessageBatch entries with an Id unique to the call,
+    # returns the entries that could not be sent after retrying, a chunk
+    # whose request fails as a whole fails all of its entries
+    if max_attempts is None:
+        max_attempts = MAX_ATTEMPTS
+    client = get_client('sqs')
+    queue_url = get_queue_url(queue_name)
+    failed = []
+    for chunk in message_chunks(entries):
+        for attempt in range(max_attempts):
+            if attempt > 0:
+                backoff(attempt)
+            try:
+                r = client.send_message_batch(
+                    QueueUrl=queue_url, Entries=chunk
+                )
+            except Exception:
+                # the client has already retried transient errors
+                break
+            # sender faults will fail again so are not retried
+            entry = {e['Id']: e for e in chunk}
+            chunk = []
+            for f in r.get('Failed', []):
+                if f.get('SenderFault') is True:
+                    failed.append(entry[f['Id']])
+                else:
+                    chunk.append(entry[f['Id']])
+            if len(chunk) == 0:
+                break
+        failed.extend(chunk)
+    return failed
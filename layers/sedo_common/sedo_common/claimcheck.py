@@ -0,0 +1,94 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# claim checks for large payloads. a payload whose JSON is over
+# SEDO_CLAIM_CHECK_BYTES is put in the blob store, addressed by its hash,
+# and replaced by a reference which is only loaded when the payload is
+# needed. references are small enough to travel in messages and items
+# however large the payload
+from collections import OrderedDict
+import hashlib
+import json
+import os
+from sedo_common.backends import get_blobs
+from sedo_common.telemetry import get_metrics
+import threading
+
+REF = '$sedoRef'
+THRESHOLD = int(os.environ.get('SEDO_CLAIM_CHECK_BYTES', 64 * 1024))
+
+# recently put or loaded payloads by key, as blobs are immutable
+CACHE_SIZE = int(os.environ.get('SEDO_CLAIM_CHECK_CACHE_SIZE', 16))
+CACHE = OrderedDict()
+LOCK = threading.Lock()
+
+
+def is_ref(value):
+    return isinstance(value, dict) and REF in value
+
+
+def cache(key, data):
+    with LOCK:
+        CACHE[key] = data
+        CACHE.move_to_end(key)
+        while len(CACHE) > CACHE_SIZE:
+            CACHE.popitem(last=False)
+
+
+def offload(value, tenant_id, threshold=None):
+    # returns value, or a reference to it if its JSON is over the threshold
+    if threshold is None:
+        threshold = THRESHOLD
+    if value is None or is_ref(value):
+        return value
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    if len(data) <= threshold:
+        return value
+    digest = hashlib.sha256(data).hexdigest()
+    key = '%s/%s' % (tenant_id, digest)
+    if key not in CACHE:
+        metrics = get_metrics()
+        with metrics.time('BlobTime', 'BlobCalls'):
+            get_blobs().put(key, data)
+        metrics.add('OffloadedBytes', len(data), 'Bytes')
+    cache(key, data)
+    return {
+        REF: key,
+        'sha256': digest,
+        'size': len(data)
+    }
+
+
+def offload_fields(obj, fields, tenant_id, threshold=None):
+    # replaces the fields of obj over the threshold with references
+    for field in fields:
+        if field in obj:
+            obj[field] = offload(obj[field], tenant_id, threshold)
+    return obj
+
+
+def load(value):
+    # returns the payload a reference refers to, or value if it is not a
+    # reference. payloads are checked against their hash
+    if not is_ref(value):
+        return value
+    key = value[REF]
+    with LOCK:
+        data = CACHE.get(key)
+    if data is None:
+        with get_metrics().time('BlobTime', 'BlobCalls'):
+            data = get_blobs().get(key)
+        if hashlib.sha256(data).hexdigest() != value['sha256']:
+            raise Exception('payload %s does not match its hash' % key)
+        cache(key, data)
+    return json.loads(data)
@@ -0,0 +1,139 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# opt-in compact encoding of payload attributes and message bodies.
+# encoded values start with a header of MAGIC, the format version and the
+# codec id, so encoded and plain values coexist and are always decoded
+# whatever SEDO_CODEC is set to. attributes are stored as binary, message
+# bodies, which must be text, as base64 after BODY_PREFIX
+import base64
+import json
+import os
+
+MAGIC = b'\xd5'
+VERSION = 1
+BODY_PREFIX = 'sedo:'
+
+# (id, serializer, compressor) by name
+CODECS = {
+    'json': (1, 'json', None),
+    'json+zlib': (2, 'json', 'zlib'),
+    'msgpack': (3, 'msgpack', None),
+    'msgpack+zlib': (4, 'msgpack', 'zlib'),
+    'msgpack+zstd': (5, 'msgpack', 'zstd')
+}
+NAMES = {v[0]: k for k, v in CODECS.items()}
+
+# empty to store and send plain JSON
+CODEC = os.environ.get('SEDO_CODEC', '')
+# values smaller than this are left as they are
+MIN_BYTES = int(os.environ.get('SEDO_CODEC_MIN_BYTES', 256))
+ZLIB_LEVEL = int(os.environ.get('SEDO_CODEC_ZLIB_LEVEL', 6))
+ZSTD_LEVEL = int(os.environ.get('SEDO_CODEC_ZSTD_LEVEL', 3))
+
+
+def serialize(serializer, value):
+    if serializer == 'msgpack':
+        import msgpack
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def deserialize(serializer, data):
+    if serializer == 'msgpack':
+        import msgpack
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+
+def compress(compressor, data):
+    if compressor == 'zlib':
+        import zlib
+        return zlib.compress(data, ZLIB_LEVEL)
+    if compressor == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+def decompress(compressor, data):
+    if compressor == 'zlib':
+        import zlib
+        return zlib.decompress(data)
+    if compressor == 'zstd':
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    return data
+
+
+def is_encoded(value):
+    return isinstance(value, bytes) and value[:1] == MAGIC
+
+
+def encode(value, codec=None, min_bytes=None):
+    # returns value encoded with codec, default SEDO_CODEC, or value as it
+    # is when no codec is set or it is smaller than min_bytes
+    codec = CODEC if codec is None else codec
+    if not codec or value is None or is_encoded(value):
+        return value
+    if codec not in CODECS:
+        raise Exception('unknown codec %s' % codec)
+    (id, serializer, compressor) = CODECS[codec]
+    data = serialize(serializer, value)
+    if len(data) < (MIN_BYTES if min_bytes is None else min_bytes):
+        return value
+    return MAGIC + bytes([VERSION, id]) + compress(compressor, data)
+
+
+def decode(value):
+    # returns the value an encoded value was encoded from, or value
+    if not is_encoded(value):
+        return value
+    (version, id) = (value[1], value[2])
+    if version != VERSION or id not in NAMES:
+        raise Exception('unsupported encoding %s/%s' % (version, id))
+    (_, serializer, compressor) = CODECS[NAMES[id]]
+    return deserialize(serializer, decompress(compressor, value[3:]))
+
+
+def encode_fields(obj, fields, codec=None):
+    for field in fields:
+        if field in obj:
+            obj[field] = encode(obj[field], codec)
+    return obj
+
+
+def decode_fields(obj, fields=None):
+    # decodes the given fields of obj, or every encoded field
+    for field in obj if fields is None else fields:
+        if field in obj and is_encoded(obj[field]):
+            obj[field] = decode(obj[field])
+    return obj
+
+
+def encode_body(event, body=None, codec=None):
+    # a message body for event, its JSON body when given, unless a codec is
+    # set and the body is at least MIN_BYTES
+    if body is None:
+        body = json.dumps(event)
+    codec = CODEC if codec is None else codec
+    if not codec or len(body) < MIN_BYTES:
+        return body
+    value = encode(event, codec, min_bytes=0)
+    return BODY_PREFIX + base64.b64encode(value).decode('ascii')
+
+
+def decode_body(body):
+    if body.startswith(BODY_PREFIX):
+        return decode(base64.b64decode(body[len(BODY_PREFIX):]))
+    return json.loads(body)
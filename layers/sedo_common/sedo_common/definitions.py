@@ -0,0 +1,92 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# definitions are compiled when created by the API, so invalid step graphs
+# are rejected before they are executed, and by the execution processor
+# when it first runs a version
+from collections import OrderedDict
+
+
+class InvalidDefinition(Exception):
+    pass
+
+
+def compile_definition(definition):
+    steps = OrderedDict()
+    for sd in definition.get('steps', []):
+        if sd['id'] in steps:
+            raise InvalidDefinition('duplicate step %s' % sd['id'])
+        steps[sd['id']] = sd
+    if len(steps) == 0:
+        raise InvalidDefinition('definition has no steps')
+
+    # check next references
+    for sd in steps.values():
+        if sd.get('end') is True:
+            continue
+        if 'next' not in sd:
+            raise InvalidDefinition('step %s has no next step' % sd['id'])
+        if sd['next'] not in steps:
+            raise InvalidDefinition('step %s next step %s not found' % (
+                sd['id'], sd['next']
+            ))
+
+    # check all steps are reachable from the first and an end is reached
+    first = next(iter(steps))
+    reachable = []
+    sd = steps[first]
+    while sd['id'] not in reachable:
+        reachable.append(sd['id'])
+        if sd.get('end') is True:
+            break
+        sd = steps[sd['next']]
+    else:
+        raise InvalidDefinition(
+            'step %s loops without reaching an end step' % sd['id']
+        )
+    unreachable = [k for k in steps if k not in reachable]
+    if len(unreachable):
+        raise InvalidDefinition(
+            'unreachable steps %s' % ', '.join(unreachable)
+        )
+
+    # branches of parallel steps, and the steps of map steps, are compiled
+    # as definitions keyed by their path of step IDs and branch indexes, *
+    # for every chunk of a map step
+    branches = {}
+    for sd in steps.values():
+        if sd.get('type') == 'parallel':
+            if len(sd.get('branches') or []) == 0:
+                raise InvalidDefinition('step %s has no branches' % sd['id'])
+            _branches = [
+                ('%s/%s' % (sd['id'], i), b)
+                for i, b in enumerate(sd['branches'])
+            ]
+        elif sd.get('type') == 'map':
+            if 'itemsPath' not in sd:
+                raise InvalidDefinition('step %s has no itemsPath' % sd['id'])
+            _branches = [('%s/*' % sd['id'], sd)]
+        else:
+            continue
+        for (path, branch) in _branches:
+            compiled = compile_definition(branch)
+            for k, v in compiled.pop('branches').items():
+                branches['%s/%s' % (path, k)] = v
+            branches[path] = compiled
+
+    return {
+        'id': definition.get('id'),
+        'first': first,
+        'steps': steps,
+        'branches': branches
+    }
@@ -0,0 +1,108 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# fair scheduling of tenants. events are dispatched to one of
+# SEDO_QUEUE_SHARDS processor queues by a hash of the tenant ID, so a
+# tenant's backlog only delays the tenants sharing its shard, and each
+# tenant's event rate is bounded by its share of SEDO_TENANT_QUOTA. events
+# over the quota are deferred to a later window rather than dropped
+import hashlib
+import json
+import os
+import random
+from sedo_common.backends import get_store
+from sedo_common import telemetry
+from sedo_common.telemetry import get_metrics
+import time
+
+QUEUE_NAME = 'sedo_execution-processor-queue'
+SHARDS = int(os.environ.get('SEDO_QUEUE_SHARDS', 1))
+
+# events per second allowed per tenant, 0 for no limit, scaled by the
+# tenant's weight in SEDO_TENANT_WEIGHTS, eg {"123": 2, "*": 1}
+QUOTA = float(os.environ.get('SEDO_TENANT_QUOTA', 0))
+WEIGHTS = json.loads(os.environ.get('SEDO_TENANT_WEIGHTS') or '{}')
+
+# usage is counted in the usage table over fixed windows, expiring after
+USAGE_TABLE = 'sedo_tenant_usage'
+WINDOW_SECONDS = int(os.environ.get('SEDO_TENANT_QUOTA_WINDOW', 10))
+
+
+def get_shard(tenant_id, shards=None):
+    if shards is None:
+        shards = SHARDS
+    if shards <= 1:
+        return 0
+    digest = hashlib.sha256(tenant_id.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % shards
+
+
+def get_queue_name(tenant_id=None, shards=None):
+    # shard 0 keeps the name of the unsharded queue, so events already
+    # queued are still processed when shards are added
+    shard = 0 if tenant_id is None else get_shard(tenant_id, shards)
+    if shard == 0:
+        return QUEUE_NAME
+    return '%s-%d' % (QUEUE_NAME, shard)
+
+
+def get_queue_names(shards=None):
+    if shards is None:
+        shards = SHARDS
+    return [QUEUE_NAME] + [
+        '%s-%d' % (QUEUE_NAME, shard) for shard in range(1, shards)
+    ]
+
+
+def get_limit(tenant_id):
+    # events allowed per window, or None when unlimited
+    if QUOTA <= 0:
+        return None
+    weight = float(WEIGHTS.get(tenant_id, WEIGHTS.get('*', 1)))
+    return max(int(QUOTA * weight * WINDOW_SECONDS), 1)
+
+
+def admit(tenant_id, count, now=None):
+    # reserves count events of the tenant's quota in the current window,
+    # returning how many are admitted and the delay for the rest, spread
+    # over the next window. once a window is used up every later
+    # reservation in it is refused, so reservations are never handed back
+    limit = get_limit(tenant_id)
+    if limit is None or count == 0:
+        return count, 0
+    if now is None:
+        now = time.time()
+    window = int(now // WINDOW_SECONDS)
+    metrics = get_metrics()
+    try:
+        with metrics.time('QuotaTime', 'QuotaCalls'):
+            r = get_store().update_item(
+                USAGE_TABLE,
+                {'tenantId': tenant_id, 'window': window},
+                {'expiresAt': (window + 2) * WINDOW_SECONDS},
+                add={'used': count}
+            )
+    except Exception as e:
+        # events are admitted rather than held up when usage is unavailable
+        telemetry.error(
+            'unable to count tenant usage', tenantId=tenant_id,
+            exception=telemetry.describe(e)
+        )
+        return count, 0
+    used = int(r['used'])
+    admitted = max(min(count, limit - used + count), 0)
+    if admitted == count:
+        return count, 0
+    metrics.add('Deferred', count - admitted)
+    delay = (window + 1) * WINDOW_SECONDS - now
+    return admitted, int(delay + random.random() * WINDOW_SECONDS) + 1
@@ -0,0 +1,190 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# structured logs and metrics. log lines are JSON objects filtered by
+# SEDO_LOG_LEVEL, with payloads only included for a sample of records and
+# truncated. metrics are collected per unit of work, eg a transition, and
+# written as a CloudWatch Embedded Metric Format (EMF) line, which
+# CloudWatch Logs turns into metrics without any API calls
+from contextlib import contextmanager
+from datetime import datetime
+import json
+import os
+import random
+import threading
+import time
+
+LEVELS = {
+    'DEBUG': 10,
+    'INFO': 20,
+    'WARNING': 30,
+    'ERROR': 40
+}
+LOG_LEVEL = LEVELS.get(os.environ.get('SEDO_LOG_LEVEL', 'INFO').upper(), 20)
+PAYLOAD_SAMPLE_RATE = float(
+    os.environ.get('SEDO_LOG_PAYLOAD_SAMPLE_RATE', 0)
+)
+PAYLOAD_MAX_BYTES = int(os.environ.get('SEDO_LOG_PAYLOAD_MAX_BYTES', 1024))
+METRICS_ENABLED = os.environ.get('SEDO_METRICS', 'true') == 'true'
+NAMESPACE = os.environ.get('SEDO_METRICS_NAMESPACE', 'Sedo')
+SERVICE = os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'sedo')
+
+LOCAL = threading.local()
+
+
+def write(line):
+    print(json.dumps(line, default=str))
+
+
+def is_enabled(level):
+    return LEVELS[level] >= LOG_LEVEL
+
+
+def log(level, message, **fields):
+    if not is_enabled(level):
+        return
+    line = {
+        'level': level,
+        'message': message,
+        'timestamp': datetime.utcnow().isoformat() + 'Z'
+    }
+    line.update(get_metrics().properties)
+    line.update({k: v for k, v in fields.items() if v is not None})
+    write(line)
+
+
+def debug(message, **fields):
+    log('DEBUG', message, **fields)
+
+
+def info(message, **fields):
+    log('INFO', message, **fields)
+
+
+def warning(message, **fields):
+    log('WARNING', message, **fields)
+
+
+def error(message, **fields):
+    log('ERROR', message, **fields)
+
+
+def truncate(value):
+    if len(value) > PAYLOAD_MAX_BYTES:
+        return value[:PAYLOAD_MAX_BYTES] + '...(%s bytes)' % len(value)
+    return value
+
+
+def payload(obj):
+    # the payload as JSON for the sampled records, truncated to
+    # PAYLOAD_MAX_BYTES, otherwise None
+    if not get_metrics().sampled:
+        return None
+    if not isinstance(obj, str):
+        obj = json.dumps(obj, default=str)
+    return truncate(obj)
+
+
+def describe(e):
+    # exception message without the instance jsonschema errors include
+    return truncate(str(getattr(e, 'message', e)))
+
+
+class Metrics(object):
+    # metric values and units, and properties logged alongside them
+
+    def __init__(self, sampled=False, **properties):
+        self.sampled = sampled
+        self.properties = properties
+        self.values = {}
+        self.units = {}
+
+    def add(self, name, value, unit='Count'):
+        self.values[name] = self.values.get(name, 0) + value
+        self.units[name] = unit
+
+    @contextmanager
+    def time(self, name, calls=None):
+        # adds the elapsed milliseconds to name, and one to calls if given
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, (time.perf_counter() - start) * 1000,
+                     'Milliseconds')
+            if calls is not None:
+                self.add(calls, 1)
+
+    def to_emf(self):
+        line = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': NAMESPACE,
+                    'Dimensions': [['Service']],
+                    'Metrics': [
+                        {'Name': name, 'Unit': self.units[name]}
+                        for name in self.values
+                    ]
+                }]
+            },
+            'Service': SERVICE
+        }
+        line.update(self.properties)
+        line.update({
+            name: round(value, 3) for name, value in self.values.items()
+        })
+        return line
+
+    def flush(self):
+        if METRICS_ENABLED and len(self.values):
+            write(self.to_emf())
+
+
+class NullMetrics(Metrics):
+    # collects nothing, outside of a record. it is shared, so properties
+    # set on it are discarded rather than logged with every later line
+
+    @property
+    def properties(self):
+        return {}
+
+    @properties.setter
+    def properties(self, value):
+        pass
+
+    def add(self, name, value, unit='Count'):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def get_metrics():
+    return getattr(LOCAL, 'metrics', None) or NULL_METRICS
+
+
+@contextmanager
+def record(**properties):
+    # collects the metrics of a unit of work on this thread, written when
+    # it ends. payloads are logged for a sample of records
+    previous = getattr(LOCAL, 'metrics', None)
+    metrics = Metrics(
+        sampled=random.random() < PAYLOAD_SAMPLE_RATE, **properties
+    )
+    LOCAL.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        LOCAL.metrics = previous
+        metrics.flush()
@@ -0,0 +1,60 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+
+# compiled validators keyed by schema hash, so schemas are only checked and
+# validators only built once per container
+CACHE_SIZE = int(os.environ.get('SEDO_VALIDATOR_CACHE_SIZE', 256))
+VALIDATORS = OrderedDict()
+LOCK = threading.Lock()
+
+
+def get_schema_hash(schema):
+    return hashlib.sha256(json.dumps(
+        schema, sort_keys=True, separators=(',', ':')
+    ).encode('utf-8')).hexdigest()
+
+
+def get_validator(schema, schema_hash=None):
+    if schema_hash is None:
+        schema_hash = get_schema_hash(schema)
+    with LOCK:
+        validator = VALIDATORS.get(schema_hash)
+        if validator is not None:
+            VALIDATORS.move_to_end(schema_hash)
+            return validator
+    # imported lazily so trusted events never pay for loading jsonschema
+    from jsonschema.validators import validator_for
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    validator = cls(schema)
+    with LOCK:
+        VALIDATORS[schema_hash] = validator
+        while len(VALIDATORS) > CACHE_SIZE:
+            VALIDATORS.popitem(last=False)
+    return validator
+
+
+def validate(instance, schema, schema_hash=None):
+    # same behaviour as jsonschema.validate, using a cached validator
+    from jsonschema.exceptions import best_match
+    error = best_match(
+        get_validator(schema, schema_hash).iter_errors(instance)
+    )
+    if error is not None:
+        raise error
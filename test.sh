@@ -1,4 +1,4 @@
 #!/bin/bash
 set -e
-pytest --cov=functions tests/ --cov-report html:/tmp/htmlcov --cov-fail-under 80
+pytest --cov=functions --cov=layers tests/ --cov-report html:/tmp/htmlcov --cov-fail-under 80
 flake8 .
\ No newline at end of file
@@ -39,7 +39,17 @@ def get_test_dir(name):
     return test_dir
 
 
-def create_dynamodb_table(table_name, keys=None):
+def get_key_schema(keys):
+    key_schema = []
+    for i, kpair in enumerate(keys):
+        key_schema.append({
+            'AttributeName': kpair.split(':')[0],
+            'KeyType': 'HASH' if i == 0 else 'RANGE'
+        })
+    return key_schema
+
+
+def create_dynamodb_table(table_name, keys=None, indexes=None):
     dynamodb = get_session().resource('dynamodb')
     if not isinstance(keys, list):
         keys = ['tenantId', 'id']
@@ -64,6 +74,21 @@ def create_dynamodb_table(table_name, keys=None):
         })
         attributes.append(kpair)
 
+    if isinstance(indexes, dict):
+        kwargs['GlobalSecondaryIndexes'] = []
+        for index_name, index_keys in indexes.items():
+            kwargs['GlobalSecondaryIndexes'].append({
+                'IndexName': index_name,
+                'KeySchema': get_key_schema(index_keys),
+                'Projection': {'ProjectionType': 'ALL'},
+                'ProvisionedThroughput': pt
+            })
+            for kpair in index_keys:
+                if ':' not in kpair:
+                    kpair += ':S'
+                if kpair not in attributes:
+                    attributes.append(kpair)
+
     for kpair in attributes:
         if ':' not in kpair:
             kpair += ':S'
@@ -120,8 +145,23 @@ def get_queue_messages(queue):
 
 def create_infra():
     create_dynamodb_table('sedo_definition')
-    create_dynamodb_table('sedo_execution')
-    create_queue('sedo_execution-processor-queue')
+    create_dynamodb_table('sedo_definition_version')
+    create_dynamodb_table('sedo_execution', indexes={
+        'active-index': ['tenantId', 'activeState'],
+        'definition-index': ['tenantId', 'definitionId'],
+        'updated-index': ['tenantId', 'updatedAt']
+    })
+    create_dynamodb_table(
+        'sedo_execution_history', keys=['executionId', 'seq:N']
+    )
+    create_dynamodb_table(
+        'sedo_tenant_usage', keys=['tenantId', 'window:N']
+    )
+    create_dynamodb_table('sedo_timer', keys=['bucket', 'id'])
+    for shard in range(4):
+        create_queue('sedo_execution-processor-queue%s' % (
+            '-%d' % shard if shard else ''
+        ))
 
 
 def load_dynamodb_data(table_name, items):
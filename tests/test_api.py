@@ -11,22 +11,41 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
 from moto import mock_dynamodb2
 from moto import mock_sqs
 import os
+import pytest
 import sys
 from tests import helpers as h
+from uuid import uuid4
 
 BASE_PATH = '/sedo/tenants/123'
 FUNC_NAME = 'sedo_api'
 ROOT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)))
 FUNC_DIR = os.path.join(ROOT_PATH, 'functions', FUNC_NAME)
 DATA_PATH = os.path.join(ROOT_PATH, 'tests', 'data', FUNC_NAME)
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
 
 sys.path.append(FUNC_DIR)
+sys.path.append(LAYER_DIR)
 os.chdir(FUNC_DIR)
 
+import api  # noqa: 402
+from build_spec import load_spec  # noqa: 402
 from index import handler  # noqa: 402
+from index import SPEC  # noqa: 402
+from sedo_common import backends  # noqa: 402
+from sedo_common import claimcheck  # noqa: 402
+from sedo_common import codec  # noqa: 402
+
+
+@pytest.fixture(autouse=True)
+def definition_cache():
+    # tests reuse definition IDs
+    api.DEFINITION_CACHE.clear()
+    yield
+    api.DEFINITION_CACHE.clear()
 
 
 def _test_file(file):
@@ -35,6 +54,11 @@ def _test_file(file):
     )
 
 
+def test_spec_in_sync():
+    # api.json is generated from api.yaml by build_spec.py
+    assert h.load_file(SPEC) == json.loads(json.dumps(load_spec()))
+
+
 @mock_dynamodb2
 @mock_sqs
 def test_definition_api():
@@ -47,7 +71,8 @@ def test_definition_api():
     # create definition
     data = h.load_file(_test_file('definition1.yaml'))
     r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', data)
-
+    version = r.json.pop('version')
+    assert len(version) == 64
     assert r.json == {'id': 'definition1', 'tenantId': '123'}
 
     # get definitions
@@ -57,7 +82,260 @@ def test_definition_api():
     # get definition
     data['tenantId'] = '123'
     r = h.invoke(handler, 'GET', BASE_PATH + '/definitions/definition1')
-    assert r.json == data
+    assert r.json == dict(data, version=version)
+
+    # definition version is stored
+    table = h.get_session().resource('dynamodb').Table(
+        'sedo_definition_version'
+    )
+    item = table.get_item(Key={'tenantId': '123', 'id': version})['Item']
+    assert item['definitionId'] == 'definition1'
+
+    # re-creating the same definition keeps the same immutable version
+    data = h.load_file(_test_file('definition1.yaml'))
+    r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', data)
+    assert r.json['version'] == version
+
+    # a definition whose steps don't form a valid graph is rejected
+    data['id'] = 'definition2'
+    data['steps'][0]['next'] = 'missing'
+    r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', data)
+    assert r.status_code == 400
+    assert r.json['title'] == 'invalid definition'
+    assert r.json['detail'] == 'step %s next step missing not found' % (
+        data['steps'][0]['id']
+    )
+    r = h.invoke(handler, 'GET', BASE_PATH + '/definitions/definition2')
+    assert r.status_code == 404
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_conditional_get(monkeypatch):
+    h.create_infra()
+    definition = h.load_file(_test_file('definition1.yaml'))
+    h.invoke(handler, 'POST', BASE_PATH + '/definitions', definition)
+    path = BASE_PATH + '/definitions/definition1'
+
+    # definitions are returned with a strong ETag, and not returned again
+    # while it matches
+    r = h.invoke(handler, 'GET', path)
+    etag = r.headers['ETag']
+    assert etag == api.get_etag(r.json)
+    assert etag.startswith('"') and etag.endswith('"')
+    for header in [etag, 'W/%s' % etag, '"other", %s' % etag, '*']:
+        r = h.invoke(handler, 'GET', path, headers={'If-None-Match': header})
+        assert r.status_code == 304
+        assert r.content == ''
+        assert r.headers['ETag'] == etag
+    r = h.invoke(handler, 'GET', path, headers={'If-None-Match': '"other"'})
+    assert r.status_code == 200
+
+    # executions read the cached definition
+    store = backends.get_store()
+    get_item = store.get_item
+    reads = []
+    monkeypatch.setattr(
+        store, 'get_item',
+        lambda table, key, **kwargs: reads.append(table) or get_item(
+            table, key, **kwargs
+        )
+    )
+    for i in range(3):
+        r = h.invoke(handler, 'POST', path + '/execute', {
+            'input': {'foo': 'bar'}
+        })
+        assert r.status_code == 201
+    assert reads == []
+
+    # writes invalidate the definition
+    definition['steps'][0]['message'] = 'changed'
+    h.invoke(handler, 'POST', BASE_PATH + '/definitions', definition)
+    r = h.invoke(handler, 'GET', path, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.json['steps'][0]['message'] == 'changed'
+    assert r.headers['ETag'] != etag
+    assert reads == ['sedo_definition']
+
+    # cached definitions expire, and are copies
+    key = ('123', 'definition1')
+    assert api.get_cached_definition(*key) == r.json
+    api.get_cached_definition(*key)['steps'] = []
+    assert api.get_cached_definition(*key) == r.json
+    assert api.get_cached_definition(*key, now=api.time.time() + 31) is None
+    assert key not in api.DEFINITION_CACHE
+    monkeypatch.setattr(api, 'DEFINITION_CACHE_SIZE', 1)
+    api.cache_definition({'tenantId': '123', 'id': 'a'})
+    api.cache_definition({'tenantId': '123', 'id': 'b'})
+    assert list(api.DEFINITION_CACHE) == [('123', 'b')]
+
+    # executions are returned with an ETag that changes with them
+    r = h.invoke(handler, 'GET', BASE_PATH + '/executions')
+    path = BASE_PATH + '/executions/' + r.json[0]['id']
+    r = h.invoke(handler, 'GET', path)
+    etag = r.headers['ETag']
+    r = h.invoke(handler, 'GET', path, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    h.get_session().resource('dynamodb').Table('sedo_execution').update_item(
+        Key={'tenantId': '123', 'id': path.split('/')[-1]},
+        UpdateExpression='SET #s = :s',
+        ExpressionAttributeNames={'#s': 'state'},
+        ExpressionAttributeValues={':s': 'ExecutionStarted'}
+    )
+    r = h.invoke(handler, 'GET', path, headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.json['state'] == 'ExecutionStarted'
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_wait_for_execution(monkeypatch):
+    h.create_infra()
+    h.load_dynamodb_data('sedo_execution', [{
+        'tenantId': '123',
+        'id': '123:definition1:abc',
+        'state': 'StepStarted',
+        'revision': 2
+    }])
+    path = BASE_PATH + '/executions/123:definition1:abc'
+    table = h.get_session().resource('dynamodb').Table('sedo_execution')
+
+    # the state alone is read, backing off, until the execution is terminal
+    store = backends.get_store()
+    get_item = store.get_item
+    reads = []
+    monkeypatch.setattr(
+        store, 'get_item',
+        lambda table, key, attributes=None: reads.append(attributes) or (
+            get_item(table, key, attributes=attributes)
+        )
+    )
+
+    class clock(object):
+        now = 1000.0
+        sleeps = []
+
+        @classmethod
+        def time(cls):
+            return cls.now
+
+        @classmethod
+        def sleep(cls, seconds):
+            cls.sleeps.append(seconds)
+            cls.now += seconds
+            if len(cls.sleeps) == 6:
+                table.update_item(
+                    Key={'tenantId': '123', 'id': '123:definition1:abc'},
+                    UpdateExpression='SET #s = :s',
+                    ExpressionAttributeNames={'#s': 'state'},
+                    ExpressionAttributeValues={':s': 'ExecutionSucceeded'}
+                )
+
+    monkeypatch.setattr(api, 'time', clock)
+    r = h.invoke(handler, 'GET', path + '?waitFor=terminal')
+    assert r.status_code == 200
+    assert r.json['state'] == 'ExecutionSucceeded'
+    assert clock.sleeps == [0.1, 0.2, 0.4, 0.8, 1.6, 2]
+    assert reads == [['state']] * 7 + [None]
+
+    # terminal and missing executions return straight away
+    reads.clear()
+    r = h.invoke(handler, 'GET', path + '?waitFor=terminal&timeout=5')
+    assert r.status_code == 200
+    assert len(reads) == 2
+    r = h.invoke(handler, 'GET', path + 'x?waitFor=terminal')
+    assert r.status_code == 404
+
+    # the execution is returned as it is when the timeout is up
+    table.put_item(Item={
+        'tenantId': '123',
+        'id': '123:definition1:abc',
+        'state': 'StepStarted'
+    })
+    clock.sleeps.clear()
+    r = h.invoke(handler, 'GET', path + '?waitFor=terminal&timeout=1')
+    assert r.status_code == 200
+    assert r.json['state'] == 'StepStarted'
+    assert clock.sleeps == pytest.approx([0.1, 0.2, 0.4, 0.3])
+    r = h.invoke(handler, 'GET', path + '?waitFor=terminal&timeout=26')
+    assert r.status_code == 400
+
+    # read failures are reported
+    monkeypatch.setattr(store, 'get_item', None)
+    r = h.invoke(handler, 'GET', path + '?waitFor=terminal')
+    assert r.status_code == 500
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_list_pagination(monkeypatch):
+    h.create_infra()
+    data = h.load_file(_test_file('definition1.yaml'))
+    for i in range(3):
+        data['id'] = 'definition%s' % i
+        h.invoke(handler, 'POST', BASE_PATH + '/definitions', data)
+
+    # first page has a cursor to the next
+    r = h.invoke(handler, 'GET', BASE_PATH + '/definitions?limit=2')
+    assert r.json == [
+        {'id': 'definition0', 'tenantId': '123'},
+        {'id': 'definition1', 'tenantId': '123'}
+    ]
+    cursor = r.headers['X-Next-Cursor']
+
+    # last page has no cursor
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/definitions?limit=2&cursor=' + cursor
+    )
+    assert r.json == [{'id': 'definition2', 'tenantId': '123'}]
+    assert 'X-Next-Cursor' not in r.headers
+
+    # cursors are only valid for their tenant
+    for invalid in ['invalid', cursor.replace('123', '456')]:
+        r = h.invoke(
+            handler, 'GET', '/sedo/tenants/456/definitions?cursor=' + invalid
+        )
+        assert r.status_code == 400
+        assert r.json['title'] == 'invalid cursor'
+
+    # projected fields
+    r = h.invoke(handler, 'GET', BASE_PATH + '/definitions?fields=id,version')
+    assert [sorted(d) for d in r.json] == [['id', 'version']] * 3
+
+    # streamed export
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/definitions?format=ndjson&fields=id'
+    )
+    assert r.headers['Content-Type'] == 'application/x-ndjson'
+    assert r.content.splitlines() == [
+        '{"id": "definition%s"}' % i for i in range(3)
+    ]
+    assert 'X-Next-Cursor' not in r.headers
+
+    # exports are capped, with the cursor of the rest
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/definitions?format=ndjson&limit=1'
+    )
+    assert len(r.content.splitlines()) == 1
+    monkeypatch.setattr(api, 'NDJSON_LIMIT', 2)
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/definitions?format=ndjson&fields=id'
+    )
+    assert len(r.content.splitlines()) == 2
+    r = h.invoke(handler, 'GET', BASE_PATH + (
+        '/definitions?format=ndjson&fields=id&cursor=%s' % (
+            r.headers['X-Next-Cursor']
+        )
+    ))
+    assert r.content.splitlines() == ['{"id": "definition2"}']
+    assert 'X-Next-Cursor' not in r.headers
+    monkeypatch.setattr(api, 'DEFAULT_LIMIT', 1)
+    monkeypatch.setattr(api, 'NDJSON_MAX_BYTES', 1)
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/definitions?format=ndjson&fields=id'
+    )
+    assert len(r.content.splitlines()) == 1
+    assert 'X-Next-Cursor' in r.headers
 
 
 @mock_dynamodb2
@@ -68,6 +346,7 @@ def test_execution_api():
     # create definition
     definition = h.load_file(_test_file('definition1.yaml'))
     r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', definition)
+    version = r.json['version']
 
     # create invalid execution (definition not found)
     data = {'input': {'bar': 'baz'}}
@@ -113,7 +392,7 @@ def test_execution_api():
     )
     execution_id = r.json['id']
     assert execution_id.startswith('123:definition1:')
-    assert len(execution_id) == len('123:definition1:12345678')
+    assert len(execution_id) == len('123:definition1:') + 36
     assert r.json['state'] == 'ExecutionSubmitted'
     assert r.json['tenantId'] == '123'
 
@@ -136,19 +415,316 @@ def test_execution_api():
         'GET',
         BASE_PATH + '/executions/' + execution_id
     )
-    definition['tenantId'] = '123'
     expected = {
         "input": {
             "foo": "bar"
         },
         "state": "ExecutionSubmitted",
         "tenantId": "123",
-        "id": execution_id,
-        'definition': definition
+        "id": execution_id
     }
-    assert r.json == expected
+    assert r.json.pop('createdAt') == r.json.pop('updatedAt')
+    assert r.json == dict(
+        expected,
+        definitionId='definition1',
+        definitionHash=version,
+        revision=0,
+        activeState='ExecutionSubmitted'
+    )
 
     # check dispatched messages on queue
-    expected.pop('definition', None)
     events = h.get_queue_messages('sedo_execution-processor-queue')
-    assert events == [expected]
+    assert events == [dict(expected, definitionHash=version, revision=0)]
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_execution_filters():
+    h.create_infra()
+    h.load_dynamodb_data('sedo_execution', [
+        {
+            'tenantId': '123',
+            'id': '123:a:1',
+            'state': 'StepStarted',
+            'activeState': 'StepStarted',
+            'definitionId': 'a',
+            'updatedAt': '2022-05-01T10:00:00Z'
+        },
+        {
+            'tenantId': '123',
+            'id': '123:a:2',
+            'state': 'ExecutionSucceeded',
+            'definitionId': 'a',
+            'updatedAt': '2022-05-02T10:00:00Z'
+        },
+        {
+            'tenantId': '123',
+            'id': '123:b:1',
+            'state': 'ExecutionSubmitted',
+            'activeState': 'ExecutionSubmitted',
+            'definitionId': 'b',
+            'updatedAt': '2022-05-03T10:00:00Z'
+        },
+        {
+            'tenantId': '123',
+            'id': '123:b:1:map:0',
+            'state': 'StepStarted',
+            'branch': 'map/0',
+            'parent': {'id': '123:b:1', 'revision': 1, 'seq': 1, 'count': 1},
+            'updatedAt': '2022-05-04T10:00:00Z'
+        }
+    ])
+
+    def _ids(qs):
+        r = h.invoke(handler, 'GET', BASE_PATH + '/executions?' + qs)
+        assert r.status_code == 200
+        return sorted([e['id'] for e in r.json])
+
+    # sub-executions are not listed
+    assert _ids('') == ['123:a:1', '123:a:2', '123:b:1']
+    assert _ids('state=active') == ['123:a:1', '123:b:1']
+    assert _ids('state=StepStarted') == ['123:a:1']
+    assert _ids('state=ExecutionSucceeded') == ['123:a:2']
+    assert _ids('definitionId=a') == ['123:a:1', '123:a:2']
+    assert _ids('since=2022-05-02') == ['123:a:2', '123:b:1']
+    assert _ids('state=active&definitionId=b') == ['123:b:1']
+    assert _ids('definitionId=a&since=2022-05-02') == ['123:a:2']
+
+    # only indexed attributes can be returned when filtering
+    r = h.invoke(
+        handler, 'GET', BASE_PATH + '/executions?state=active&fields=input'
+    )
+    assert r.status_code == 400
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_execution_batch_api(monkeypatch):
+    h.create_infra()
+    definition = h.load_file(_test_file('definition1.yaml'))
+    h.invoke(handler, 'POST', BASE_PATH + '/definitions', definition)
+
+    # definition not found
+    data = {'inputs': [{'foo': 'bar'}]}
+    r = h.invoke(
+        handler, 'POST', BASE_PATH + '/definitions/invalid/execute-batch', data
+    )
+    assert r.status_code == 404
+
+    # results are per input, in order
+    inputs = [{'foo': str(i)} for i in range(30)]
+    inputs[3] = {'bar': 'baz'}
+    r = h.invoke(
+        handler,
+        'POST',
+        BASE_PATH + '/definitions/definition1/execute-batch',
+        {'inputs': inputs}
+    )
+    assert r.status_code == 200
+    results = r.json['results']
+    assert len(results) == 30
+    assert results[3]['status'] == 400
+    assert results[3]['title'] == 'input does not pass inputSchema validation'
+    created = [x for i, x in enumerate(results) if i != 3]
+    assert all([x['state'] == 'ExecutionSubmitted' for x in created])
+    assert len(set([x['id'] for x in created])) == 29
+
+    # executions written and events dispatched
+    r = h.invoke(handler, 'GET', BASE_PATH + '/executions?fields=id')
+    assert sorted([x['id'] for x in r.json]) == sorted(
+        [x['id'] for x in created]
+    )
+    sqs = h.get_session().client('sqs')
+    attributes = sqs.get_queue_attributes(
+        QueueUrl=h.get_queue_url('sedo_execution-processor-queue'),
+        AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '29'
+
+    # inputs whose executions remain unprocessed are reported, and their
+    # events are not sent
+    store = backends.get_store()
+    batch_write = store.batch_write
+
+    def _batch_write(table, items):
+        batch_write(table, items[:1])
+        return items[1:]
+
+    monkeypatch.setattr(store, 'batch_write', _batch_write)
+    r = h.invoke(
+        handler,
+        'POST',
+        BASE_PATH + '/definitions/definition1/execute-batch',
+        {'inputs': [{'foo': 'a'}, {'foo': 'b'}]}
+    )
+    assert r.status_code == 200
+    (created, unprocessed) = r.json['results']
+    assert created['state'] == 'ExecutionSubmitted'
+    assert unprocessed['status'] == 500
+    assert unprocessed['title'] == 'unable to create execution'
+    attributes = sqs.get_queue_attributes(
+        QueueUrl=h.get_queue_url('sedo_execution-processor-queue'),
+        AttributeNames=['ApproximateNumberOfMessages']
+    )['Attributes']
+    assert attributes['ApproximateNumberOfMessages'] == '30'
+    monkeypatch.setattr(store, 'batch_write', batch_write)
+
+    # an existing execution is never overwritten
+    class uuid(object):
+        def __init__(self, value):
+            self.value = value
+
+        def __str__(self):
+            return self.value
+
+    monkeypatch.setattr(api, 'uuid4', lambda: uuid('same'))
+    for status in [201, 409]:
+        r = h.invoke(
+            handler, 'POST', BASE_PATH + '/definitions/definition1/execute',
+            {'input': {'foo': 'c'}}
+        )
+        assert r.status_code == status
+    assert r.json['title'] == 'execution already exists'
+
+    # executions whose events can't be sent are reported and removed
+    monkeypatch.setattr(api, 'uuid4', lambda: uuid(str(uuid4())))
+    queue = backends.get_queue()
+
+    def _send_message_batch(queue_name, entries):
+        raise Exception('unavailable')
+
+    monkeypatch.setattr(queue, 'send_message_batch', _send_message_batch)
+    monkeypatch.setattr(queue, 'send_message', _send_message_batch)
+    r = h.invoke(
+        handler,
+        'POST',
+        BASE_PATH + '/definitions/definition1/execute-batch',
+        {'inputs': [{'foo': 'a'}, {'foo': 'b'}]}
+    )
+    assert r.status_code == 200
+    results = r.json['results']
+    assert [x['status'] for x in results] == [500, 500]
+    r = h.invoke(
+        handler, 'POST', BASE_PATH + '/definitions/definition1/execute',
+        {'input': {'foo': 'c'}}
+    )
+    assert r.status_code == 500
+    r = h.invoke(handler, 'GET', BASE_PATH + '/executions?fields=id')
+    assert len(r.json) == 31
+
+
+def test_memory_backend(monkeypatch):
+    # the API runs against the in-memory backend without AWS
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    try:
+        data = h.load_file(_test_file('definition1.yaml'))
+        r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', data)
+        assert r.status_code == 201
+        r = h.invoke(
+            handler, 'POST', BASE_PATH + '/definitions/definition1/execute',
+            {'input': {'foo': 'bar'}}
+        )
+        assert r.status_code == 201
+        id = r.json['id']
+        r = h.invoke(handler, 'GET', BASE_PATH + '/executions?state=active')
+        assert [x['id'] for x in r.json] == [id]
+
+        # parallel steps nest branches of steps
+        echo = {'id': 'echo', 'type': 'echo', 'end': True}
+        parallel = {
+            'id': 'fan-out', 'type': 'parallel', 'maxConcurrency': 2,
+            'branches': [{'steps': [echo]}, {'steps': [dict(
+                echo, type='parallel', branches=[{'steps': [echo]}]
+            )]}],
+            'end': True
+        }
+        r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', dict(
+            data, id='definition2', steps=[parallel]
+        ))
+        assert r.status_code == 201
+        r = h.invoke(handler, 'POST', BASE_PATH + '/definitions', dict(
+            data, id='definition3', steps=[dict(parallel, branches=[{
+                'steps': [dict(echo, type='unknown')]
+            }])]
+        ))
+        assert r.status_code == 400
+        records = backends.get_queue().receive_messages(
+            'sedo_execution-processor-queue'
+        )
+        assert [json.loads(x['body'])['id'] for x in records] == [id]
+
+        # large inputs are stored as claim checks, and loaded when read
+        monkeypatch.setattr(claimcheck, 'THRESHOLD', 100)
+        input = {'foo': 'x' * 200}
+        r = h.invoke(
+            handler, 'POST', BASE_PATH + '/definitions/definition1/execute',
+            {'input': input}
+        )
+        id = r.json['id']
+        item = backends.get_store().get_item(
+            'sedo_execution', {'tenantId': '123', 'id': id}
+        )
+        assert claimcheck.is_ref(item['input'])
+        (record,) = backends.get_queue().receive_messages(
+            'sedo_execution-processor-queue'
+        )
+        assert json.loads(record['body'])['input'] == item['input']
+        r = h.invoke(handler, 'GET', BASE_PATH + '/executions/' + id)
+        assert r.json['input'] == input
+
+        # with a codec set payloads and messages are encoded, and returned
+        # as JSON
+        monkeypatch.setattr(codec, 'CODEC', 'msgpack+zlib')
+        monkeypatch.setattr(codec, 'MIN_BYTES', 0)
+        r = h.invoke(
+            handler, 'POST', BASE_PATH + '/definitions/definition1/execute',
+            {'input': {'foo': 'baz'}}
+        )
+        id = r.json['id']
+        item = backends.get_store().get_item(
+            'sedo_execution', {'tenantId': '123', 'id': id}
+        )
+        assert codec.is_encoded(item['input'])
+        (record,) = backends.get_queue().receive_messages(
+            'sedo_execution-processor-queue'
+        )
+        assert codec.decode_body(record['body'])['input'] == {'foo': 'baz'}
+        r = h.invoke(handler, 'GET', BASE_PATH + '/executions/' + id)
+        assert r.json['input'] == {'foo': 'baz'}
+    finally:
+        backends.reset()
+
+
+def test_execution_history(monkeypatch):
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    try:
+        id = '123:definition1:abc'
+        backends.get_store().batch_write('sedo_execution_history', [{
+            'executionId': id,
+            'seq': seq,
+            'tenantId': '123',
+            'state': 'StepStarted'
+        } for seq in range(1, 6)])
+        path = BASE_PATH + '/executions/%s/history' % id
+
+        # transitions in sequence order, a page at a time
+        r = h.invoke(handler, 'GET', path + '?limit=3')
+        assert r.status_code == 200
+        assert [x['seq'] for x in r.json] == [1, 2, 3]
+        cursor = r.headers['X-Next-Cursor']
+        r = h.invoke(handler, 'GET', path + '?limit=3&cursor=' + cursor)
+        assert [x['seq'] for x in r.json] == [4, 5]
+        assert 'X-Next-Cursor' not in r.headers
+        r = h.invoke(handler, 'GET', path + '?cursor=abc')
+        assert r.status_code == 400
+
+        # only the tenant's own history is returned
+        r = h.invoke(
+            handler, 'GET', path.replace('/tenants/123/', '/tenants/456/')
+        )
+        assert r.status_code == 200
+        assert r.json == []
+    finally:
+        backends.reset()
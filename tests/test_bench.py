@@ -0,0 +1,87 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from bench import codec
+from bench import startup
+from bench import throughput
+from sedo_common import scheduling
+import pytest
+
+
+def test_startup():
+    results = startup.run(['processor'], runs=1)
+    assert set(results['processor'].keys()) == set(startup.METRICS)
+    assert results['processor']['import']['p50'] > 0
+    budgets = startup.parse_budgets(['processor:import=0'])
+    errors = startup.check_budgets(results, budgets)
+    assert len(errors) == 1
+    assert startup.check_budgets(
+        results, startup.parse_budgets(['processor:first=100000'])
+    ) == []
+    with pytest.raises(Exception, match='invalid budget'):
+        startup.parse_budgets(['processor:nope=1'])
+
+
+def test_codec():
+    results = codec.run([1024], ['msgpack', 'json+zlib'], runs=2)
+    (result,) = results['sizes']
+    assert result['size'] >= 1024
+    assert list(result['codecs'].keys()) == ['none', 'msgpack', 'json+zlib']
+    assert result['codecs']['none']['ratio'] == 1
+    assert result['codecs']['json+zlib']['ratio'] < 1
+    assert result['codecs']['msgpack']['encode_us']['p50'] > 0
+
+
+def test_definition_generator():
+    definition = throughput.get_definition(4, wait_ratio=0.5)
+    assert [x['type'] for x in definition['steps']] == [
+        'echo', 'wait', 'echo', 'wait'
+    ]
+    assert definition['steps'][-1]['end'] is True
+    assert throughput.get_step_id(26) == 'step-aa'
+
+
+def test_throughput():
+    results = throughput.run(executions=20, steps=3, input_size=10)
+    assert results['completed'] == 20
+    # started, three steps and succeeded are chained in a single write
+    assert results['transitions'] == 20 * 4
+    assert results['calls_per_execution']['store.update_item'] == 1
+    assert set(results['latency_ms']['transition'].keys()) == set([
+        'p50', 'p95', 'p99', 'max'
+    ])
+    assert throughput.compare(results, results) == []
+    slower = dict(results, transitions_per_second=(
+        results['transitions_per_second'] * 2
+    ))
+    assert throughput.compare(results, slower) == [
+        'transitions_per_second regressed from %s to %s' % (
+            slower['transitions_per_second'],
+            results['transitions_per_second']
+        )
+    ]
+
+
+def test_throughput_quota(monkeypatch):
+    # usage is counted, through the recorded store, rather than failing open
+    errors = []
+    monkeypatch.setattr(
+        scheduling.telemetry, 'error', lambda *args, **kwargs: errors.append(
+            args
+        )
+    )
+    monkeypatch.setattr(scheduling, 'QUOTA', 1000)
+    results = throughput.run(executions=20, steps=3)
+    assert results['completed'] == 20
+    assert errors == []
+    assert results['calls_per_execution']['store.update_item'] > 1
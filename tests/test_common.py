@@ -0,0 +1,535 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+from boto3.dynamodb.conditions import Attr
+from boto3.dynamodb.conditions import Key
+from moto import mock_dynamodb2
+from moto import mock_s3
+from moto import mock_sqs
+import os
+import json
+import pytest
+import sys
+from tests import helpers as h
+import threading
+import time
+
+ROOT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)))
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
+
+sys.path.append(LAYER_DIR)
+
+from sedo_common import aws  # noqa: 402
+from sedo_common import backends  # noqa: 402
+from sedo_common import batch  # noqa: 402
+from sedo_common import claimcheck  # noqa: 402
+from sedo_common import codec  # noqa: 402
+from sedo_common import scheduling  # noqa: 402
+from sedo_common import telemetry  # noqa: 402
+from sedo_common import validation  # noqa: 402
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_aws_pool():
+    aws.reset()
+    h.create_infra()
+
+    # sessions and clients are shared
+    assert aws.get_session() is aws.get_session()
+    assert aws.get_client('sqs') is aws.get_client('sqs')
+
+    # tables are reused within a thread, but not shared between threads
+    table = aws.get_table('sedo_execution')
+    assert aws.get_table('sedo_execution') is table
+    tables = []
+    t = threading.Thread(
+        target=lambda: tables.append(aws.get_table('sedo_execution'))
+    )
+    t.start()
+    t.join()
+    assert tables[0] is not table
+
+    # queue url is only looked up once
+    url = aws.get_queue_url('sedo_execution-processor-queue')
+    assert url.endswith('/sedo_execution-processor-queue')
+    aws.POOL['queue_urls']['sedo_execution-processor-queue'] = 'cached'
+    assert aws.get_queue_url('sedo_execution-processor-queue') == 'cached'
+
+    # reset drops everything
+    aws.reset()
+    assert aws.get_table('sedo_execution') is not table
+    assert aws.get_queue_url('sedo_execution-processor-queue') == url
+
+
+def test_validation_cache(monkeypatch):
+    monkeypatch.setattr(validation, 'CACHE_SIZE', 2)
+    validation.VALIDATORS.clear()
+    schema = {
+        'type': 'object',
+        'properties': {'foo': {'type': 'string'}},
+        'required': ['foo']
+    }
+    validation.validate({'foo': 'bar'}, schema)
+    with pytest.raises(Exception) as e:
+        validation.validate({}, schema)
+    assert e.value.message == "'foo' is a required property"
+
+    # one compiled validator per schema, least recently used evicted
+    validator = validation.get_validator(schema)
+    assert validation.get_validator(dict(schema)) is validator
+    validation.validate('x', {'type': 'string'}, 'string')
+    validation.get_validator(schema)
+    validation.validate(1, {'type': 'number'}, 'number')
+    assert list(validation.VALIDATORS) == [
+        validation.get_schema_hash(schema), 'number'
+    ]
+
+    # invalid schemas are rejected
+    with pytest.raises(Exception):
+        validation.validate({}, {'type': 'invalid'})
+
+
+def test_send_message_batch(monkeypatch):
+    calls = []
+
+    class client(object):
+        def send_message_batch(self, QueueUrl, Entries):
+            calls.append([e['Id'] for e in Entries])
+            if len(calls) == 1:
+                return {'Failed': [
+                    {'Id': '1', 'SenderFault': False},
+                    {'Id': '2', 'SenderFault': True}
+                ]}
+            return {'Failed': [
+                {'Id': e['Id'], 'SenderFault': False}
+                for e in Entries if e['Id'] == '1'
+            ]}
+
+    monkeypatch.setattr(batch, 'get_client', lambda name: client())
+    monkeypatch.setattr(batch, 'get_queue_url', lambda name: 'url')
+    monkeypatch.setattr(batch, 'backoff', lambda attempt: None)
+    entries = [{'Id': str(i), 'MessageBody': '{}'} for i in range(12)]
+
+    # sender faults are not retried, others are retried until max attempts
+    failed = batch.send_message_batch('queue', entries, max_attempts=3)
+    assert [e['Id'] for e in failed] == ['2', '1']
+    assert calls[0] == [str(i) for i in range(10)]
+    assert calls[1:3] == [['1'], ['1']]
+    assert calls[3] == ['10', '11']
+
+    # chunks are limited by total size, a failed request fails its entries
+    def fail(QueueUrl, Entries):
+        calls.append([e['Id'] for e in Entries])
+        raise Exception('batch too long')
+
+    calls.clear()
+    body = 'x' * (100 * 1024)
+    entries = [{'Id': str(i), 'MessageBody': body} for i in range(5)]
+    assert [len(c) for c in batch.message_chunks(entries)] == [2, 2, 1]
+    entries[0]['MessageBody'] = 'x' * (batch.MESSAGE_BATCH_BYTES + 1)
+    assert [len(c) for c in batch.message_chunks(entries)] == [1, 2, 2]
+    monkeypatch.setattr(client, 'send_message_batch', lambda self, **kwargs: (
+        fail(**kwargs)
+    ))
+    failed = batch.send_message_batch('queue', entries, max_attempts=3)
+    assert [e['Id'] for e in failed] == ['0', '1', '2', '3', '4']
+    assert calls == [['0'], ['1', '2'], ['3', '4']]
+
+
+def test_batch_write(monkeypatch):
+    calls = []
+
+    class resource(object):
+        def batch_write_item(self, RequestItems):
+            requests = RequestItems['table']
+            calls.append(len(requests))
+            # first item of each request is left unprocessed once
+            if len(calls) == 1:
+                return {'UnprocessedItems': {'table': requests[:1]}}
+            return {}
+
+    monkeypatch.setattr(batch, 'get_resource', lambda name: resource())
+    monkeypatch.setattr(batch, 'backoff', lambda attempt: None)
+    items = [{'id': str(i)} for i in range(30)]
+    assert batch.batch_write('table', items) == []
+    assert calls == [25, 1, 5]
+    calls.clear()
+    assert batch.batch_write('table', items, max_attempts=1) == [items[0]]
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'aws'])
+def backend(request, tmp_path):
+    mocks = []
+    if request.param == 'aws':
+        mocks = [mock_dynamodb2(), mock_sqs()]
+        for m in mocks:
+            m.start()
+        aws.reset()
+        h.create_infra()
+    elif request.param == 'sqlite':
+        os.environ['SEDO_SQLITE_PATH'] = str(tmp_path / 'sedo.sqlite')
+    os.environ['SEDO_BACKEND'] = request.param
+    try:
+        yield (
+            request.param,
+            backends.create('store', request.param),
+            backends.create('queue', request.param)
+        )
+    finally:
+        os.environ.pop('SEDO_BACKEND')
+        os.environ.pop('SEDO_SQLITE_PATH', None)
+        for m in mocks:
+            m.stop()
+
+
+def test_store(backend):
+    (name, store, _) = backend
+    table = 'sedo_execution'
+
+    # items are read back as JSON types, optionally projected
+    item = {'tenantId': 't1', 'id': 'a', 'state': 'x', 'count': 1}
+    store.put_item(table, item)
+    assert store.get_item(table, {'tenantId': 't1', 'id': 'a'}) == item
+    assert store.get_item(
+        table, {'tenantId': 't1', 'id': 'a'}, ['id', 'count']
+    ) == {'id': 'a', 'count': 1}
+    assert store.get_item(table, {'tenantId': 't1', 'id': 'b'}) is None
+
+    # binary attributes, such as encoded payloads, are read back as bytes
+    store.put_item(table, {'tenantId': 't1', 'id': 'b', 'input': b'\xd5\x01'})
+    assert store.get_item(table, {'tenantId': 't1', 'id': 'b'}) == {
+        'tenantId': 't1', 'id': 'b', 'input': b'\xd5\x01'
+    }
+    store.delete_item(table, {'tenantId': 't1', 'id': 'b'})
+
+    # conditional writes
+    with pytest.raises(backends.ConditionFailed):
+        store.put_item(table, item, condition=Attr('id').not_exists())
+    key = {'tenantId': 't1', 'id': 'a'}
+    store.update_item(
+        table, key, {'count': 2, 'step': 's'},
+        condition=Attr('count').eq(1) | Attr('count').not_exists()
+    )
+    with pytest.raises(backends.ConditionFailed):
+        store.update_item(
+            table, key, {'count': 3}, condition=Attr('count').eq(1)
+        )
+    store.update_item(table, key, {}, remove=['step'])
+    assert store.get_item(table, key) == dict(item, count=2)
+
+    # atomic adds return the updated values, adding to a set is idempotent
+    assert store.update_item(
+        table, key, {}, add={'count': 3, 'joined': {2}}
+    ) == {'count': 5, 'joined': [2]}
+    assert store.update_item(
+        table, key, {'state': 'y'}, add={'joined': {0, 2}},
+        condition=Attr('count').eq(5)
+    ) == {'joined': [0, 2]}
+    with pytest.raises(backends.ConditionFailed):
+        store.update_item(
+            table, key, {}, add={'joined': {1}}, condition=Attr('count').eq(1)
+        )
+    assert store.get_item(table, key) == dict(
+        item, count=5, state='y', joined=[0, 2]
+    )
+    store.delete_item(table, key)
+    assert store.get_item(table, key) is None
+
+    # queries page in key order, limit applies before the filter, and
+    # indexes are sparse
+    items = [{
+        'tenantId': 't1',
+        'id': '%02d' % i,
+        'state': 'even' if i % 2 == 0 else 'odd',
+        'updatedAt': '2022-01-%02d' % (10 - i)
+    } for i in range(5)]
+    items[0]['activeState'] = 'even'
+    assert store.batch_write(table, items + [
+        dict(items[0], tenantId='t2')
+    ]) == []
+    (page, start_key) = store.query(table, Key('tenantId').eq('t1'), limit=3)
+    assert [x['id'] for x in page] == ['00', '01', '02']
+    (page, start_key) = store.query(
+        table, Key('tenantId').eq('t1'), limit=3, start_key=start_key
+    )
+    assert [x['id'] for x in page] == ['03', '04']
+    assert start_key is None
+    (page, start_key) = store.query(
+        table, Key('tenantId').eq('t1'), filter=Attr('state').eq('odd'),
+        attributes=['id'], limit=2
+    )
+    assert page == [{'id': '01'}]
+    assert start_key is not None
+    (page, _) = store.query(
+        table, Key('tenantId').eq('t1') & Key('updatedAt').gte('2022-01-07'),
+        index='updated-index'
+    )
+    assert [x['id'] for x in page] == ['03', '02', '01', '00']
+    (page, _) = store.query(
+        table, Key('tenantId').eq('t1'), index='active-index'
+    )
+    assert [x['id'] for x in page] == ['00']
+    store.batch_delete(table, [
+        {'tenantId': 't1', 'id': x['id']} for x in items
+    ])
+    assert store.query(table, Key('tenantId').eq('t1')) == ([], None)
+
+
+def test_queue(backend):
+    (name, _, queue) = backend
+    name_ = 'sedo_execution-processor-queue'
+    queue.send_message(name_, {
+        'MessageBody': '{"a": 1}',
+        'MessageAttributes': {
+            'sedoSource': {'DataType': 'String', 'StringValue': 'processor'}
+        }
+    })
+    assert queue.send_message_batch(name_, [
+        {'Id': '0', 'MessageBody': '{"b": 2}'}
+    ]) == []
+    assert queue.get_size(name_) == 2
+
+    # received as Lambda event records, until deleted
+    records = queue.receive_messages(name_)
+    assert sorted([r['body'] for r in records]) == [
+        '{"a": 1}', '{"b": 2}'
+    ]
+    record = [r for r in records if r['body'] == '{"a": 1}'][0]
+    assert record['attributes']['ApproximateReceiveCount'] == '1'
+    assert int(record['attributes']['SentTimestamp']) > 0
+    assert record['messageAttributes']['sedoSource'] == {
+        'stringValue': 'processor', 'dataType': 'String'
+    }
+    assert queue.receive_messages(name_) == []
+    queue.delete_messages(name_, records)
+    assert queue.get_size(name_) == 0
+    if name == 'aws':
+        return
+
+    # delayed messages, and redelivery after the visibility timeout
+    queue.visibility_timeout = 0
+    queue.send_message(name_, {'MessageBody': '{}', 'DelaySeconds': 1})
+    assert queue.receive_messages(name_) == []
+    time.sleep(1.1)
+    assert len(queue.receive_messages(name_)) == 1
+    records = queue.receive_messages(name_)
+    assert records[0]['attributes']['ApproximateReceiveCount'] == '2'
+    queue.delete_messages(name_, records)
+    assert queue.get_size(name_) == 0
+
+
+def test_backend_selection(monkeypatch):
+    backends.reset()
+    assert type(backends.get_store()).__name__ == 'DynamoDBStore'
+    assert backends.get_queue() is backends.get_queue()
+    backends.reset()
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    assert type(backends.get_store()).__name__ == 'MemoryStore'
+    backends.reset()
+    monkeypatch.setenv('SEDO_BACKEND', 'nope')
+    with pytest.raises(Exception) as e:
+        backends.get_queue()
+    assert str(e.value) == 'unknown backend nope'
+    backends.reset()
+
+
+def test_telemetry(monkeypatch, capsys):
+    def lines():
+        return [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+
+    # log lines are JSON, filtered by level
+    monkeypatch.setattr(telemetry, 'LOG_LEVEL', telemetry.LEVELS['INFO'])
+    telemetry.debug('hidden')
+    telemetry.info('shown', foo='bar', empty=None)
+    (line,) = lines()
+    assert (line['level'], line['message'], line['foo']) == (
+        'INFO', 'shown', 'bar'
+    )
+    assert 'empty' not in line
+
+    # payloads are only logged for sampled records, and truncated
+    monkeypatch.setattr(telemetry, 'PAYLOAD_MAX_BYTES', 10)
+    monkeypatch.setattr(telemetry, 'PAYLOAD_SAMPLE_RATE', 0)
+    with telemetry.record(executionId='a'):
+        assert telemetry.payload({'a': 1}) is None
+    monkeypatch.setattr(telemetry, 'PAYLOAD_SAMPLE_RATE', 1)
+    with telemetry.record(executionId='a'):
+        assert telemetry.payload({'a': 1}) == '{"a": 1}'
+        assert telemetry.payload('x' * 20) == 'x' * 10 + '...(20 bytes)'
+    assert telemetry.payload({'a': 1}) is None
+
+    # metrics of a record are written in embedded metric format, with the
+    # record properties on its log lines
+    with telemetry.record(executionId='a') as metrics:
+        with metrics.time('ReadTime', 'StoreCalls'):
+            pass
+        telemetry.get_metrics().add('PayloadBytes', 10, 'Bytes')
+        telemetry.get_metrics().add('PayloadBytes', 5, 'Bytes')
+        telemetry.warning('inside')
+    (log, emf) = lines()
+    assert log['executionId'] == 'a'
+    assert emf['executionId'] == 'a'
+    assert emf['PayloadBytes'] == 15
+    assert emf['StoreCalls'] == 1
+    assert emf['ReadTime'] >= 0
+    definition = emf['_aws']['CloudWatchMetrics'][0]
+    assert definition['Dimensions'] == [['Service']]
+    assert {m['Name']: m['Unit'] for m in definition['Metrics']} == {
+        'ReadTime': 'Milliseconds', 'StoreCalls': 'Count',
+        'PayloadBytes': 'Bytes'
+    }
+
+    # nothing is collected outside a record
+    telemetry.get_metrics().add('PayloadBytes', 1)
+    with telemetry.record():
+        pass
+    assert lines() == []
+    telemetry.get_metrics().properties.update({'state': 'ExecutionFailed'})
+    telemetry.info('unrelated')
+    assert 'state' not in lines()[0]
+
+
+def test_claimcheck(monkeypatch):
+    from sedo_common.backends.memory import MemoryBlobStore
+    blobs = MemoryBlobStore()
+    backends.set_backend(blobs=blobs)
+    claimcheck.CACHE.clear()
+    try:
+        # small payloads are kept inline
+        assert claimcheck.offload({'a': 1}, 't1') == {'a': 1}
+        assert claimcheck.offload(None, 't1') is None
+
+        # large ones are stored once by hash and referenced
+        value = {'data': 'x' * 100}
+        ref = claimcheck.offload(value, 't1', threshold=50)
+        assert claimcheck.is_ref(ref)
+        assert ref['$sedoRef'] == 't1/%s' % ref['sha256']
+        assert ref['size'] == len(blobs.blobs[ref['$sedoRef']])
+        assert claimcheck.offload(ref, 't1', threshold=50) is ref
+        obj = {'input': value, 'stash': {'a': 1}}
+        claimcheck.offload_fields(obj, ['input', 'stash', 'x'], 't1', 50)
+        assert obj == {'input': ref, 'stash': {'a': 1}}
+
+        # loaded from the cache, or the blob store and checked
+        assert claimcheck.load({'a': 1}) == {'a': 1}
+        assert claimcheck.load(ref) == value
+        claimcheck.CACHE.clear()
+        assert claimcheck.load(ref) == value
+        claimcheck.CACHE.clear()
+        blobs.blobs[ref['$sedoRef']] = b'{}'
+        with pytest.raises(Exception) as e:
+            claimcheck.load(ref)
+        assert str(e.value) == 'payload %s does not match its hash' % (
+            ref['$sedoRef']
+        )
+    finally:
+        backends.reset()
+        claimcheck.CACHE.clear()
+
+
+def test_codec(monkeypatch):
+    value = {'data': ['x' * 10, 1, 2.5, True, None, {'a': 'b'}]}
+    for name in codec.CODECS:
+        encoded = codec.encode(value, name, min_bytes=0)
+        assert codec.is_encoded(encoded)
+        assert encoded[:3] == bytes([0xd5, 1, codec.CODECS[name][0]])
+        assert codec.decode(encoded) == value
+        # encoded values are not encoded again
+        assert codec.encode(encoded, name) is encoded
+
+    # opt-in, and values below the minimum size are left as they are
+    assert codec.CODEC == ''
+    assert codec.encode(value) is value
+    assert codec.encode(value, 'msgpack') is value
+    assert codec.encode(None, 'msgpack', min_bytes=0) is None
+    with pytest.raises(Exception) as e:
+        codec.encode(value, 'xml', min_bytes=0)
+    assert str(e.value) == 'unknown codec xml'
+    with pytest.raises(Exception) as e:
+        codec.decode(b'\xd5\x02\x01{}')
+    assert str(e.value) == 'unsupported encoding 2/1'
+
+    # plain and encoded attributes coexist whatever the codec
+    item = {
+        'id': 'a', 'input': value,
+        'output': codec.encode(value, 'msgpack+zlib', min_bytes=0)
+    }
+    assert codec.decode_fields(dict(item)) == {
+        'id': 'a', 'input': value, 'output': value
+    }
+    assert codec.encode_fields(dict(item), ['input', 'x'], 'json+zlib')[
+        'input'
+    ] == codec.encode(value, 'json+zlib')
+
+    # message bodies are text, and plain JSON bodies are still read
+    monkeypatch.setattr(codec, 'MIN_BYTES', 0)
+    body = codec.encode_body(value, codec='msgpack+zstd')
+    assert body.startswith('sedo:')
+    assert codec.decode_body(body) == value
+    assert codec.encode_body(value) == json.dumps(value)
+    assert codec.decode_body(json.dumps(value)) == value
+
+
+@mock_s3
+def test_blob_stores(tmp_path):
+    from sedo_common.backends.aws import S3BlobStore
+    from sedo_common.backends.sqlite import FileBlobStore
+    aws.reset()
+    h.get_session().client('s3').create_bucket(Bucket='sedo-blobs')
+    for blobs in [S3BlobStore(), FileBlobStore(str(tmp_path))]:
+        blobs.put('t1/abc', b'data')
+        assert blobs.get('t1/abc') == b'data'
+        with pytest.raises(KeyError):
+            blobs.get('t1/missing')
+    with pytest.raises(Exception) as e:
+        FileBlobStore(str(tmp_path)).put('../escape', b'')
+    assert str(e.value) == 'invalid blob key ../escape'
+    aws.reset()
+
+
+def test_scheduling(monkeypatch):
+    # tenants are spread across the shards, shard 0 keeps the queue name
+    assert scheduling.get_queue_name('123') == scheduling.QUEUE_NAME
+    assert scheduling.get_queue_name() == scheduling.QUEUE_NAME
+    names = scheduling.get_queue_names(4)
+    assert names[0] == 'sedo_execution-processor-queue'
+    assert names[3] == 'sedo_execution-processor-queue-3'
+    shards = [scheduling.get_shard('t%d' % i, 4) for i in range(100)]
+    assert set(shards) == set(range(4))
+    assert scheduling.get_shard('t1', 4) == scheduling.get_shard('t1', 4)
+    assert scheduling.get_queue_name('t1', 4) == names[shards[1]]
+
+    # without a quota every event is admitted and usage is not counted
+    from sedo_common.backends.memory import MemoryStore
+    store = MemoryStore()
+    backends.set_backend(store=store)
+    try:
+        assert scheduling.admit('t1', 10) == (10, 0)
+        assert len(store.tables) == 0
+
+        # the quota is per window, scaled by the tenant's weight
+        monkeypatch.setattr(scheduling, 'QUOTA', 1)
+        monkeypatch.setattr(scheduling, 'WEIGHTS', {'t2': 2, '*': 0.5})
+        assert scheduling.get_limit('t1') == 5
+        assert scheduling.get_limit('t2') == 20
+        assert scheduling.admit('t1', 3, now=1000) == (3, 0)
+        (admitted, delay) = scheduling.admit('t1', 3, now=1001)
+        assert admitted == 2
+        assert 9 <= delay <= 20
+        assert scheduling.admit('t1', 1, now=1009)[0] == 0
+        assert scheduling.admit('t1', 5, now=1010) == (5, 0)
+        assert scheduling.admit('t2', 20, now=1001) == (20, 0)
+        assert scheduling.admit('t1', 0, now=1001) == (0, 0)
+    finally:
+        backends.reset()
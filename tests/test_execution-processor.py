@@ -11,10 +11,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+from boto3.dynamodb.conditions import Key
 import json
 from moto import mock_dynamodb2
 from moto import mock_sqs
 import os
+import pytest
 import sys
 from tests import helpers as h
 import time
@@ -23,12 +25,36 @@ FUNC_NAME = 'sedo_execution-processor'
 ROOT_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)))
 FUNC_DIR = os.path.join(ROOT_PATH, 'functions', FUNC_NAME)
 DATA_PATH = os.path.join(ROOT_PATH, 'tests', 'data', FUNC_NAME)
+LAYER_DIR = os.path.join(ROOT_PATH, 'layers', 'sedo_common')
 
 sys.path.append(FUNC_DIR)
+sys.path.append(LAYER_DIR)
 os.chdir(FUNC_DIR)
 
+import processor  # noqa: 402
+from processor import compile_definition  # noqa: 402
+from processor import DEFINITION_CACHE  # noqa: 402
+from processor import get_compiled_definition  # noqa: 402
 from processor import get_execution  # noqa: 402
+from processor import process_event  # noqa: 402
 from processor import sqs_handler  # noqa: 402
+from processor import timer_handler  # noqa: 402
+from sedo_common import aws  # noqa: 402
+from sedo_common import backends  # noqa: 402
+from sedo_common import claimcheck  # noqa: 402
+from sedo_common import codec  # noqa: 402
+from sedo_common import scheduling  # noqa: 402
+from sedo_common.backends import get_queue  # noqa: 402
+from timers import fire_timers  # noqa: 402
+from timers import get_bucket  # noqa: 402
+
+
+@pytest.fixture(autouse=True)
+def dedupe_cache():
+    # tests reuse execution IDs
+    processor.DEDUPE_CACHE.clear()
+    yield
+    processor.DEDUPE_CACHE.clear()
 
 
 def _test_file(file):
@@ -37,14 +63,50 @@ def _test_file(file):
     )
 
 
-def get_sqs_event(event):
+def get_sqs_event(*events, source=None, receive_count=1):
+    records = [{
+        'messageId': 'message-%s' % i,
+        'body': json.dumps(event) if isinstance(event, dict) else event,
+        'attributes': {'ApproximateReceiveCount': str(receive_count)}
+    } for i, event in enumerate(events)]
+    if source is not None:
+        for record in records:
+            record['messageAttributes'] = {
+                'sedoSource': {'stringValue': source, 'dataType': 'String'}
+            }
     return {
-        'Records': [{
-            'body': json.dumps(event)
-        }]
+        'Records': records
     }
 
 
+def process(event, **kwargs):
+    return process_event(json.loads(json.dumps(event)), **kwargs)
+
+
+class context(object):
+    def __init__(self, remaining_ms):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def drive(queue, timeout=10):
+    # hands received records to sqs_handler until the queue is empty
+    deadline = time.time() + timeout
+    bodies = []
+    while queue.get_size(processor.QUEUE_NAME) and time.time() < deadline:
+        records = queue.receive_messages(processor.QUEUE_NAME)
+        if len(records) == 0:
+            time.sleep(0.1)
+            continue
+        bodies.extend([r['body'] for r in records])
+        r = sqs_handler({'Records': records}, None)
+        assert r == {'batchItemFailures': []}
+        queue.delete_messages(processor.QUEUE_NAME, records)
+    return bodies
+
+
 @mock_dynamodb2
 @mock_sqs
 def test_processor():
@@ -55,73 +117,1100 @@ def test_processor():
     execution_id = event['id']
     # print('event %s' % event)
     event.pop('definition', None)
+    r = process(event, max_steps=1)
+    assert r == {
+        'id': execution_id,
+        'input': {'foo': 'bar'},
+        'state': 'ExecutionStarted',
+        'revision': 1,
+        'seq': 1,
+        'tenantId': '123'
+    }
+
+    r = process(r, max_steps=1)
+    assert r == {
+        "id": execution_id,
+        "input": {
+            "foo": "bar"
+        },
+        "state": "StepSucceeded",
+        "revision": 2,
+        "seq": 2,
+        "tenantId": "123",
+        "step": "wait-some-time"
+    }
+
+    r = process(r, max_steps=1)
+    # print(json.dumps(r, indent=2))
+    wait_time = r.pop('wait_timestamp', None)
+    assert wait_time.startswith('20')
+    assert r == {
+        "id": execution_id,
+        "input": {
+            "foo": "bar"
+        },
+        "state": "StepStarted",
+        "revision": 3,
+        "seq": 3,
+        "tenantId": "123",
+        "step": "wait-some-time"
+    }
+    r['wait_timestamp'] = wait_time
+
+    # re-polling an unfinished wait does not write the execution
+    repoll = dict(r, wait_timestamp='2999-01-01T00:00:00Z')
+    assert process(repoll, max_steps=1)['revision'] == 3
+    assert get_execution('123', execution_id)['revision'] == 3
+    time.sleep(2)
+
+    r = process(r, max_steps=1)
+    wait_time = r.pop('wait_timestamp', None)
+    assert r == {
+        "id": execution_id,
+        "input": {
+            "foo": "bar"
+        },
+        "state": "StepSucceeded",
+        "revision": 4,
+        "seq": 4,
+        "tenantId": "123",
+        "step": "last-echo"
+    }
+
+    r = process(r, max_steps=1)
+    assert r == {
+        "id": execution_id,
+        "input": {
+            "foo": "bar"
+        },
+        "state": "ExecutionSucceeded",
+        "revision": 5,
+        "seq": 5,
+        "tenantId": "123",
+        "step": "last-echo"
+    }
+
+    execution = get_execution('123', execution_id)
+    assert execution['state'] == 'ExecutionSucceeded'
+    assert 'activeState' not in execution
+    assert execution['updatedAt'].startswith('20')
+
+    # each transition is recorded in order, the re-poll is not
+    assert execution['seq'] == 5
+    (history, _) = backends.get_store().query(
+        processor.HISTORY_TABLE, Key('executionId').eq(execution_id)
+    )
+    assert [
+        (x['seq'], x['state'], x.get('step'), x['revision']) for x in history
+    ] == [
+        (1, 'ExecutionStarted', None, 1),
+        (2, 'StepSucceeded', 'wait-some-time', 2),
+        (3, 'StepStarted', 'wait-some-time', 3),
+        (4, 'StepSucceeded', 'last-echo', 4),
+        (5, 'ExecutionSucceeded', 'last-echo', 5)
+    ]
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_invalid_definition():
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    executions[0]['definition']['steps'][0]['next'] = 'missing'
+    h.load_dynamodb_data('sedo_execution', executions)
+
+    # the execution fails rather than the event being redelivered
+    event = {
+        'tenantId': '123',
+        'id': executions[0]['id'],
+        'state': 'ExecutionSubmitted'
+    }
     r = sqs_handler(get_sqs_event(event), None)
-    assert r == [
-        {
-            'id': execution_id,
-            'input': {'foo': 'bar'},
-            'state': 'ExecutionStarted',
-            'tenantId': '123'
-        }
+    assert r == {'batchItemFailures': []}
+    execution = get_execution('123', event['id'])
+    assert execution['state'] == 'ExecutionFailed'
+    assert execution['error'] == (
+        'invalid definition: step initial-echo next step missing not found'
+    )
+    assert 'activeState' not in execution
+    assert h.get_queue_messages('sedo_execution-processor-queue') == []
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_stale_event(monkeypatch):
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    executions[0]['revision'] = 5
+    h.load_dynamodb_data('sedo_execution', executions)
+    monkeypatch.setenv('SEDO_MAX_CHAIN_STEPS', '1')
+
+    # an event behind the execution revision is dropped, not retried
+    event = {
+        'tenantId': '123',
+        'id': executions[0]['id'],
+        'state': 'ExecutionSubmitted',
+        'revision': 4,
+        'definitionHash': 'abc123'
+    }
+    r = sqs_handler(get_sqs_event(event), None)
+    assert r == {'batchItemFailures': []}
+    execution = get_execution('123', event['id'])
+    assert execution['state'] == 'ExecutionSubmitted'
+    assert execution['revision'] == 5
+
+    r = process(dict(event, revision=5))
+    assert r['revision'] == 6
+    assert get_execution('123', event['id'])['state'] == 'ExecutionStarted'
+
+    # an event of a missing execution does not create it
+    missing = dict(event, id='123:definition1:gone', revision=0)
+    with pytest.raises(Exception) as e:
+        process(missing)
+    assert str(e.value) == 'execution not found'
+    with pytest.raises(Exception) as e:
+        get_execution('123', missing['id'])
+    assert str(e.value) == 'execution not found'
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_sqs_handler_batch():
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    h.load_dynamodb_data('sedo_execution', executions)
+    event = executions[0].copy()
+    event.pop('definition', None)
+    missing = dict(event, id='123:definition1:missing')
+
+    r = sqs_handler(get_sqs_event(
+        missing, event, 'not json', dict(missing, state='StepStarted')
+    ), None)
+    # both records of the missing execution and the invalid body are
+    # reported, the valid execution is not
+    assert r == {
+        'batchItemFailures': [
+            {'itemIdentifier': 'message-0'},
+            {'itemIdentifier': 'message-3'},
+            {'itemIdentifier': 'message-2'}
+        ]
+    }
+    execution = get_execution('123', event['id'])
+    assert execution['state'] == 'StepStarted'
+    assert execution['activeState'] == 'StepStarted'
+    assert execution['step'] == 'wait-some-time'
+
+    r = sqs_handler(get_sqs_event(dict(event, state='ExecutionStarted')), None)
+    assert r == {'batchItemFailures': []}
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_worker_pool(monkeypatch):
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    for i in range(1, 8):
+        executions.append(dict(
+            executions[0], id='123:definition1:%08d' % i
+        ))
+    h.load_dynamodb_data('sedo_execution', executions)
+    monkeypatch.setenv('SEDO_MAX_CHAIN_STEPS', '1')
+    events = [{
+        'tenantId': '123',
+        'id': e['id'],
+        'state': 'ExecutionSubmitted'
+    } for e in executions]
+
+    # batches reuse the worker threads, and their AWS resources
+    session = aws.get_session()
+    resource = session.resource
+    resources = []
+    monkeypatch.setattr(
+        session, 'resource',
+        lambda *args, **kwargs: resources.append(args) or resource(
+            *args, **kwargs
+        )
+    )
+    r = sqs_handler(get_sqs_event(*events[:4]), None)
+    assert r == {'batchItemFailures': []}
+    pool = processor.get_pool()
+    resources.clear()
+    r = sqs_handler(get_sqs_event(*events[4:]), None)
+    assert r == {'batchItemFailures': []}
+    assert processor.get_pool() is pool
+    assert resources == []
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_processor_chaining():
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    h.load_dynamodb_data('sedo_execution', executions)
+    event = executions[0].copy()
+    event.pop('definition', None)
+
+    # synchronous steps are chained until the wait step
+    r = process(event)
+    assert r.pop('wait_timestamp').startswith('20')
+    assert r == {
+        'id': event['id'],
+        'input': {'foo': 'bar'},
+        'state': 'StepStarted',
+        'revision': 1,
+        'seq': 3,
+        'tenantId': '123',
+        'step': 'wait-some-time'
+    }
+    assert len(h.get_queue_messages('sedo_execution-processor-queue')) == 0
+
+    # no lambda time left only allows a single transition
+    r = process(event, context=context(1000))
+    assert r['state'] == 'ExecutionStarted'
+
+    # wait is over so the rest of the execution completes
+    r = process(dict(event, state='StepSucceeded', step='last-echo'))
+    assert r['state'] == 'ExecutionSucceeded'
+    assert r['step'] == 'last-echo'
+    execution = get_execution('123', event['id'])
+    assert execution['state'] == 'ExecutionSucceeded'
+
+
+def test_compile_definition():
+    definition = h.load_file(_test_file('execution1.json'))[0]['definition']
+    compiled = compile_definition(definition)
+    assert compiled['first'] == 'initial-echo'
+    assert list(compiled['steps']) == [
+        'initial-echo', 'wait-some-time', 'last-echo'
     ]
 
-    r = sqs_handler(get_sqs_event(r[0]), None)
-    assert r == [
-        {
-            "id": execution_id,
-            "input": {
-                "foo": "bar"
-            },
-            "state": "StepSucceeded",
-            "tenantId": "123",
-            "step": "wait-some-time"
-        }
+    def _steps(*steps):
+        return {'id': 'd', 'steps': list(steps)}
+
+    for definition, error in [
+        (_steps(), 'definition has no steps'),
+        (
+            _steps({'id': 'a', 'end': True}, {'id': 'a', 'end': True}),
+            'duplicate step a'
+        ),
+        (_steps({'id': 'a'}), 'step a has no next step'),
+        (_steps({'id': 'a', 'next': 'b'}), 'step a next step b not found'),
+        (
+            _steps({'id': 'a', 'end': True}, {'id': 'b', 'end': True}),
+            'unreachable steps b'
+        ),
+        (
+            _steps({'id': 'a', 'next': 'b'}, {'id': 'b', 'next': 'a'}),
+            'step a loops without reaching an end step'
+        ),
+        (
+            _steps({'id': 'a', 'type': 'parallel', 'end': True}),
+            'step a has no branches'
+        ),
+        (
+            _steps({
+                'id': 'a', 'type': 'parallel', 'branches': [{'steps': []}],
+                'end': True
+            }),
+            'definition has no steps'
+        )
+    ]:
+        with pytest.raises(Exception) as e:
+            compile_definition(definition)
+        assert str(e.value) == error
+
+    # branches are compiled with the definition, keyed by their path
+    branch = _steps({'id': 'b', 'type': 'echo', 'end': True})
+    compiled = compile_definition(_steps({
+        'id': 'a', 'type': 'parallel', 'end': True, 'branches': [
+            branch,
+            _steps({
+                'id': 'c', 'type': 'parallel', 'end': True,
+                'branches': [branch]
+            })
+        ]
+    }))
+    assert sorted(compiled['branches']) == ['a/0', 'a/1', 'a/1/c/0']
+    assert processor.get_branch_definition(compiled, 'a/1/c/0')['first'] == (
+        'b'
+    )
+    assert processor.get_branch_definition(compiled) is compiled
+    with pytest.raises(Exception) as e:
+        processor.get_branch_definition(compiled, 'a/2')
+    assert str(e.value) == 'branch a/2 not found'
+
+    # every chunk of a map step runs its steps
+    compiled = compile_definition(_steps({
+        'id': 'a', 'type': 'map', 'itemsPath': 'x', 'end': True,
+        'steps': [{
+            'id': 'c', 'type': 'parallel', 'end': True, 'branches': [branch]
+        }]
+    }))
+    assert sorted(compiled['branches']) == ['a/*', 'a/*/c/0']
+    assert processor.get_branch_definition(compiled, 'a/12/c/0')['first'] == (
+        'b'
+    )
+    with pytest.raises(Exception) as e:
+        compile_definition(_steps({'id': 'a', 'type': 'map', 'end': True}))
+    assert str(e.value) == 'step a has no itemsPath'
+
+
+def test_compiled_definition_cache():
+    DEFINITION_CACHE.clear()
+    definition = h.load_file(_test_file('execution1.json'))[0]['definition']
+    compiled = get_compiled_definition(definition)
+    assert len(compiled['hash']) == 64
+    assert get_compiled_definition(None, compiled['hash']) is compiled
+    assert get_compiled_definition(None, 'unknown') is None
+    assert get_compiled_definition(None) is None
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_definition_version():
+    h.create_infra()
+    DEFINITION_CACHE.clear()
+    executions = h.load_file(_test_file('execution1.json'))
+    definition = executions[0].pop('definition')
+    executions[0].update({
+        'definitionId': 'definition1',
+        'definitionHash': 'abc123'
+    })
+    h.load_dynamodb_data('sedo_execution', executions)
+    event = executions[0].copy()
+    event.pop('definitionId')
+    event.pop('definitionHash')
+
+    # version not found
+    with pytest.raises(Exception) as e:
+        process(event, max_steps=2)
+    assert str(e.value) == 'execution definition not found'
+
+    # definition is read from the version and then cached
+    h.load_dynamodb_data('sedo_definition_version', [{
+        'tenantId': '123',
+        'id': 'abc123',
+        'definitionId': 'definition1',
+        'definition': definition
+    }])
+    r = process(event, max_steps=2)
+    assert r['state'] == 'StepSucceeded'
+    assert list(DEFINITION_CACHE) == ['abc123']
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_timers():
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    executions[0]['definition']['steps'][1]['seconds'] = 3600
+    h.load_dynamodb_data('sedo_execution', executions)
+    event = executions[0].copy()
+    event.pop('definition', None)
+
+    # long wait is scheduled as a timer rather than a queue message
+    now = time.time()
+    r = process(event)
+    assert r['state'] == 'StepStarted'
+    assert len(h.get_queue_messages('sedo_execution-processor-queue')) == 0
+    table = h.get_session().resource('dynamodb').Table('sedo_timer')
+    items = table.scan()['Items']
+    assert len(items) == 1
+    due = int(items[0]['due'])
+    assert items[0]['bucket'] == get_bucket(due)
+    assert items[0]['id'] == '123/%s/wait-some-time' % event['id']
+    assert due >= int(now) + 3600
+
+    # nothing due yet
+    assert timer_handler({}, None) == {'fired': 0}
+
+    # timer fires once due, with a delay for the rest of the minute
+    dispatched = []
+    assert fire_timers(
+        lambda events: dispatched.extend(events) or [],
+        now=due - due % 60
+    ) == 1
+    assert dispatched == [(r, due % 60)]
+    assert table.scan()['Items'] == [{
+        'bucket': 'cursor',
+        'id': 'cursor',
+        'due': due - due % 60 + 60
+    }]
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_trusted_events(monkeypatch):
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    h.load_dynamodb_data('sedo_execution', executions)
+    monkeypatch.setenv('SEDO_MAX_CHAIN_STEPS', '1')
+    # not valid against the event schema, but otherwise processable
+    event = {
+        'tenantId': '123',
+        'id': executions[0]['id'],
+        'state': 'ExecutionSubmitted',
+        'extra': True
+    }
+
+    # untrusted events are always validated
+    r = sqs_handler(get_sqs_event(event, source='processor'), None)
+    assert r == {'batchItemFailures': [{'itemIdentifier': 'message-0'}]}
+
+    # trusted processor events skip validation, other sources do not
+    monkeypatch.setattr(processor, 'TRUST_INTERNAL_EVENTS', True)
+    r = sqs_handler(get_sqs_event(event, source='other'), None)
+    assert r == {'batchItemFailures': [{'itemIdentifier': 'message-0'}]}
+    r = sqs_handler(get_sqs_event(event, source='processor'), None)
+    assert r == {'batchItemFailures': []}
+    assert get_execution('123', event['id'])['state'] == 'ExecutionStarted'
+
+    # dispatched events are marked as coming from the processor
+    processor.dispatch_event({'tenantId': '123', 'id': event['id']})
+    sqs = h.get_session().client('sqs')
+    messages = sqs.receive_message(
+        QueueUrl=h.get_queue_url('sedo_execution-processor-queue'),
+        MessageAttributeNames=['All']
+    )['Messages']
+    assert messages[0]['MessageAttributes']['sedoSource'] == {
+        'StringValue': 'processor', 'DataType': 'String'
+    }
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_outbox(monkeypatch):
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    for i in range(1, 12):
+        executions.append(dict(
+            executions[0], id='123:definition1:%08d' % i
+        ))
+    h.load_dynamodb_data('sedo_execution', executions)
+    monkeypatch.setenv('SEDO_MAX_CHAIN_STEPS', '1')
+    events = [{
+        'tenantId': '123',
+        'id': e['id'],
+        'state': 'ExecutionSubmitted'
+    } for e in executions]
+
+    # events of the whole batch are sent with SendMessageBatch
+    calls = []
+    queue = get_queue()
+    send_message_batch = queue.send_message_batch
+
+    def _send_message_batch(queue_name, entries):
+        calls.append(len(entries))
+        return send_message_batch(queue_name, entries)
+
+    monkeypatch.setattr(queue, 'send_message_batch', _send_message_batch)
+    r = sqs_handler(get_sqs_event(*events[:11]), None)
+    assert r == {'batchItemFailures': []}
+    assert calls == [11]
+    assert len(h.get_queue_messages('sedo_execution-processor-queue')) == 10
+
+    # records whose events could not be sent are redelivered
+    monkeypatch.setattr(
+        queue, 'send_message_batch', lambda queue_name, entries: entries
+    )
+    r = sqs_handler(get_sqs_event(events[11]), None)
+    assert r == {'batchItemFailures': [{'itemIdentifier': 'message-0'}]}
+    assert get_execution('123', events[11]['id'])['revision'] == 1
+
+    # a request that fails as a whole fails its messages rather than raising
+    def _fail(queue_name, entries):
+        raise Exception('request too large')
+
+    monkeypatch.setattr(queue, 'send_message_batch', _fail)
+    message = {'MessageBody': '{}'}
+    assert processor.flush_events([('queue', message)] * 2) == [0, 1]
+
+    # a duplicate is dropped, but a redelivery replays the dispatch
+    monkeypatch.setattr(queue, 'send_message_batch', _send_message_batch)
+    event = dict(events[11], revision=0, definitionHash='abc123')
+    calls.clear()
+    r = sqs_handler(get_sqs_event(event), None)
+    assert r == {'batchItemFailures': []}
+    assert calls == []
+    r = sqs_handler(get_sqs_event(event, receive_count=2), None)
+    assert r == {'batchItemFailures': []}
+    assert calls == [1]
+    assert get_execution('123', events[11]['id'])['revision'] == 1
+
+    # timers are only deleted once dispatched
+    h.load_dynamodb_data('sedo_timer', [{
+        'bucket': get_bucket(0),
+        'id': 'timer',
+        'due': 0,
+        'event': json.dumps(event)
+    }])
+    with pytest.raises(Exception) as e:
+        fire_timers(lambda events: [0], now=0)
+    assert str(e.value) == 'unable to dispatch 1 timers'
+    assert fire_timers(processor.dispatch_events, now=0) == 1
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_history(monkeypatch):
+    h.create_infra()
+    executions = h.load_file(_test_file('execution1.json'))
+    executions.append(dict(executions[0], id='123:definition1:00000001'))
+    h.load_dynamodb_data('sedo_execution', executions)
+    monkeypatch.setenv('SEDO_MAX_CHAIN_STEPS', '1')
+    events = [{
+        'tenantId': '123',
+        'id': e['id'],
+        'state': 'ExecutionSubmitted',
+        'revision': 0
+    } for e in executions]
+
+    # history of the whole batch is written with one BatchWriteItem
+    store = backends.get_store()
+    batch_write = store.batch_write
+    calls = []
+
+    def _batch_write(table, items):
+        calls.append((table, len(items)))
+        return batch_write(table, items)
+
+    monkeypatch.setattr(store, 'batch_write', _batch_write)
+    r = sqs_handler(get_sqs_event(events[0]), None)
+    assert r == {'batchItemFailures': []}
+    assert calls == [(processor.HISTORY_TABLE, 1)]
+    (history, _) = store.query(
+        processor.HISTORY_TABLE, Key('executionId').eq(events[0]['id'])
+    )
+    assert [(x['seq'], x['state']) for x in history] == [
+        (1, 'ExecutionStarted')
     ]
 
-    r = sqs_handler(get_sqs_event(r[0]), None)
-    # print(json.dumps(r, indent=2))
-    wait_time = r[0].pop('wait_timestamp', None)
-    assert wait_time.startswith('20')
-    assert r == [
-        {
-            "id": execution_id,
-            "input": {
-                "foo": "bar"
-            },
-            "state": "StepStarted",
-            "tenantId": "123",
-            "step": "wait-some-time"
-        }
+    # records whose history could not be written are redelivered without
+    # dispatching their events, and replay both
+    monkeypatch.setattr(store, 'batch_write', lambda table, items: items)
+    queue = get_queue()
+    sent = []
+    monkeypatch.setattr(
+        queue, 'send_message_batch',
+        lambda queue_name, entries: sent.extend(entries) or []
+    )
+    r = sqs_handler(get_sqs_event(events[1]), None)
+    assert r == {'batchItemFailures': [{'itemIdentifier': 'message-0'}]}
+    assert sent == []
+    monkeypatch.setattr(store, 'batch_write', _batch_write)
+    r = sqs_handler(get_sqs_event(events[1], receive_count=2), None)
+    assert r == {'batchItemFailures': []}
+    assert len(sent) == 1
+    (history, _) = store.query(
+        processor.HISTORY_TABLE, Key('executionId').eq(events[1]['id'])
+    )
+    assert [(x['seq'], x['state']) for x in history] == [
+        (1, 'ExecutionStarted')
     ]
-    r[0]['wait_timestamp'] = wait_time
-    time.sleep(2)
+    assert get_execution('123', events[1]['id'])['seq'] == 1
+
+
+@pytest.mark.parametrize('name', ['memory', 'sqlite'])
+def test_local_backends(name, monkeypatch, tmp_path):
+    # the same processing runs without AWS, driven from the local queue
+    monkeypatch.setenv('SEDO_BACKEND', name)
+    monkeypatch.setenv('SEDO_SQLITE_PATH', str(tmp_path / 'sedo.sqlite'))
+    backends.reset()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        execution = h.load_file(_test_file('execution1.json'))[0]
+        store.put_item('sedo_execution', execution)
+        queue.send_message(processor.QUEUE_NAME, {
+            'MessageBody': json.dumps({
+                'tenantId': '123',
+                'id': execution['id'],
+                'state': 'ExecutionSubmitted'
+            })
+        })
+        drive(queue)
+        execution = get_execution('123', execution['id'])
+        assert execution['state'] == 'ExecutionSucceeded'
+        assert execution['step'] == 'last-echo'
+        assert 'activeState' not in execution
+    finally:
+        backends.reset()
+
 
-    r = sqs_handler(get_sqs_event(r[0]), None)
-    wait_time = r[0].pop('wait_timestamp', None)
-    assert r == [
-        {
-            "id": execution_id,
-            "input": {
-                "foo": "bar"
-            },
-            "state": "StepSucceeded",
-            "tenantId": "123",
-            "step": "last-echo"
+def test_codec(monkeypatch):
+    # executions written before the codec was enabled are still processed,
+    # while new messages and payloads are encoded
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        execution = h.load_file(_test_file('execution1.json'))[0]
+        execution['definition'] = codec.encode(
+            execution['definition'], 'json+zlib', min_bytes=0
+        )
+        execution['input'] = codec.encode(
+            execution['input'], 'msgpack', min_bytes=0
+        )
+        store.put_item('sedo_execution', execution)
+        queue.send_message(processor.QUEUE_NAME, {
+            'MessageBody': json.dumps({
+                'tenantId': '123',
+                'id': execution['id'],
+                'state': 'ExecutionSubmitted'
+            })
+        })
+        monkeypatch.setattr(codec, 'CODEC', 'msgpack+zlib')
+        monkeypatch.setattr(codec, 'MIN_BYTES', 0)
+        bodies = drive(queue)
+        assert len(bodies) > 1
+        assert all([b.startswith('sedo:') for b in bodies[1:]])
+        execution = get_execution('123', execution['id'])
+        assert execution['state'] == 'ExecutionSucceeded'
+        assert execution['input'] == {'foo': 'bar'}
+        assert execution['definition']['id'] == 'definition1'
+    finally:
+        backends.reset()
+
+
+def test_parallel(monkeypatch):
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        echo = {'id': 'echo', 'type': 'echo', 'end': True}
+        definition = {
+            'id': 'definition1',
+            'steps': [{
+                'id': 'fan-out',
+                'type': 'parallel',
+                'maxConcurrency': 2,
+                'branches': [
+                    {'steps': [echo]},
+                    {'steps': [{
+                        'id': 'inner',
+                        'type': 'parallel',
+                        'branches': [{'steps': [echo]}, {'steps': [echo]}],
+                        'end': True
+                    }]},
+                    {'steps': [echo]}
+                ],
+                'next': 'last-echo'
+            }, {
+                'id': 'last-echo',
+                'type': 'echo',
+                'end': True
+            }]
         }
-    ]
+        version = processor.get_definition_hash(definition)
+        store.put_item('sedo_definition_version', {
+            'tenantId': '123', 'id': version, 'definition': definition
+        })
+        id = '123:definition1:abc'
+        store.put_item('sedo_execution', {
+            'tenantId': '123', 'id': id, 'state': 'ExecutionSubmitted',
+            'input': {'foo': 'bar'}, 'definitionHash': version, 'revision': 0
+        })
+        queue.send_message(processor.QUEUE_NAME, {'MessageBody': json.dumps({
+            'tenantId': '123', 'id': id, 'state': 'ExecutionSubmitted',
+            'input': {'foo': 'bar'}, 'definitionHash': version, 'revision': 0
+        })})
 
-    r = sqs_handler(get_sqs_event(r[0]), None)
-    assert r == [
-        {
-            "id": execution_id,
-            "input": {
-                "foo": "bar"
-            },
-            "state": "ExecutionSucceeded",
-            "tenantId": "123",
-            "step": "last-echo"
+        # the parent waits at the parallel step for its branches, at most
+        # two of which are started at once
+        records = queue.receive_messages(processor.QUEUE_NAME)
+        assert sqs_handler({'Records': records}, None) == {
+            'batchItemFailures': []
         }
-    ]
+        queue.delete_messages(processor.QUEUE_NAME, records)
+        execution = get_execution('123', id)
+        assert (execution['state'], execution['step']) == (
+            'StepStarted', 'fan-out'
+        )
+        records = queue.receive_messages(processor.QUEUE_NAME)
+        assert sorted([json.loads(r['body'])['id'] for r in records]) == [
+            id + ':fan-out:0', id + ':fan-out:1'
+        ]
 
-    execution = get_execution('123', execution_id)
-    assert execution['state'] == 'ExecutionSucceeded'
+        # branches are not running executions of their own, so are kept out
+        # of the active executions index
+        assert execution['activeState'] == 'StepStarted'
+        for i in range(2):
+            child = get_execution('123', '%s:fan-out:%s' % (id, i))
+            assert child['state'] == 'ExecutionSubmitted'
+            assert 'activeState' not in child
+        queue.delete_messages(processor.QUEUE_NAME, records)
+        queue.send_message_batch(processor.QUEUE_NAME, [
+            {'Id': str(i), 'MessageBody': r['body']}
+            for i, r in enumerate(records)
+        ])
+        drive(queue)
+
+        # the last branch to finish moves the parent on exactly once
+        execution = get_execution('123', id)
+        assert execution['state'] == 'ExecutionSucceeded'
+        assert execution['joined'] == [0, 1, 2]
+        (history, _) = store.query(
+            processor.HISTORY_TABLE, Key('executionId').eq(id)
+        )
+        assert [(x['state'], x.get('step')) for x in history] == [
+            ('ExecutionStarted', None),
+            ('StepStarted', 'fan-out'),
+            ('StepSucceeded', 'last-echo'),
+            ('ExecutionSucceeded', 'last-echo')
+        ]
+        for child in [
+            'fan-out:0', 'fan-out:1', 'fan-out:2', 'fan-out:1:inner:0',
+            'fan-out:1:inner:1'
+        ]:
+            execution = get_execution('123', '%s:%s' % (id, child))
+            assert execution['state'] == 'ExecutionSucceeded'
+            assert execution['input'] == {'foo': 'bar'}
+        assert execution['branch'] == 'fan-out/1/inner/1'
+        assert execution['parent']['id'] == id + ':fan-out:1'
+
+        # a redelivered branch completion adds nothing, nor moves the
+        # parent on again
+        event = {
+            'tenantId': '123', 'id': id + ':fan-out:2',
+            'state': 'ExecutionSucceeded', 'step': 'echo',
+            'branch': 'fan-out/2', 'definitionHash': version, 'parent': {
+                'id': id, 'revision': 1, 'seq': 2, 'count': 3
+            }
+        }
+        processor.join_parent(event, {
+            'tenantId': '123', 'id': event['id'], 'definitionHash': version
+        })
+        assert queue.get_size(processor.QUEUE_NAME) == 0
+        assert get_execution('123', id)['revision'] == 2
+    finally:
+        backends.reset()
+
+
+def test_map(monkeypatch):
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    claimcheck.CACHE.clear()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        definition = {
+            'id': 'definition1',
+            'steps': [{
+                'id': 'map-items',
+                'type': 'map',
+                'itemsPath': 'data.items',
+                'chunkSize': 4,
+                'maxConcurrency': 2,
+                'steps': [{'id': 'echo', 'type': 'echo', 'end': True}],
+                'next': 'last-echo'
+            }, {
+                'id': 'last-echo',
+                'type': 'echo',
+                'end': True
+            }]
+        }
+        version = processor.get_definition_hash(definition)
+        store.put_item('sedo_definition_version', {
+            'tenantId': '123', 'id': version, 'definition': definition
+        })
+
+        # a large input is loaded from the blob store to be split into
+        # chunks, which are offloaded again
+        monkeypatch.setattr(claimcheck, 'THRESHOLD', 50)
+        items = ['item-%02d' % i for i in range(25)]
+        input = claimcheck.offload({'data': {'items': items}}, '123')
+        assert claimcheck.is_ref(input)
+        id = '123:definition1:abc'
+        event = {
+            'tenantId': '123', 'id': id, 'state': 'ExecutionSubmitted',
+            'input': input, 'definitionHash': version, 'revision': 0
+        }
+        store.put_item('sedo_execution', dict(event))
+        queue.send_message(
+            processor.QUEUE_NAME, {'MessageBody': json.dumps(event)}
+        )
+        calls = []
+        get_items = processor.get_items
+
+        def _get_items(event, sd):
+            calls.append(sd['id'])
+            return get_items(event, sd)
+
+        monkeypatch.setattr(processor, 'get_items', _get_items)
+        drive(queue)
+        monkeypatch.setattr(processor, 'get_items', get_items)
+
+        # the items are only read when the step starts, not by each join
+        assert calls == ['map-items']
+
+        # chunks ran as sub-executions, and only their count is aggregated
+        # into the parent's output, the input of the next step
+        execution = get_execution('123', id)
+        assert execution['state'] == 'ExecutionSucceeded'
+        assert execution['output'] == {'count': 25, 'chunks': 7}
+        assert execution['joined'] == list(range(7))
+        for i in range(7):
+            chunk = get_execution('123', '%s:map-items:%s' % (id, i))
+            assert chunk['state'] == 'ExecutionSucceeded'
+            assert chunk['branch'] == 'map-items/%s' % i
+            assert claimcheck.load(chunk['input']) == {
+                'items': items[i * 4:(i + 1) * 4]
+            }
+
+        # the chunks started as others finish were offloaded once, and the
+        # parent's input is not read again to start or join them
+        assert 'childInputs' not in execution
+        inputs = processor.get_child_inputs(event, definition['steps'][0])
+        assert inputs[5:] == [
+            claimcheck.load(get_execution('123', '%s:map-items:%s' % (
+                id, i
+            ))['input']) for i in [5, 6]
+        ]
+        refs = processor.offload_inputs(inputs, '123')
+        assert all(claimcheck.is_ref(ref) for ref in refs)
+        assert [claimcheck.load(ref) for ref in refs] == inputs
+
+        # an empty array is mapped without sub-executions
+        sd = dict(definition['steps'][0], id='map-none')
+        assert processor.get_child_inputs({'input': {'data': {
+            'items': []
+        }}}, sd) == []
+
+        # an input without an array fails the execution, as redelivering
+        # its event can't fix the input
+        event = dict(event, id='123:definition1:none', input={'data': {}})
+        store.put_item('sedo_execution', dict(event))
+        queue.send_message(
+            processor.QUEUE_NAME, {'MessageBody': json.dumps(event)}
+        )
+        drive(queue)
+        execution = get_execution('123', event['id'])
+        assert execution['state'] == 'ExecutionFailed'
+        assert 'activeState' not in execution
+        assert execution['error'] == (
+            'invalid input: step map-items itemsPath data.items is not an '
+            'array'
+        )
+    finally:
+        backends.reset()
+        claimcheck.CACHE.clear()
+
+
+def test_fair_scheduling(monkeypatch):
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    monkeypatch.setattr(scheduling, 'SHARDS', 4)
+    monkeypatch.setattr(scheduling, 'QUOTA', 0.0003)
+    monkeypatch.setattr(scheduling, 'WINDOW_SECONDS', 3600)
+    monkeypatch.setattr(scheduling, 'WEIGHTS', {'456': 2})
+    backends.reset()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        execution = h.load_file(_test_file('execution1.json'))[0]
+        events = []
+        for tenant_id, count in [('123', 3), ('456', 2)]:
+            for i in range(count):
+                id = '%s:definition1:%08d' % (tenant_id, i)
+                store.put_item('sedo_execution', dict(
+                    execution, tenantId=tenant_id, id=id
+                ))
+                events.append({
+                    'tenantId': tenant_id,
+                    'id': id,
+                    'state': 'ExecutionSubmitted'
+                })
+
+        # each tenant's events are admitted up to its weighted quota, the
+        # rest are sent again to the tenant's shard, delayed
+        r = sqs_handler(get_sqs_event(
+            *events, source='processor', receive_count=2
+        ), None)
+        assert r == {'batchItemFailures': []}
+        revisions = [
+            get_execution(e['tenantId'], e['id']).get('revision', 0)
+            for e in events
+        ]
+        assert revisions == [1, 0, 0, 1, 1]
+        queue_name = scheduling.get_queue_name('123')
+        assert queue_name != scheduling.get_queue_name('456')
+        assert queue.get_size(queue_name) == 3
+        deferred = [
+            m for m in queue.queues[queue_name]['messages'].values()
+            if 'sedoReplay' in m['attributes']
+        ]
+        assert [json.loads(m['body'])['id'] for m in deferred] == [
+            e['id'] for e in events[1:3]
+        ]
+        for m in deferred:
+            assert m['visible_at'] > time.time() + 1
+            assert set(m['attributes']) == set(['sedoSource', 'sedoReplay'])
+        assert queue.get_size(scheduling.get_queue_name('456')) == 2
+
+        # deferred redeliveries still replay
+        (record,) = get_sqs_event(events[1])['Records']
+        record['messageAttributes'] = deferred[0]['attributes']
+        assert processor.is_replay(record)
+
+        # events are admitted when usage can't be counted
+        monkeypatch.setattr(store, 'update_item', None)
+        assert scheduling.admit('123', 5) == (5, 0)
+    finally:
+        backends.reset()
+
+
+def test_duplicates(monkeypatch):
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    backends.reset()
+    try:
+        store = backends.get_store()
+        queue = backends.get_queue()
+        execution = h.load_file(_test_file('execution1.json'))[0]
+        store.put_item('sedo_execution', execution)
+        event = {
+            'tenantId': '123',
+            'id': execution['id'],
+            'state': 'ExecutionSubmitted',
+            'revision': 0
+        }
+        calls = []
+        (get_item, update_item) = (store.get_item, store.update_item)
+        monkeypatch.setattr(
+            store, 'get_item',
+            lambda *args, **kwargs: calls.append('get') or get_item(
+                *args, **kwargs
+            )
+        )
+        monkeypatch.setattr(
+            store, 'update_item',
+            lambda *args, **kwargs: calls.append('update') or update_item(
+                *args, **kwargs
+            )
+        )
+
+        def handle(message_id, receive_count=1):
+            sqs_event = get_sqs_event(event, receive_count=receive_count)
+            sqs_event['Records'][0]['messageId'] = message_id
+            calls.clear()
+            assert sqs_handler(sqs_event, None) == {'batchItemFailures': []}
+
+        handle('message-1')
+        e = get_execution('123', execution['id'])
+        assert (e['revision'], e['seq'], e['messageId']) == (1, 3, 'message-1')
+        assert queue.get_size(processor.QUEUE_NAME) == 1
+
+        # a duplicate is dropped before the execution is read
+        handle('message-2')
+        assert calls == []
+
+        # or, in another container, before its transitions are run again
+        processor.DEDUPE_CACHE.clear()
+        handle('message-2')
+        assert calls == ['get']
+
+        # a redelivery of the message replays its dispatch, a redelivered
+        # duplicate does not
+        handle('message-2', receive_count=2)
+        assert 'update' in calls
+        assert queue.get_size(processor.QUEUE_NAME) == 1
+        handle('message-1', receive_count=2)
+        assert queue.get_size(processor.QUEUE_NAME) == 2
+        assert get_execution('123', execution['id'])['revision'] == 1
+
+        # processed revisions expire from the cache
+        assert processor.is_duplicate(event)
+        assert not processor.is_duplicate(event, now=time.time() + 301)
+        assert not processor.is_duplicate(event)
+        monkeypatch.setattr(processor, 'DEDUPE_CACHE_SIZE', 1)
+        processor.set_processed(dict(event, revision=1))
+        processor.set_processed(dict(event, revision=2))
+        assert list(processor.DEDUPE_CACHE) == [('123', execution['id'], 2)]
+    finally:
+        backends.reset()
+
+
+@mock_dynamodb2
+@mock_sqs
+def test_metrics(capsys):
+    h.create_infra()
+    execution = h.load_file(_test_file('execution1.json'))[0]
+    h.load_dynamodb_data('sedo_execution', [execution])
+    event = get_sqs_event({
+        'tenantId': '123',
+        'id': execution['id'],
+        'state': 'ExecutionSubmitted'
+    })
+    event['Records'][0]['attributes']['SentTimestamp'] = str(
+        int(time.time() * 1000) - 2000
+    )
+    capsys.readouterr()
+    assert sqs_handler(event, None) == {'batchItemFailures': []}
+    lines = [json.loads(x) for x in capsys.readouterr().out.splitlines()]
+    emf = [x for x in lines if '_aws' in x]
+
+    # a metrics line per record, and one for the batch
+    assert len(emf) == 2
+    metrics = emf[0]
+    assert metrics['executionId'] == execution['id']
+    assert metrics['state'] == 'StepStarted'
+    assert metrics['step'] == 'wait-some-time'
+    assert metrics['QueueLag'] >= 2000
+    assert metrics['Transitions'] == 3
+    # the execution and its embedded definition are read once
+    assert metrics['StoreCalls'] == 3
+    for name in [
+        'ValidateTime', 'ReadTime', 'WriteTime', 'DispatchTime',
+        'ProcessTime', 'PayloadBytes', 'DispatchBytes'
+    ]:
+        assert name in metrics
+    assert emf[1]['Records'] == 1
+    assert emf[1]['QueueCalls'] == 1
+    assert emf[1]['Failures'] == 0
+
+    # events are not logged in full
+    assert not any(['event' in x for x in lines])
+
+
+def test_claimcheck(monkeypatch):
+    # large payloads are dispatched as references, and not loaded by steps
+    # that do not use them
+    monkeypatch.setenv('SEDO_BACKEND', 'memory')
+    monkeypatch.setattr(claimcheck, 'THRESHOLD', 1000)
+    backends.reset()
+    claimcheck.CACHE.clear()
+    try:
+        execution = h.load_file(_test_file('execution1.json'))[0]
+        backends.get_store().put_item('sedo_execution', execution)
+        event = {
+            'tenantId': '123',
+            'id': execution['id'],
+            'state': 'ExecutionSubmitted',
+            'input': {'foo': 'x' * 2000}
+        }
+        r = sqs_handler(get_sqs_event(event), None)
+        assert r == {'batchItemFailures': []}
+        # dispatched with the delay of the wait step
+        time.sleep(1.1)
+        queue = backends.get_queue()
+        (record,) = queue.receive_messages(processor.QUEUE_NAME)
+        assert len(record['body']) < 1000
+        dispatched = json.loads(record['body'])
+        ref = dispatched['input']
+        assert claimcheck.is_ref(ref)
+        assert claimcheck.load(ref) == event['input']
+
+        blobs = backends.get_blobs()
+        monkeypatch.setattr(blobs, 'get', None)
+        claimcheck.CACHE.clear()
+        dispatched.pop('wait_timestamp')
+        dispatched['state'] = 'StepSucceeded'
+        dispatched['step'] = 'last-echo'
+        r = sqs_handler(get_sqs_event(dispatched, source='processor'), None)
+        assert r == {'batchItemFailures': []}
+        assert get_execution('123', execution['id'])['state'] == (
+            'ExecutionSucceeded'
+        )
+    finally:
+        backends.reset()
+        claimcheck.CACHE.clear()